@@ -4,29 +4,47 @@ Uses Ollama (local LLM) or OpenAI GPT-4 to generate personalized credit dispute
 """
 
 import os
-import requests
+import time
 from dotenv import load_dotenv
 
+import metrics
+from http_clients import get_openai_client as shared_openai_client
+
 load_dotenv()
 
 # OpenAI configuration (lazy initialization)
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 
 def get_openai_client():
-    """Lazy initialize OpenAI client only when needed"""
-    if not OPENAI_API_KEY:
-        return None
+    """Shared OpenAI client, created on first use (see http_clients)"""
     try:
-        from openai import OpenAI
-        return OpenAI(api_key=OPENAI_API_KEY)
+        return shared_openai_client()
     except Exception as e:
         print(f"Failed to initialize OpenAI client: {e}")
         return None
 
+# Provider registry/router
+from llm_providers import (
+    OLLAMA_BASE_URL, DEFAULT_LATENCY_BUDGET, HEDGING_ENABLED, ProviderUnavailable,
+    get_provider, route, complete_with_routing, complete_hedged
+)
+
+from prompts import PROMPT_VERSION, letter_prompt, premium_prompt, batch_prompt
+
 # Ollama configuration
-OLLAMA_API_URL = "http://localhost:11434/api/generate"
+OLLAMA_API_URL = f"{OLLAMA_BASE_URL}/api/generate"
 OLLAMA_MODEL = "llama3.2"  # Using llama3.2 for better text generation
 
+def standard_letter_request(account_info: dict, version: str = PROMPT_VERSION):
+    """Per-provider request builder for the standard (free) letter"""
+    def build(provider):
+        system, prompt = letter_prompt(provider.kind, account_info, version)
+        return {"system": system, "prompt": prompt,
+                "temperature": 0.7,  # Slight creativity but mostly consistent
+                "max_tokens": 600 if provider.kind == "ollama" else 800,
+                "prompt_version": version}
+    return build
+
 def generate_dispute_letter_ollama(account_info: dict, personal_info: dict = None) -> str:
     """
     Generate a personalized credit dispute letter using Ollama (local LLM)
@@ -38,75 +56,23 @@ def generate_dispute_letter_ollama(account_info: dict, personal_info: dict = Non
     Returns:
         Generated letter text
     """
-    
-    # Build the prompt
-    prompt = f"""You are an expert credit repair specialist. Generate a professional, legally-compliant credit dispute letter.
-
-ACCOUNT INFORMATION:
-- Credit Bureau: {account_info.get('bureau', 'N/A')}
-- Creditor: {account_info.get('creditor_name', 'N/A')}
-- Account Number: {account_info.get('account_number', 'N/A')}
-- Account Type: {account_info.get('account_type', 'Not specified')}
-- Balance: ${account_info.get('balance', 'N/A')}
-- Dispute Reason: {account_info.get('reason', 'N/A')}
-"""
-
-    if account_info.get('notes'):
-        prompt += f"- Additional Details: {account_info['notes']}\n"
-
-    prompt += """
-REQUIREMENTS:
-1. Write a formal business letter in a professional tone
-2. Cite the Fair Credit Reporting Act (FCRA) rights
-3. Clearly state what is being disputed and why
-4. Request investigation and correction within 30 days
-5. Request written confirmation of results
-6. Be firm but respectful
-7. Keep it concise (300-500 words)
-8. Include proper letter structure (date, recipient, body, closing)
-9. Use "To Whom It May Concern:" as greeting
-10. Sign off with "Sincerely,"
-
-DO NOT include:
-- Sender's personal information in the body (will be added separately)
-- Threats or aggressive language
-- Irrelevant information
-- Legal jargon that's too complex
-
-Generate ONLY the letter body. Start with today's date and the bureau address."""
-
+    provider = get_provider(f"ollama:{OLLAMA_MODEL}")
     try:
-        # Call Ollama API
-        response = requests.post(
-            OLLAMA_API_URL,
-            json={
-                "model": OLLAMA_MODEL,
-                "prompt": prompt,
-                "stream": False,
-                "options": {
-                    "temperature": 0.7,
-                    "top_p": 0.9,
-                    "num_predict": 600  # Limit response length
-                }
-            },
-            timeout=60
-        )
-        
-        if response.status_code == 200:
-            result = response.json()
-            return result.get("response", "").strip()
-        else:
-            print(f"Ollama API error: {response.status_code}")
-            return None
-            
+        return provider.complete(**standard_letter_request(account_info)(provider))
+    except ProviderUnavailable as e:
+        print(f"⏭️  {e}")
+        return None
     except Exception as e:
         print(f"Error generating letter with Ollama: {e}")
         return None
 
-def generate_dispute_letter_ai(account_info: dict, personal_info: dict = None) -> str:
+def generate_dispute_letter_ai(account_info: dict, personal_info: dict = None,
+                               latency_budget: float = DEFAULT_LATENCY_BUDGET,
+                               hedge: bool = HEDGING_ENABLED, source_out: dict = None) -> str:
     """
     Generate a personalized credit dispute letter using AI
-    Tries Ollama first (free, local), falls back to OpenAI if needed
+    The router picks the provider: local Ollama first while it is healthy and fits the
+    latency budget, then OpenAI gpt-4o-mini (see llm_providers.route)
     
     Args:
         account_info: Dictionary with account details
@@ -123,90 +89,192 @@ def generate_dispute_letter_ai(account_info: dict, personal_info: dict = None) -
             - city: City
             - state: State
             - zip: ZIP code
+        latency_budget: Target seconds for this call (None = no budget)
+        hedge: Race a slow primary against the next provider (see llm_providers.complete_hedged)
+        source_out: Filled with the letter's 'model' and 'prompt_version' (optional)
     
     Returns:
         Generated letter text
     """
-    
-    # Try Ollama first (local, free)
-    print("🤖 Generating letter with Ollama...")
-    letter = generate_dispute_letter_ollama(account_info, personal_info)
+    source_out = {} if source_out is None else source_out
+    print("🤖 Generating letter with AI...")
+    complete = complete_hedged if hedge else complete_with_routing
+    letter, provider = complete(
+        standard_letter_request(account_info),
+        tier="standard",
+        latency_budget=latency_budget
+    )
     
     if letter:
-        print("✅ Letter generated successfully with Ollama!")
+        print(f"✅ Letter generated successfully with {provider.name}!")
+        source_out.update(model=provider.name, prompt_version=PROMPT_VERSION)
         return letter
     
-    # Fallback to OpenAI if Ollama fails
-    client = get_openai_client()
-    if not client:
+    if not get_openai_client():
         print("⚠️  No AI available (Ollama failed, OpenAI key not set)")
         return None
     
-    print("🔄 Falling back to OpenAI GPT-4...")
-    
-    # Build the prompt (same as Ollama)
-    prompt = f"""You are an expert credit repair specialist. Generate a professional, legally-compliant credit dispute letter.
-
-ACCOUNT INFORMATION:
-- Credit Bureau: {account_info.get('bureau', 'N/A')}
-- Creditor: {account_info.get('creditor_name', 'N/A')}
-- Account Number: {account_info.get('account_number', 'N/A')}
-- Account Type: {account_info.get('account_type', 'Not specified')}
-- Balance: ${account_info.get('balance', 'N/A')}
-- Dispute Reason: {account_info.get('reason', 'N/A')}
-"""
+    # Fallback to template if AI fails
+    print("AI generation failed, using fallback letter")
+    source_out.update(model="fallback", prompt_version=None)
+    return generate_fallback_letter(account_info)
 
-    if account_info.get('notes'):
-        prompt += f"- Additional Details: {account_info['notes']}\n"
 
-    prompt += """
-REQUIREMENTS:
-1. Write a formal business letter in a professional tone
-2. Cite the Fair Credit Reporting Act (FCRA) rights
-3. Clearly state what is being disputed and why
-4. Request investigation and correction
-5. Request written confirmation of results
-6. Be firm but respectful
-7. Keep it concise (300-500 words)
-8. Include proper letter structure (date, recipient, body, closing)
-9. Use "Dear Sir or Madam" as greeting
-10. Sign off with "Sincerely,"
-
-DO NOT include:
-- Sender's personal information in the body (will be added separately)
-- Threats or aggressive language
-- Irrelevant information
-- Legal jargon that's too complex
-
-Generate ONLY the letter body. Start with the date line."""
+def stream_dispute_letter_ai(account_info: dict, latency_budget: float = DEFAULT_LATENCY_BUDGET):
+    """
+    Stream a standard letter as it is generated (for the live preview)
+    Providers are tried in routing order until one produces output; once text has
+    been sent a failure ends the stream instead of restarting with another provider.
+    Closing the generator aborts the in-flight backend request.
+    
+    Yields:
+        ('token', text) chunks, then ('done', provider name) or ('error', message)
+    """
+    build = standard_letter_request(account_info)
+    for provider in route("standard", latency_budget):
+        started_output = False
+        chunks = provider.stream(**build(provider))
+        try:
+            for chunk in chunks:
+                started_output = True
+                yield "token", chunk
+            yield "done", provider.name
+            return
+        except ProviderUnavailable as e:
+            print(f"⏭️  {e}")
+        except Exception as e:
+            print(f"⚠️  {provider.name} failed: {e}")
+            if started_output:
+                yield "error", "Letter generation was interrupted, please try again"
+                return
+        finally:
+            chunks.close()
+
+    if not get_openai_client():
+        yield "error", "No AI available (Ollama failed, OpenAI key not set)"
+        return
+
+    print("AI generation failed, using fallback letter")
+    yield "token", generate_fallback_letter(account_info)
+    yield "done", "fallback"
+
+
+BATCH_LETTERS_ENABLED = os.getenv("LLM_BATCH_LETTERS", "1") == "1"
+BATCH_SIZE = int(os.getenv("LLM_BATCH_SIZE", "5"))
+BATCH_TOKENS_PER_LETTER = 800
+
+BATCH_LETTERS_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "letters": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "id": {"type": "string"},
+                    "letter": {"type": "string"}
+                },
+                "required": ["id", "letter"],
+                "additionalProperties": False
+            }
+        }
+    },
+    "required": ["letters"],
+    "additionalProperties": False
+}
+
+def validate_letter(letter: str, account_info: dict) -> bool:
+    """Cheap sanity checks on a generated letter before we trust it"""
+    if not letter or len(letter.split()) < 120:
+        return False
+    text = letter.lower()
+    creditor = str(account_info.get('creditor_name') or '').lower()
+    account_number = str(account_info.get('account_number') or '').lower()
+    mentions_account = (creditor and creditor in text) or (account_number and account_number in text)
+    return bool(mentions_account) and "sincerely" in text
+
+def _generate_letter_chunk(account_infos: list, sources_out: list) -> list:
+    """
+    One structured request for a chunk of accounts; returns letters (None where invalid)
+    and appends each letter's source (model, prompt version) to sources_out
+    """
+    import json
+
+    def build(provider):
+        system, prompt = batch_prompt(provider.kind, account_infos)
+        return {
+            "system": system,
+            "prompt": prompt,
+            "temperature": 0.7,
+            "max_tokens": BATCH_TOKENS_PER_LETTER * len(account_infos) + 200,
+            "json_schema": BATCH_LETTERS_SCHEMA,
+            "usage_out": usage,
+            "prompt_version": PROMPT_VERSION
+        }
+
+    usage = {}
+    raw, provider = complete_with_routing(build, tier="standard")
+    metrics.incr("batch.requests")
+    metrics.incr("batch.prompt_tokens", usage.get('prompt_tokens', 0))
+    metrics.incr("batch.completion_tokens", usage.get('completion_tokens', 0))
+    if not raw:
+        sources_out.extend({} for _ in account_infos)
+        return [None] * len(account_infos)
 
     try:
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",  # Using gpt-4o-mini for cost efficiency
-            messages=[
-                {
-                    "role": "system",
-                    "content": "You are a professional credit repair specialist who writes effective, legally-compliant dispute letters. Your letters are clear, firm, and always get results."
-                },
-                {
-                    "role": "user",
-                    "content": prompt
-                }
-            ],
-            temperature=0.7,  # Slight creativity but mostly consistent
-            max_tokens=800
-        )
-        
-        letter_content = response.choices[0].message.content.strip()
-        return letter_content
-        
-    except Exception as e:
-        # Fallback to template if AI fails
-        print(f"AI generation failed: {e}")
-        return generate_fallback_letter(account_info)
+        items = json.loads(raw).get("letters", [])
+    except (ValueError, AttributeError) as e:
+        print(f"⚠️  Batch response from {provider.name} was not valid JSON: {e}")
+        sources_out.extend({} for _ in account_infos)
+        return [None] * len(account_infos)
+    sources_out.extend({'model': provider.name, 'prompt_version': PROMPT_VERSION} for _ in account_infos)
+
+    by_id = {str(item.get("id")): item.get("letter", "").strip() for item in items if isinstance(item, dict)}
+    letters = []
+    for index, account_info in enumerate(account_infos):
+        letter = by_id.get(str(index))
+        letters.append(letter if validate_letter(letter, account_info) else None)
+    return letters
+
+def generate_dispute_letters_batch(account_infos: list, batch_size: int = BATCH_SIZE,
+                                   sources_out: list = None) -> list:
+    """
+    Generate letters for several accounts with one structured LLM call per chunk of
+    batch_size accounts. Letters that are missing or fail validate_letter are retried
+    individually with generate_dispute_letter_ai.
+    
+    Returns:
+        List of letter texts in the same order as account_infos (None where AI failed);
+        sources_out (optional) is filled with each letter's model and prompt version
+    """
+    started = time.monotonic()
+    letters = []
+    sources = []
+
+    if BATCH_LETTERS_ENABLED and len(account_infos) > 1:
+        print(f"🤖 Generating {len(account_infos)} letters in batches of {batch_size}...")
+        for start in range(0, len(account_infos), batch_size):
+            letters.extend(_generate_letter_chunk(account_infos[start:start + batch_size], sources))
+    else:
+        letters = [None] * len(account_infos)
+        sources = [{} for _ in account_infos]
 
+    metrics.incr("batch.items", len(account_infos))
+    for index, letter in enumerate(letters):
+        if letter is None:
+            if BATCH_LETTERS_ENABLED and len(account_infos) > 1:
+                metrics.incr("batch.items_fallback")
+            sources[index] = {}
+            letters[index] = generate_dispute_letter_ai(account_infos[index], source_out=sources[index])
+    if sources_out is not None:
+        sources_out[:] = sources
 
-def generate_dispute_letter_premium(account_info: dict, personal_info: dict = None, custom_instructions: str = "") -> str:
+    metrics.observe("batch.seconds", time.monotonic() - started)
+    return letters
+
+
+def generate_dispute_letter_premium(account_info: dict, personal_info: dict = None, custom_instructions: str = "",
+                                    source_out: dict = None) -> str:
     """
     Generate a premium letter using GPT-4 with custom instructions
     This is the paid tier - higher quality, customizable output
@@ -215,78 +283,38 @@ def generate_dispute_letter_premium(account_info: dict, personal_info: dict = No
         account_info: Dictionary with account details
         personal_info: Dictionary with sender details (optional)
         custom_instructions: Custom prompt modifications (tone, emphasis, details)
+        source_out: Filled with the letter's 'model' and 'prompt_version' (optional)
     
     Returns:
         Generated letter text
     """
-    client = get_openai_client()
-    if not client:
+    if not get_openai_client():
         print("❌ OpenAI API key not configured!")
         return None
     
     print("✨ Generating PREMIUM letter with GPT-4...")
     
-    # Build enhanced prompt with custom instructions
-    prompt = f"""You are an expert credit repair specialist. Generate a professional, legally-compliant credit dispute letter.
-
-ACCOUNT INFORMATION:
-- Credit Bureau: {account_info.get('bureau', 'N/A')}
-- Creditor: {account_info.get('creditor_name', 'N/A')}
-- Account Number: {account_info.get('account_number', 'N/A')}
-- Account Type: {account_info.get('account_type', 'Not specified')}
-- Balance: ${account_info.get('balance', 'N/A')}
-- Dispute Reason: {account_info.get('reason', 'N/A')}
-"""
-
-    if account_info.get('notes'):
-        prompt += f"- Additional Details: {account_info['notes']}\n"
-
-    # Add custom instructions
-    if custom_instructions:
-        prompt += f"\nCUSTOM REQUIREMENTS:\n{custom_instructions}\n"
-
-    prompt += """
-STANDARD REQUIREMENTS:
-1. Write a formal business letter
-2. Cite the Fair Credit Reporting Act (FCRA) rights
-3. Clearly state what is being disputed and why
-4. Request investigation and correction
-5. Request written confirmation of results
-6. Include proper letter structure (date, recipient, body, closing)
-7. Use "Dear Sir or Madam" as greeting
-8. Sign off with "Sincerely,"
-
-DO NOT include:
-- Sender's personal information in the body (will be added separately)
-- Threats or aggressive language
-- Irrelevant information
-
-Generate ONLY the letter body. Start with the date line."""
-
-    try:
-        response = client.chat.completions.create(
-            model="gpt-4",  # Premium GPT-4 for best quality
-            messages=[
-                {
-                    "role": "system",
-                    "content": "You are an elite credit repair specialist with 20+ years experience. Your letters are meticulously crafted, legally bulletproof, and highly effective. You adapt your writing style based on client needs while maintaining professionalism."
-                },
-                {
-                    "role": "user",
-                    "content": prompt
-                }
-            ],
-            temperature=0.8,  # Higher creativity for premium tier
-            max_tokens=1000  # Allow longer, more detailed letters
-        )
-        
-        letter_content = response.choices[0].message.content.strip()
-        print("✅ Premium letter generated successfully!")
-        return letter_content
-        
-    except Exception as e:
-        print(f"❌ Premium generation failed: {e}")
+    system, prompt = premium_prompt(account_info, custom_instructions)
+    letter_content, provider = complete_with_routing(
+        lambda provider: {
+            "system": system,
+            "prompt": prompt,
+            "temperature": 0.8,  # Higher creativity for premium tier
+            "max_tokens": 1000,  # Allow longer, more detailed letters
+            "prompt_version": PROMPT_VERSION
+        },
+        tier="premium",
+        latency_budget=None
+    )
+    
+    if not letter_content:
+        print("❌ Premium generation failed")
         return None
+    
+    print(f"✅ Premium letter generated successfully with {provider.name}!")
+    if source_out is not None:
+        source_out.update(model=provider.name, prompt_version=PROMPT_VERSION)
+    return letter_content
 
 
 def generate_fallback_letter(account_info: dict) -> str:
@@ -1,10 +1,10 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, send_file
+from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, send_file, Response, stream_with_context
 from datetime import datetime, timedelta
 from pathlib import Path
 import csv
-import subprocess
+import io
 import json
-from functools import wraps
+from functools import wraps, partial
 import pandas as pd
 import os
 import requests
@@ -22,9 +22,12 @@ from db import (
     add_document, get_user_documents, get_document_by_id, delete_document,
     update_document_analysis, get_disputes_awaiting_response,
     get_user_by_email, create_user_with_email, update_last_login_by_email,
-    check_profile_completed, update_user_profile, update_dispute_pdf_path
+    check_profile_completed, update_user_profile
 )
 from document_analyzer import analyze_document
+from pregenerator import schedule_pregeneration
+from http_clients import get_session
+from jobs import submit_job, get_job, job_json
 import hashlib
 
 def validate_password(password):
@@ -147,7 +150,10 @@ def get_status_color(status):
         "sent": "info",
         "failed": "danger",
         "invalid_tracking_id": "danger",
-        "pending": "secondary"
+        "pending": "secondary",
+        "sending": "info",
+        "returned_to_sender": "danger",
+        "cancelled": "secondary"
     }
     return colors.get(status, "secondary")
 
@@ -285,12 +291,18 @@ def index():
     # Get recent accounts (last 5)
     recent_accounts = accounts[:5] if len(accounts) > 5 else accounts
     
+    # Background send/status check started from here: the page polls /jobs/<id> until it's done
+    job = get_job(request.args.get('job_id', ''))
+    if job and job['user_id'] != user_id:
+        job = None
+    
     return render_template('dashboard.html', 
                          disputes=disputes, 
                          stats=stats,
                          recent_accounts=recent_accounts,
                          awaiting_response=awaiting_response,
                          get_status_color=get_status_color,
+                         job=job_json(job) if job else None,
                          username=session.get('username'))
 
 def get_device_fingerprint():
@@ -628,7 +640,7 @@ def accounts():
             
             if all([bureau, creditor, account_number, reason]):
                 # Add account to database
-                add_user_account(
+                account_id = add_user_account(
                     user_id=user_id,
                     bureau=bureau,
                     creditor_name=creditor,
@@ -640,16 +652,20 @@ def accounts():
                 )
                 
                 # Also create a pending dispute automatically for the funnel
-                log_dispute(
+                dispute_id = log_dispute(
                     user_id=user_id,
                     account_number=account_number,
                     bureau=bureau,
                     description=reason,
                     tracking_id=None,
                     status='pending',
-                    creditor_name=creditor
+                    creditor_name=creditor,
+                    account_id=account_id
                 )
                 
+                # Start building the letter in the background so /generate-batch is instant
+                schedule_pregeneration(dispute_id)
+                
                 flash(f'✅ Account added! Ready to send dispute letter.', 'success')
                 # Redirect to send batch to complete the funnel
                 return redirect(url_for('send_batch'))
@@ -731,16 +747,34 @@ def upload_accounts():
                         errors.append(f"Row {index + 2}: Missing required field")
                         continue
                     
-                    add_user_account(
+                    bureau = str(row['bureau']).strip()
+                    creditor = str(row['creditor_name']).strip()
+                    account_number = str(row['account_number']).strip()
+                    reason = str(row['reason']).strip()
+                    
+                    account_id = add_user_account(
                         user_id=user_id,
-                        bureau=str(row['bureau']).strip(),
-                        creditor_name=str(row['creditor_name']).strip(),
-                        account_number=str(row['account_number']).strip(),
-                        reason=str(row['reason']).strip(),
+                        bureau=bureau,
+                        creditor_name=creditor,
+                        account_number=account_number,
+                        reason=reason,
                         account_type=str(row.get('account_type', '')).strip() if pd.notna(row.get('account_type')) else None,
                         balance=float(row['balance']) if pd.notna(row.get('balance')) else None,
                         notes=str(row.get('notes', '')).strip() if pd.notna(row.get('notes')) else None
                     )
+                    
+                    # Create the pending dispute for the funnel (same as /accounts)
+                    dispute_id = log_dispute(
+                        user_id=user_id,
+                        account_number=account_number,
+                        bureau=bureau,
+                        description=reason,
+                        tracking_id=None,
+                        status='pending',
+                        creditor_name=creditor,
+                        account_id=account_id
+                    )
+                    schedule_pregeneration(dispute_id)
                     success_count += 1
                 except Exception as e:
                     error_count += 1
@@ -793,6 +827,18 @@ def download_template():
                      download_name='accounts_template.csv',
                      mimetype='text/csv')
 
+def preview_account_info(data):
+    """Account details posted by the letter preview page"""
+    return {
+        'bureau': data.get('bureau'),
+        'creditor_name': data.get('creditor_name'),
+        'account_number': data.get('account_number'),
+        'reason': data.get('reason'),
+        'account_type': data.get('account_type', ''),
+        'balance': data.get('balance', ''),
+        'notes': data.get('notes', '')
+    }
+
 @app.route('/api/generate-letter', methods=['POST'])
 @login_required
 def api_generate_letter():
@@ -801,15 +847,7 @@ def api_generate_letter():
         from ai_generator import generate_dispute_letter_ai
         
         data = request.get_json()
-        account_info = {
-            'bureau': data.get('bureau'),
-            'creditor_name': data.get('creditor_name'),
-            'account_number': data.get('account_number'),
-            'reason': data.get('reason'),
-            'account_type': data.get('account_type', ''),
-            'balance': data.get('balance', ''),
-            'notes': data.get('notes', '')
-        }
+        account_info = preview_account_info(data)
         
         # Check if OpenAI API key is configured
         if not os.getenv('OPENAI_API_KEY'):
@@ -831,6 +869,36 @@ def api_generate_letter():
             'error': str(e)
         }), 500
 
+@app.route('/api/generate-letter/stream', methods=['POST'])
+@login_required
+def api_generate_letter_stream():
+    """Stream the AI letter preview as Server-Sent Events while tokens arrive"""
+    from ai_generator import stream_dispute_letter_ai
+
+    account_info = preview_account_info(request.get_json() or {})
+
+    # Check if OpenAI API key is configured
+    if not os.getenv('OPENAI_API_KEY'):
+        return jsonify({
+            'success': False,
+            'error': 'OpenAI API key not configured. Please add OPENAI_API_KEY to your .env file.'
+        }), 400
+
+    def events():
+        letter_events = stream_dispute_letter_ai(account_info)
+        try:
+            for event, value in letter_events:
+                key = {'token': 'text', 'done': 'provider'}.get(event, 'error')
+                yield f"event: {event}\ndata: {json.dumps({key: value})}\n\n"
+        finally:
+            letter_events.close()  # Client disconnected -> abort the in-flight LLM request
+
+    return Response(
+        stream_with_context(events()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}  # No proxy buffering
+    )
+
 @app.route('/preview-letter/<int:account_id>')
 @login_required
 def preview_letter(account_id):
@@ -862,8 +930,10 @@ def send_batch():
 @app.route('/generate-batch', methods=['POST'])
 @login_required
 def generate_batch():
-    """Generate PDFs for selected disputes"""
-    from generator import render_letter, generate_pdf
+    """Generate letters for selected disputes (PDFs are rendered when downloaded or sent)"""
+    from generator import render_letters, account_info_from_dispute, letter_inputs_hash
+    from pregenerator import is_pregenerated
+    from db import save_dispute_letter
     
     user_id = session.get('user_id')
     
@@ -887,72 +957,69 @@ def generate_batch():
     generated_count = 0
     skipped_count = 0
     
+    # Work out which disputes still need a letter
+    to_generate = []
     for dispute in disputes:
+        # Prepare account info - handle None values from LEFT JOIN
+        account_info = account_info_from_dispute(dispute)
+        inputs_hash = letter_inputs_hash(account_info)
+        
+        # Check if the letter already exists (cached or pre-generated) and is still current
+        if is_pregenerated(dispute, inputs_hash):
+            print(f"✓ Skipping {dispute['account_number']} - letter already exists")
+            skipped_count += 1
+            continue
+        to_generate.append((dispute, account_info, inputs_hash))
+    
+    # Generate letters with AI (several accounts per LLM request)
+    print(f"🤖 Generating {len(to_generate)} letter(s)...")
+    sources = []
+    try:
+        letters = render_letters([info for _, info, _ in to_generate], use_ai=True, sources_out=sources)
+    except Exception as e:
+        flash(f'❌ Error generating letters: {str(e)}', 'danger')
+        letters = []
+    
+    for (dispute, account_info, inputs_hash), letter_text, source in zip(to_generate, letters, sources):
         try:
-            # Check if PDF already exists (cached)
-            if dispute.get('pdf_path') and Path(dispute['pdf_path']).exists():
-                print(f"✓ Skipping {dispute['account_number']} - PDF already exists")
-                skipped_count += 1
-                continue
-            
-            # Prepare account info - handle None values from LEFT JOIN
-            account_info = {
-                'bureau': dispute['bureau'],
-                'creditor_name': dispute['creditor_name'] or 'Unknown',
-                'account_number': dispute['account_number'],
-                'reason': dispute['description'],
-                'account_type': dispute['account_type'] if dispute['account_type'] else '',
-                'balance': dispute['balance'] if dispute['balance'] else '',
-                'notes': dispute['notes'] if dispute['notes'] else ''
-            }
-            
-            # Generate letter with AI
-            print(f"🤖 Generating letter for {dispute['account_number']}...")
-            letter_text = render_letter(account_info, use_ai=True)
-            
-            # Generate PDF
-            bureau_dir = Path(f"disputes/generated/{dispute['bureau'].lower()}")
-            bureau_dir.mkdir(parents=True, exist_ok=True)
-            pdf_path = bureau_dir / f"{dispute['account_number']}.pdf"
-            generate_pdf(letter_text, pdf_path)
-            
-            # Save PDF path to database
-            from db import update_dispute_pdf_path
-            update_dispute_pdf_path(dispute['id'], pdf_path)
-            
+            # Save the letter text to the database
+            save_dispute_letter(dispute['id'], letter_text, inputs_hash,
+                                source.get('model'), source.get('prompt_version'))
             generated_count += 1
             
         except Exception as e:
-            flash(f'❌ Error generating PDF for {dispute["account_number"]}: {str(e)}', 'danger')
+            flash(f'❌ Error saving letter for {dispute["account_number"]}: {str(e)}', 'danger')
     
     if skipped_count > 0:
         flash(f'ℹ️ Skipped {skipped_count} letter(s) - already generated', 'info')
     
     if generated_count > 0:
-        flash(f'✅ Generated {generated_count} new PDF letter(s)! Review them before sending.', 'success')
+        flash(f'✅ Generated {generated_count} new letter(s)! Review them before sending.', 'success')
     
     return redirect(url_for('review_batch'))
 
 @app.route('/review-batch', methods=['GET'])
 @login_required
 def review_batch():
-    """Review generated PDFs before sending to Lob"""
+    """Review generated letters before sending to Lob"""
     user_id = session.get('user_id')
     
-    # Get pending disputes with PDF paths from PostgreSQL
+    # Get pending disputes with their saved letters from PostgreSQL
     disputes = get_user_disputes(user_id, status='pending')
     
-    # Check which PDFs exist
+    # Disputes with a letter (saved text, or a PDF from before letter text was stored)
     disputes_with_pdfs = []
     for dispute in disputes:
         pdf_path = Path(f"disputes/generated/{dispute['bureau'].lower()}/{dispute['account_number']}.pdf")
-        if pdf_path.exists():
+        if dispute.get('letter_text') or pdf_path.exists():
             disputes_with_pdfs.append({
                 'id': dispute['id'],
                 'bureau': dispute['bureau'],
                 'creditor_name': dispute['creditor_name'],
                 'account_number': dispute['account_number'],
                 'description': dispute['description'],
+                'letter_model': dispute.get('letter_model'),
+                'has_text': bool(dispute.get('letter_text')),
                 'pdf_exists': True
             })
     
@@ -964,25 +1031,23 @@ def review_batch():
 @login_required
 def send_to_lob():
     """Actually send generated PDFs via Lob API (costs money!)"""
-    # Run the batch script which sends to Lob
-    result = subprocess.run(['python3', 'batch_processor.py'], 
-                          capture_output=True, 
-                          text=True,
-                          cwd=Path.cwd())
-    
-    if result.returncode == 0:
-        flash('✅ Letters sent via Lob! Check dashboard for tracking.', 'success')
-        return redirect(url_for('dashboard'))
-    else:
-        flash(f'❌ Send failed: {result.stderr}', 'danger')
-        return redirect(url_for('review_batch'))
+    from batch_processor import run_batch
+    
+    # Send this user's queue in the background (a double click joins the running job;
+    # disputes are claimed atomically, so overlapping runs never mail one twice)
+    user_id = session.get('user_id')
+    job = submit_job('send_batch', partial(run_batch, user_id=user_id, init_schema=False),
+                     user_id=user_id, exclusive=True)
+    flash(f'📬 Sending letters via Lob in the background (job {job["id"]}). '
+          'Check dashboard for tracking.', 'success')
+    return redirect(url_for('dashboard', job_id=job['id']))
 
 @app.route('/regenerate-with-premium-ai', methods=['POST'])
 @login_required
 def regenerate_with_premium_ai():
     """Regenerate a letter with GPT-4 and custom prompt"""
     from ai_generator import generate_dispute_letter_premium
-    from generator import generate_pdf
+    from db import save_dispute_letter
     
     dispute_id = request.form.get('dispute_id')
     tone = request.form.get('tone', 'professional')
@@ -1037,28 +1102,22 @@ def regenerate_with_premium_ai():
         }
         
         # Call premium AI generator
+        source = {}
         letter_content = generate_dispute_letter_premium(
             account_info, 
             personal_info,
-            custom_instructions
+            custom_instructions,
+            source_out=source
         )
         
         if not letter_content:
             flash('❌ Premium AI generation failed! Please try again.', 'danger')
             return redirect(url_for('review_batch'))
         
-        # Generate new PDF with premium content
-        pdf_output_dir = Path(f'disputes/generated/{dispute["bureau"].lower()}')
-        pdf_output_dir.mkdir(parents=True, exist_ok=True)
-        
-        # Use _premium suffix to distinguish from free version
-        pdf_filename = f"{dispute['account_number']}_premium.pdf"
-        pdf_path = pdf_output_dir / pdf_filename
-        
-        generate_pdf(letter_content, pdf_path)
-        
-        # Update database with new premium PDF path
-        update_dispute_pdf_path(dispute_id, str(pdf_path))
+        # Replace the saved letter (no inputs hash: a premium letter is kept even if the
+        # account details change; its PDF is rendered on the next download/send)
+        save_dispute_letter(dispute_id, letter_content, None,
+                            source.get('model'), source.get('prompt_version'))
         
         flash('✅ Letter regenerated with Premium AI (GPT-4)!', 'success')
         
@@ -1071,17 +1130,42 @@ def regenerate_with_premium_ai():
 @login_required
 def check_status():
     """Check delivery status"""
-    result = subprocess.run(['python3', 'batch_processor.py', '--check-status'], 
-                          capture_output=True, 
-                          text=True,
-                          cwd=Path.cwd())
-    
-    if result.returncode == 0:
-        flash('✅ Status check complete!', 'success')
-    else:
-        flash(f'❌ Status check failed: {result.stderr}', 'warning')
+    from tracker import check_lob_status
+    
+    job = submit_job('check_status', check_lob_status, user_id=session.get('user_id'), exclusive=True)
+    flash(f'📡 Checking delivery statuses in the background (job {job["id"]}).', 'info')
+    return redirect(url_for('dashboard', job_id=job['id']))
+
+@app.route('/webhooks/lob', methods=['POST'])
+def lob_webhook():
+    """Lob letter tracking events (signed); applied to disputes in the background"""
+    from lob_webhooks import LOB_WEBHOOK_SECRET, verify_signature, ingest_events, schedule_apply
+    
+    if not LOB_WEBHOOK_SECRET:
+        return jsonify({'error': 'Lob webhooks not configured'}), 503
+    body = request.get_data()
+    if not verify_signature(body, request.headers.get('Lob-Signature-Timestamp'),
+                            request.headers.get('Lob-Signature')):
+        return jsonify({'error': 'Invalid signature'}), 401
+    try:
+        event = json.loads(body)
+    except ValueError:
+        return jsonify({'error': 'Invalid JSON'}), 400
     
-    return redirect(url_for('dashboard'))
+    # A storage failure returns 500 so Lob delivers the event again
+    new = ingest_events([event])
+    if new:
+        schedule_apply()
+    return jsonify({'received': True, 'new': new})
+
+@app.route('/jobs/<job_id>')
+@login_required
+def job_status(job_id):
+    """Status of a background job started by this user (JSON)"""
+    job = get_job(job_id)
+    if not job or (job['user_id'] != session.get('user_id') and session.get('role') != 'admin'):
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job_json(job))
 
 @app.route('/settings', methods=['GET', 'POST'])
 @login_required
@@ -1145,16 +1229,46 @@ def download_pdf(dispute_id):
     dispute = next((d for d in disputes if d['id'] == dispute_id), None)
     
     if dispute:
+        download_name = f"{dispute['bureau']}_{dispute['account_number']}.pdf"
+        # Rendered from the saved letter text (or still queued for writing after a send)
+        from generator import dispute_pdf
+        from pdf_store import pending_pdf
+        pdf_bytes = dispute_pdf(dispute) or pending_pdf(
+            Path("disputes/generated") / dispute['bureau'].lower() / f"{dispute['account_number']}.pdf")
+        if pdf_bytes is not None:
+            return send_file(io.BytesIO(pdf_bytes),
+                           as_attachment=True,
+                           download_name=download_name,
+                           mimetype='application/pdf')
+        
         pdf_path = get_pdf_path(dispute['account_number'], dispute['bureau'])
         if pdf_path:
             return send_file(pdf_path, 
                            as_attachment=True,
-                           download_name=f"{dispute['bureau']}_{dispute['account_number']}.pdf",
+                           download_name=download_name,
                            mimetype='application/pdf')
     
     flash('PDF not found.', 'warning')
     return redirect(url_for('dashboard'))
 
+@app.route('/letter/<int:dispute_id>/preview')
+@login_required
+def letter_preview(dispute_id):
+    """HTML preview of a dispute's saved letter (no PDF rendering)"""
+    user_id = session.get('user_id')
+    disputes = get_user_disputes(user_id)
+    dispute = next((d for d in disputes if d['id'] == dispute_id), None)
+    
+    if not dispute or not dispute.get('letter_text'):
+        flash('Letter not found.', 'warning')
+        return redirect(url_for('review_batch'))
+    
+    paragraphs = [p for p in dispute['letter_text'].split('\n\n') if p.strip()]
+    return render_template('letter_text_preview.html',
+                         dispute=dispute,
+                         paragraphs=paragraphs,
+                         username=session.get('username'))
+
 @app.route('/admin/users', methods=['GET', 'POST'])
 @admin_required
 def admin_users():
@@ -1490,6 +1604,16 @@ def api_pending_responses():
         'pending_responses': results
     })
 
+@app.route('/api/metrics', methods=['GET'])
+def api_metrics():
+    """Operational metrics (circuit breakers, provider latency, pipeline counters)"""
+    api_key = request.headers.get('X-API-Key')
+    if api_key != os.getenv('FLASK_SECRET_KEY'):
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    import metrics
+    return jsonify(metrics.snapshot())
+
 @app.route('/api/send-reminder', methods=['POST'])
 @login_required
 def api_send_reminder():
@@ -1532,7 +1656,7 @@ def api_send_reminder():
         return jsonify({'error': 'n8n webhook not configured'}), 500
     
     try:
-        response = requests.post(
+        response = get_session().post(
             n8n_url,
             json={
                 'type': 'manual_reminder',
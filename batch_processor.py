@@ -1,103 +1,694 @@
+import os
 import sys
+import socket
+import threading
+from concurrent.futures import Future, wait
 from pathlib import Path
-from generator import render_letter, generate_pdf
-from mailer import send_letter
-from db import init_db, get_db_connection
-from tracker import check_lob_status
+from dotenv import load_dotenv
+from generator import render_letters, account_info_from_dispute, letter_inputs_hash
+from pregenerator import stored_letter
+from pdf_pool import submit_pdf, PDF_RENDER_WORKERS
+from pdf_store import persist_pdf, flush as flush_pdfs
+from psycopg2.extras import execute_values
+from lob_sender import send_with_retries, LOB_SEND_CONCURRENCY
+from lob_templates import LOB_SEND_MODE, template_letter, ensure_template
+from ai_generator import BATCH_SIZE as LLM_BATCH_SIZE
+from pipeline import Pipeline, Stage
+from checkpoints import (load_checkpoints, resume_point, save_checkpoints, idempotency_key,
+                         mailing_idempotency_key, pdf_hash)
+from db import init_db, get_db_connection, save_dispute_letter
+from tracker import check_lob_status, next_check_time
 
-def get_pending_disputes():
-    """Get all pending disputes from database across all users"""
+load_dotenv()
+
+BATCH_CHUNK_SIZE = int(os.getenv("BATCH_CHUNK_SIZE", "50"))  # Disputes claimed per round
+BATCH_CLAIM_TIMEOUT_MINUTES = int(os.getenv("BATCH_CLAIM_TIMEOUT_MINUTES", "30"))
+# Pipeline stages (see send_disputes): workers per stage and the bounded queue in front of each
+BATCH_GENERATE_WORKERS = int(os.getenv("BATCH_GENERATE_WORKERS", "2"))  # Concurrent LLM batches
+BATCH_RENDER_WORKERS = int(os.getenv("BATCH_RENDER_WORKERS", "0")) or PDF_RENDER_WORKERS
+BATCH_SUBMIT_WORKERS = int(os.getenv("BATCH_SUBMIT_WORKERS", "0")) or LOB_SEND_CONCURRENCY
+BATCH_RECORD_SIZE = int(os.getenv("BATCH_RECORD_SIZE", "25"))  # Outcomes per DB transaction
+BATCH_RECORD_LINGER = float(os.getenv("BATCH_RECORD_LINGER", "1.0"))  # Seconds to fill a DB batch
+BATCH_QUEUE_SIZE = int(os.getenv("BATCH_QUEUE_SIZE", "32"))
+# One Lob letter per user and bureau instead of per dispute (see _consolidate_stage)
+BATCH_CONSOLIDATE = os.getenv("BATCH_CONSOLIDATE", "0") == "1"
+BATCH_CONSOLIDATE_MAX = int(os.getenv("BATCH_CONSOLIDATE_MAX", "6"))  # Sections per envelope
+BATCH_CONSOLIDATE_LINGER = float(os.getenv("BATCH_CONSOLIDATE_LINGER", "2.0"))  # Seconds to gather a group
+# Consolidating: claim each user's disputes to the same bureau together
+_CLAIM_ORDER = "user_id, bureau, id" if BATCH_CONSOLIDATE else "id"
+# host:pid by default; set BATCH_WORKER_ID to a stable name (e.g. per container) so a
+# restarted worker recognizes its own claims on --resume
+WORKER_ID = os.getenv("BATCH_WORKER_ID") or f"{socket.gethostname()}:{os.getpid()}"
+
+# Template mode: local PDF copies of letters Lob rendered, still being made (see _keep_copy)
+_copies = []
+_copies_lock = threading.Lock()
+
+def claim_pending_disputes(limit, user_id=None, skip_ids=()):
+    """
+    Atomically claim up to limit pending disputes (optionally one user's) for this worker:
+    status 'pending' -> 'sending'. Rows another run has locked are skipped, so parallel
+    runs on several processes/nodes never get the same dispute; so are skip_ids (the
+    ones this run already handed back).
+    """
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute(f"""
+        WITH claimed AS (
+            SELECT id FROM disputes
+            WHERE status = 'pending' AND (%(user_id)s::integer IS NULL OR user_id = %(user_id)s)
+              AND NOT (id = ANY(%(skip_ids)s::integer[]))
+            ORDER BY {_CLAIM_ORDER}
+            LIMIT %(limit)s
+            FOR UPDATE SKIP LOCKED
+        )
+        UPDATE disputes AS d
+        SET status = 'sending', claimed_at = CURRENT_TIMESTAMP, claimed_by = %(worker)s
+        FROM claimed
+        WHERE d.id = claimed.id
+        RETURNING d.id
+    """, {'user_id': user_id, 'limit': limit, 'worker': WORKER_ID, 'skip_ids': list(skip_ids)})
+    ids = [row['id'] for row in cur.fetchall()]
+    conn.commit()
+
+    disputes = _dispute_rows(cur, ids)
+    cur.close()
+    conn.close()
+    return disputes
+
+def claim_disputes(dispute_ids):
+    """Claim these disputes for this worker if they're pending (or already ours); returns their rows"""
     conn = get_db_connection()
     cur = conn.cursor()
     cur.execute("""
-        SELECT d.*, ua.creditor_name, ua.account_type, ua.balance, ua.notes
-        FROM disputes d
-        LEFT JOIN user_accounts ua ON d.account_id = ua.id
-        WHERE d.status = 'pending'
-        ORDER BY d.sent_date
-    """)
-    disputes = cur.fetchall()
+        UPDATE disputes SET status = 'sending', claimed_at = CURRENT_TIMESTAMP, claimed_by = %(worker)s
+        WHERE id = ANY(%(ids)s) AND (status = 'pending' OR (status = 'sending' AND claimed_by = %(worker)s))
+        RETURNING id
+    """, {'ids': list(dispute_ids), 'worker': WORKER_ID})
+    ids = [row['id'] for row in cur.fetchall()]
+    conn.commit()
+    disputes = _dispute_rows(cur, ids)
     cur.close()
     conn.close()
     return disputes
 
-def update_dispute_status(dispute_id, tracking_id, status):
-    """Update dispute with tracking ID and status"""
-    from datetime import datetime
+def _dispute_rows(cur, ids):
+    """Claimed disputes with their account details"""
+    disputes = []
+    if ids:
+        # Same join as get_user_disputes / get_dispute_for_generation, so the letter inputs
+        # (and letter_inputs_hash) match the letter the user reviewed or pre-generated;
+        # one row per dispute even if several accounts match
+        cur.execute("""
+            SELECT DISTINCT ON (d.id)
+                d.*, ua.account_type, ua.balance, ua.notes, ua.reason
+            FROM disputes d
+            LEFT JOIN user_accounts ua
+                ON d.account_number = ua.account_number
+                AND d.bureau = ua.bureau
+                AND d.user_id = ua.user_id
+            WHERE d.id = ANY(%s)
+            ORDER BY d.id
+        """, (ids,))
+        disputes = cur.fetchall()
+    return disputes
+
+def release_claims(dispute_ids):
+    """Hand claimed disputes that weren't mailed back to the queue"""
+    if not dispute_ids:
+        return
     conn = get_db_connection()
     cur = conn.cursor()
-    
     cur.execute("""
-        UPDATE disputes 
-        SET tracking_id = %s, status = %s, sent_date = %s
-        WHERE id = %s
-    """, (tracking_id, status, datetime.utcnow().isoformat(), dispute_id))
-    
-    # Log to history
+        UPDATE disputes SET status = 'pending', claimed_at = NULL, claimed_by = NULL
+        WHERE id = ANY(%s) AND status = 'sending'
+    """, (list(dispute_ids),))
+    conn.commit()
+    cur.close()
+    conn.close()
+
+class ReleasedDisputes:
+    """
+    Disputes a run handed back to pending (failed before reaching Lob). The same run
+    doesn't claim them again - a failure that keeps happening would otherwise have it
+    claim and release them forever; the next run retries them.
+    """
+
+    def __init__(self):
+        self._ids = set()
+        self._lock = threading.Lock()
+
+    def release(self, dispute_ids):
+        dispute_ids = list(dispute_ids)
+        with self._lock:
+            self._ids.update(dispute_ids)
+        release_claims(dispute_ids)
+
+    def ids(self):
+        with self._lock:
+            return list(self._ids)
+
+class ResumedMailings:
+    """
+    Mailings a crashed run was submitting, rebuilt once per run: the first of their
+    disputes to arrive brings in the others (see _resume_mailing)
+    """
+
+    def __init__(self):
+        self.members = {}  # idempotency key -> dispute ids rebuilt into it (() if it couldn't be)
+        self.lock = threading.Lock()
+
+def release_stale_claims(timeout_minutes=BATCH_CLAIM_TIMEOUT_MINUTES):
+    """Return disputes claimed by a run that died (claim older than the timeout) to the queue"""
+    conn = get_db_connection()
+    cur = conn.cursor()
     cur.execute("""
+        UPDATE disputes SET status = 'pending', claimed_at = NULL, claimed_by = NULL
+        WHERE status = 'sending' AND claimed_at < CURRENT_TIMESTAMP - %s * INTERVAL '1 minute'
+        RETURNING id
+    """, (timeout_minutes,))
+    released = cur.rowcount
+    conn.commit()
+    cur.close()
+    conn.close()
+    if released:
+        print(f"♻️  Released {released} stale claim(s)")
+    return released
+
+def _claim_holder_gone(worker_id):
+    """
+    True if the process holding a claim is known to be gone: an earlier run under our
+    own id (this run hasn't claimed anything yet), or a process on this host that's no
+    longer running. Workers on other hosts can't be checked, so they count as alive.
+    """
+    if worker_id == WORKER_ID:
+        return True
+    host, _, pid = worker_id.rpartition(":")
+    if host != socket.gethostname() or not pid.isdigit():
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:
+        pass
+    return False
+
+def release_dead_claims():
+    """
+    Restarting after a crash: return the crashed run's claims to the queue now instead
+    of waiting for the timeout. Claims held by live workers (parallel runs) are left alone.
+    """
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute("SELECT DISTINCT claimed_by FROM disputes WHERE status = 'sending' AND claimed_by IS NOT NULL")
+    dead = [row['claimed_by'] for row in cur.fetchall() if _claim_holder_gone(row['claimed_by'])]
+    released = 0
+    if dead:
+        cur.execute("""
+            UPDATE disputes SET status = 'pending', claimed_at = NULL, claimed_by = NULL
+            WHERE status = 'sending' AND claimed_by = ANY(%s)
+        """, (dead,))
+        released = cur.rowcount
+    conn.commit()
+    cur.close()
+    conn.close()
+    if released:
+        print(f"♻️  Released {released} claim(s) of crashed run(s): {', '.join(dead)}")
+    return released
+
+def update_dispute_statuses(updates):
+    """
+    Record send outcomes in one transaction: updates are (dispute_id, tracking_id, status,
+    pdf_path) tuples (pdf_path None = keep the current one)
+    """
+    from datetime import datetime
+    if not updates:
+        return
+    sent_at = datetime.utcnow()
+    sent_date = sent_at.isoformat()
+    conn = get_db_connection()
+    cur = conn.cursor()
+
+    execute_values(cur, """
+        UPDATE disputes AS d
+        SET tracking_id = v.tracking_id, status = v.status, sent_date = v.sent_date,
+            pdf_path = COALESCE(v.pdf_path, d.pdf_path), next_check_at = v.next_check_at
+        FROM (VALUES %s) AS v (id, tracking_id, status, pdf_path, sent_date, next_check_at)
+        WHERE d.id = v.id
+    """, [(dispute_id, tracking_id, status, str(pdf_path) if pdf_path else None, sent_date,
+           next_check_time(status, sent_at, sent_at))
+          for dispute_id, tracking_id, status, pdf_path in updates],
+        template="(%s::integer, %s, %s, %s, %s::timestamp, %s::timestamp)")
+
+    # Log to history
+    execute_values(cur, """
         INSERT INTO dispute_history (dispute_id, action, new_status, notes)
-        VALUES (%s, %s, %s, %s)
-    """, (dispute_id, 'sent', status, f'Letter sent via Lob (tracking: {tracking_id})'))
-    
+        VALUES %s
+    """, [(dispute_id, 'sent', status, f'Letter sent via Lob (tracking: {tracking_id})')
+          for dispute_id, tracking_id, status, _ in updates])
+
     conn.commit()
     cur.close()
     conn.close()
 
-def run_batch():
-    print("🚀 Starting dispute batch...")
-    init_db()
+def run_batch(user_id=None, chunk_size=BATCH_CHUNK_SIZE, init_schema=True):
+    """
+    Generate, render and mail pending disputes (all users, or one user's) until the
+    queue is empty, claiming chunk_size at a time as the pipeline has room; returns counts
+    plus the per-stage pipeline report. Raises (after the run) if outcomes of letters sent
+    to Lob couldn't be recorded.
+    init_schema=False when called from the web app (which initializes the DB at startup).
+    """
+    print(f"🚀 Starting dispute batch ({'user ' + str(user_id) if user_id else 'all users'}, worker {WORKER_ID})...")
+    if init_schema:
+        init_db()
+    # The Lob template is registered once, before anything is claimed: if that fails,
+    # the run stops here instead of every mailing failing (and its disputes cycling)
+    try:
+        template_id = ensure_template() if LOB_SEND_MODE == "template" else None
+    except Exception as e:
+        print(f"❌ Lob template not available - batch not started, nothing claimed: {e}")
+        raise
+    release_stale_claims()
 
-    disputes = get_pending_disputes()
-    
-    if not disputes:
+    released = ReleasedDisputes()
+    totals = send_disputes(_claimed_disputes(user_id, chunk_size, released), released, template_id)
+    if not totals['disputes']:
         print("⚠️ No pending disputes found.")
-        return
-    
-    print(f"📋 Found {len(disputes)} pending dispute(s)")
+    _wait_for_copies()
+    flush_pdfs()  # Finish writing the on-disk copies before the script exits
+    if totals['unrecorded']:
+        # Their letters went out (or failed at Lob) but the disputes still say 'sending':
+        # the run must not look like a success. Checkpoints are kept, so the next run
+        # records them without mailing anything again.
+        message = (f"{totals['unrecorded']} dispute outcome(s) not recorded - left claimed with their "
+                   f"checkpoints; run again with --resume (or after {BATCH_CLAIM_TIMEOUT_MINUTES} min) to record them")
+        print(f"❌ Batch incomplete: {totals['sent']} sent, {totals['failed']} failed, {message}")
+        raise RuntimeError(message)
+    print(f"✅ Batch complete: {totals['sent']} sent, {totals['failed']} failed "
+          f"({totals['mailings']} letter(s) mailed, {totals['pages']} page(s), "
+          f"{totals['bytes_uploaded'] / 1024:.0f} KB uploaded, ~${totals['estimated_cost']:.2f}).")
+    return totals
+
+def _claimed_disputes(user_id, chunk_size, released):
+    """
+    Claim pending disputes a chunk at a time, only when the pipeline pulls for more
+    (never the ones this run released)
+    """
+    while True:
+        disputes = claim_pending_disputes(chunk_size, user_id, skip_ids=released.ids())
+        if not disputes:
+            return
+        print(f"📋 Claimed {len(disputes)} pending dispute(s)")
+        yield from disputes
+
+def send_disputes(disputes, released=None, template_id=None):
+    """
+    Stream disputes (any iterable, read lazily) through the mailing pipeline:
+    generate (LLM, in batches) -> [consolidate] -> render (PDF pool) -> submit (Lob) ->
+    record (batched DB writes). Each stage has its own workers and a bounded queue in
+    front of it. Returns counts and the per-stage report ('unrecorded': disputes whose
+    outcome couldn't be written, see _record_failed).
+
+    Items are mailings: one Lob letter for one dispute, or with BATCH_CONSOLIDATE for all
+    of a user's disputes to the same bureau that arrive together (one section each).
+    With LOB_SEND_MODE=template, render only builds merge variables for the Lob template
+    (template_id, registered before the first dispute is read if not given) and the
+    local PDF copy is made after the send.
+
+    Progress is checkpointed per dispute, so a dispute left behind by a crashed run picks
+    up where it stopped: mailed letters are only recorded, rendered PDFs are reused, and
+    a letter that may have reached Lob is re-sent as the same mailing (same disputes,
+    same idempotency key) - never regrouped.
+
+    Disputes that fail before reaching Lob go back to pending through released
+    (a ReleasedDisputes, so the claim loop can skip them).
+    """
+    released = released or ReleasedDisputes()
+    resumed = ResumedMailings()
+    if LOB_SEND_MODE == "template" and template_id is None:
+        template_id = ensure_template()
+    totals = {'disputes': 0, 'sent': 0, 'failed': 0, 'released': 0, 'unrecorded': 0,
+              'mailings': 0, 'pages': 0, 'bytes_uploaded': 0, 'estimated_cost': 0.0}
+    totals_lock = threading.Lock()
+
+    def record(mailings):
+        counts = _record_stage(mailings, released)
+        with totals_lock:
+            for key in counts:
+                totals[key] += counts[key]
+        return mailings
+
+    def not_recorded(mailings, error):
+        unrecorded = _record_failed(mailings, error, released)
+        with totals_lock:
+            totals['unrecorded'] += unrecorded
+        return []
+
+    def release(disputes, error):
+        _release_failed(disputes, 'generate', error, released)
+        with totals_lock:
+            totals['released'] += len(disputes)
+        return []
+
+    stages = [Stage("generate", lambda batch: _generate_stage(batch, resumed, released),
+                    workers=BATCH_GENERATE_WORKERS,
+                    batch_size=LLM_BATCH_SIZE, queue_size=BATCH_QUEUE_SIZE, on_error=release)]
+    if BATCH_CONSOLIDATE:
+        stages.append(Stage("consolidate", _consolidate_stage, batch_size=BATCH_CHUNK_SIZE,
+                            linger=BATCH_CONSOLIDATE_LINGER, queue_size=BATCH_QUEUE_SIZE))
+    stages += [
+        Stage("render", _render_stage, workers=BATCH_RENDER_WORKERS,
+              queue_size=BATCH_QUEUE_SIZE, on_error=_mark_failed('render')),
+        Stage("submit", lambda mailing: _submit_stage(mailing, template_id), workers=BATCH_SUBMIT_WORKERS,
+              queue_size=BATCH_QUEUE_SIZE, on_error=_mark_failed('submit')),
+        Stage("record", record, workers=1, batch_size=BATCH_RECORD_SIZE,
+              linger=BATCH_RECORD_LINGER, queue_size=BATCH_QUEUE_SIZE, on_error=not_recorded)
+    ]
+    totals['pipeline'] = Pipeline("batch_pipeline", stages).run(disputes)
+    totals['estimated_cost'] = round(totals['estimated_cost'], 2)
+    return totals
+
+def _mailing(sections):
+    """
+    One Lob letter for one or more sections (a dispute and its letter text, all for the
+    same user and bureau). A single-dispute mailing keeps the per-dispute key; its PDF
+    is kept under the dispute's id (the account-number path is shared with other users
+    and with /generate-batch, so it may hold another letter by the time it's reused).
+    """
+    first = sections[0]['dispute']
+    bureau = first['bureau']
+    if len(sections) == 1:
+        letter_text = sections[0]['letter_text']
+        key = idempotency_key(first['id'], letter_text)
+        pdf_path = Path(f"disputes/generated/{bureau.lower()}/dispute-{first['id']}.pdf")
+        description = f"{bureau} dispute – {first['creditor_name']} ({first['account_number']})"
+    else:
+        key = mailing_idempotency_key([(section['dispute']['id'], section['letter_text'])
+                                       for section in sections])
+        pdf_path = Path(f"disputes/generated/{bureau.lower()}/{key}.pdf")
+        description = f"{bureau} disputes – {len(sections)} accounts (user {first['user_id']})"
+
+    dispute_ids = [section['dispute']['id'] for section in sections]
+    for section in sections:
+        section['checkpoint'].update(pdf_path=pdf_path, idempotency_key=key, mailing_dispute_ids=dispute_ids)
+    return {
+        'sections': sections,
+        'bureau': bureau,
+        'pdf_path': pdf_path,
+        'description': description,
+        'idempotency_key': key
+    }
+
+def _generate_stage(disputes, resumed, released):
+    """Letter text for a batch of disputes: saved letters reused, the rest generated and saved"""
+    checkpoints = load_checkpoints(dispute['id'] for dispute in disputes)
+
+    # Reuse letters already generated (and reviewed) for the same inputs
+    account_infos = [account_info_from_dispute(dispute) for dispute in disputes]
+    inputs_hashes = [letter_inputs_hash(info) for info in account_infos]
+    letters = [stored_letter(dispute, inputs_hash) for dispute, inputs_hash in zip(disputes, inputs_hashes)]
+    missing = [index for index, letter in enumerate(letters) if not letter]
 
-    for dispute in disputes:
+    # Generate the rest (AI in multi-account batches, or template) and save their text
+    sources = []
+    generated = render_letters([account_infos[i] for i in missing], use_ai=True, sources_out=sources)
+    for index, letter_text, source in zip(missing, generated, sources):
+        letters[index] = letter_text
+        save_dispute_letter(disputes[index]['id'], letter_text, inputs_hashes[index],
+                            source.get('model'), source.get('prompt_version'))
+    save_checkpoints('generated', [{'dispute_id': dispute['id'], 'letter_text': letter_text}
+                                   for dispute, letter_text in zip(disputes, letters)])
+
+    mailings = []
+    for dispute, letter_text in zip(disputes, letters):
+        section = {
+            'dispute': dispute,
+            'letter_text': letter_text,
+            'resume': resume_point(checkpoints.get(dispute['id']), letter_text),
+            'checkpoint': {'dispute_id': dispute['id'], 'letter_text': letter_text}
+        }
+        if section['resume'] and section['resume']['stage'] == 'submitting':
+            mailing = _resume_mailing(section, resumed, released)
+        else:
+            mailing = _mailing([section])
+        if mailing:
+            mailings.append(mailing)
+    return mailings
+
+def _resume_mailing(section, resumed, released):
+    """
+    The mailing a crashed run was submitting this dispute in, rebuilt exactly (same
+    disputes in the same order, same idempotency key) so Lob returns the letter if it
+    was created. Its other disputes are claimed here; when they later arrive on their
+    own they're skipped (None). If it can't be rebuilt, its disputes go back to pending.
+    """
+    key = section['resume']['idempotency_key']
+    member_ids = list(section['resume']['mailing_dispute_ids'] or [section['dispute']['id']])
+    own_id = section['dispute']['id']
+    with resumed.lock:
+        if key in resumed.members:
+            if own_id not in resumed.members[key]:
+                released.release([own_id])
+            return None
+
+        others = [dispute_id for dispute_id in member_ids if dispute_id != own_id]
+        claimed = {dispute['id']: dispute for dispute in claim_disputes(others)} if others else {}
+        checkpoints = load_checkpoints(others)
+        sections = []
+        for dispute_id in member_ids:
+            dispute = section['dispute'] if dispute_id == own_id else claimed.get(dispute_id)
+            letter_text = section['letter_text'] if dispute_id == own_id else (dispute or {}).get('letter_text')
+            resume = section['resume'] if dispute_id == own_id else \
+                resume_point(checkpoints.get(dispute_id), letter_text) if letter_text else None
+            if dispute is None or resume is None or resume['idempotency_key'] != key:
+                break
+            sections.append(section if dispute_id == own_id else {
+                'dispute': dispute, 'letter_text': letter_text, 'resume': resume,
+                'checkpoint': {'dispute_id': dispute_id, 'letter_text': letter_text}})
+
+        mailing = _mailing(sections) if len(sections) == len(member_ids) else None
+        if mailing is None or mailing['idempotency_key'] != key:
+            print(f"⚠️  Can't rebuild interrupted mailing {key} (disputes {member_ids}) - back to pending, not re-sent")
+            resumed.members[key] = ()
+            released.release([own_id, *claimed])
+            return None
+        resumed.members[key] = member_ids
+        mailing['resumed'] = True
+        print(f"🔁 Resuming interrupted mailing {key} ({len(member_ids)} dispute(s))")
+        return mailing
+
+def _consolidate_stage(mailings):
+    """
+    Merge the single-dispute mailings that arrived together into one per user and bureau
+    (at most BATCH_CONSOLIDATE_MAX sections each). Disputes a previous run already mailed
+    stay on their own, so they are only recorded, and mailings a crashed run was
+    submitting are re-sent exactly as they were.
+    """
+    groups = {}
+    merged = []
+    for mailing in mailings:
+        if _sent_tracking_id(mailing) or mailing.get('resumed'):
+            merged.append(mailing)
+            continue
+        dispute = mailing['sections'][0]['dispute']
+        groups.setdefault((dispute['user_id'], dispute['bureau'].lower()), []).extend(mailing['sections'])
+    for sections in groups.values():
+        for start in range(0, len(sections), BATCH_CONSOLIDATE_MAX):
+            merged.append(_mailing(sections[start:start + BATCH_CONSOLIDATE_MAX]))
+    if len(merged) < len(mailings):
+        print(f"🗂️  {len(mailings)} dispute letter(s) consolidated into {len(merged)} mailing(s)")
+    return merged
+
+def _sent_tracking_id(mailing):
+    """Tracking id if a previous run already mailed every section of this mailing together"""
+    tracking_ids = set()
+    for section in mailing['sections']:
+        resume = section['resume']
+        if not resume or resume['stage'] not in ('submitted', 'recorded') or not resume['tracking_id']:
+            return None
+        tracking_ids.add(resume['tracking_id'])
+    return tracking_ids.pop() if len(tracking_ids) == 1 else None
+
+def _render_stage(mailing):
+    """
+    The mailing's PDF bytes (from the render pool, or reused from a resumed run); in
+    template mode, its merge variables (PDF only if they're too large for a template)
+    """
+    if _sent_tracking_id(mailing):
+        return mailing  # Already mailed - nothing to render
+    if LOB_SEND_MODE == "template":
+        mailing['merge_variables'] = template_letter([section['letter_text'] for section in mailing['sections']])
+        if mailing['merge_variables'] is not None:
+            return mailing  # Lob renders it
+    pdf_path = str(mailing['pdf_path'])
+    saved = {section['resume'].get('pdf_sha256') if section['resume'] and section['resume']['stage'] in
+             ('rendered', 'submitting') and section['resume']['pdf_path'] == pdf_path else None
+             for section in mailing['sections']}
+    if len(saved) == 1 and None not in saved and Path(pdf_path).exists():
+        pdf = Path(pdf_path).read_bytes()
+        if pdf_hash(pdf) in saved:
+            for section in mailing['sections']:
+                section['checkpoint']['pdf_sha256'] = pdf_hash(pdf)
+            mailing['pdf'] = pdf
+            return mailing
+        # Rewritten since it was rendered for this letter - render again
+        print(f"⚠️  {pdf_path} changed since it was rendered, rendering {mailing['description']} again")
+
+    texts = [section['letter_text'] for section in mailing['sections']]
+    mailing['pdf'] = submit_pdf(texts[0] if len(texts) == 1 else texts).result()
+    sha = pdf_hash(mailing['pdf'])
+    for section in mailing['sections']:
+        section['checkpoint']['pdf_sha256'] = sha
+    # Keep a copy on disk in the background, then checkpoint it as rendered
+    write = persist_pdf(mailing['pdf'], mailing['pdf_path'])
+    write.add_done_callback(lambda w, sections=mailing['sections']: w.exception() is None and w.result()
+                            and _checkpoint('rendered', [section['checkpoint'] for section in sections]))
+    return mailing
+
+def _submit_stage(mailing, template_id=None):
+    """Send to Lob (rate limited, retried, idempotent); checkpointed as soon as it's accepted"""
+    if mailing.get('error'):
+        return mailing  # Failed in an earlier stage - recorded (and handed back) as it is
+    tracking_id = _sent_tracking_id(mailing)
+    if tracking_id:
+        # Mailed before the previous run stopped - just record it
+        print(f"⏩ Already sent: {mailing['description']} | Tracking: {tracking_id}")
+        mailing.update(tracking_id=tracking_id, error=None,
+                       pdf_path=mailing['sections'][0]['resume']['pdf_path'])
+        return mailing
+
+    # Fix what this letter carries before it can reach Lob, so a resumed run re-sends
+    # the same mailing under the same key (raises, and so doesn't send, if not saved)
+    save_checkpoints('submitting', [section['checkpoint'] for section in mailing['sections']])
+
+    merge_variables = mailing.get('merge_variables')
+    if merge_variables is None:
+        template_id = None  # Sent as a PDF (too large for the template, or pdf mode)
+    mailing.update(send_with_retries(mailing.pop('pdf', None), mailing['bureau'], mailing['description'],
+                                     idempotency_key=mailing['idempotency_key'],
+                                     template_id=template_id, merge_variables=merge_variables))
+    if mailing['tracking_id']:
+        _checkpoint('submitted', [{**section['checkpoint'], 'tracking_id': mailing['tracking_id']}
+                                  for section in mailing['sections']])
+        if template_id:
+            _keep_copy(mailing)
+    return mailing
+
+def _keep_copy(mailing):
+    """Render and save the local PDF copy of a template letter in the background"""
+    copied = Future()
+    with _copies_lock:
+        _copies.append(copied)
+
+    def persist(rendered):
         try:
-            # Prepare account info for letter generation
-            account_info = {
-                'bureau': dispute['bureau'],
-                'creditor_name': dispute['creditor_name'],
-                'account_number': dispute['account_number'],
-                'reason': dispute['description'],
-                'account_type': dispute.get('account_type', ''),
-                'balance': dispute.get('balance', ''),
-                'notes': dispute.get('notes', '')
-            }
-            
-            # Generate letter content (AI or template)
-            letter_text = render_letter(account_info, use_ai=True)
-            
-            # Generate PDF
-            bureau_dir = Path(f"disputes/generated/{dispute['bureau'].lower()}")
-            bureau_dir.mkdir(parents=True, exist_ok=True)
-            pdf_path = bureau_dir / f"{dispute['account_number']}.pdf"
-            generate_pdf(letter_text, pdf_path)
-            
-            print(f"📄 Generated PDF: {pdf_path}")
-            
-            # Send via Lob
-            desc = f"{dispute['bureau']} dispute – {dispute['creditor_name']} ({dispute['account_number']})"
-            tracking_id = send_letter(pdf_path, dispute['bureau'], desc)
-            
-            if tracking_id:
-                update_dispute_status(dispute['id'], tracking_id, 'sent')
-                print(f"✅ Sent: {desc} | Tracking: {tracking_id}")
-            else:
-                update_dispute_status(dispute['id'], 'N/A', 'failed')
-                print(f"❌ Failed: {desc}")
-                
+            persist_pdf(rendered.result(), mailing['pdf_path'])
         except Exception as e:
-            print(f"❌ Error processing dispute {dispute['id']}: {e}")
-            update_dispute_status(dispute['id'], 'N/A', 'failed')
+            print(f"⚠️  Local copy of {mailing['description']} not saved: {e}")
+        finally:
+            copied.set_result(None)
+
+    texts = [section['letter_text'] for section in mailing['sections']]
+    submit_pdf(texts[0] if len(texts) == 1 else texts).add_done_callback(persist)
+
+def _wait_for_copies():
+    """Wait for local copies still being rendered (before the batch script exits)"""
+    with _copies_lock:
+        pending = list(_copies)
+        _copies.clear()
+    wait(pending)
+
+def _record_stage(mailings, released):
+    """
+    Write a batch of outcomes in one transaction, for every dispute in each mailing: sent
+    (all sharing the mailing's tracking id) or failed at Lob; disputes that failed before
+    reaching Lob go back to pending for the next run
+    """
+    updates = []
+    handed_back = []
+    counts = {'mailings': 0, 'pages': 0, 'bytes_uploaded': 0, 'estimated_cost': 0.0}
+    for mailing in mailings:
+        dispute_ids = [section['dispute']['id'] for section in mailing['sections']]
+        if mailing.get('tracking_id'):
+            print(f"✅ Sent: {mailing['description']} | Tracking: {mailing['tracking_id']}")
+            updates += [(dispute_id, mailing['tracking_id'], 'sent', mailing['pdf_path'])
+                        for dispute_id in dispute_ids]
+            if mailing.get('attempts'):  # Mailed by this run (not recorded after a resume)
+                counts['mailings'] += 1
+                counts['pages'] += mailing.get('pages', 0)
+                counts['bytes_uploaded'] += mailing.get('bytes', 0)
+                counts['estimated_cost'] += mailing.get('cost', 0.0)
+        elif mailing.get('attempts'):
+            print(f"❌ Failed: {mailing['description']} ({mailing['error']})")
+            updates += [(dispute_id, 'N/A', 'failed', None) for dispute_id in dispute_ids]
+        else:
+            print(f"↩️  Not sent, back to pending: {mailing['description']} ({mailing.get('error')})")
+            handed_back += dispute_ids
+    update_dispute_statuses(updates)
+    released.release(handed_back)
+    save_checkpoints('recorded', [{**section['checkpoint'], 'tracking_id': mailing['tracking_id']}
+                                  for mailing in mailings if mailing.get('tracking_id')
+                                  for section in mailing['sections']])
+
+    sent = sum(1 for _, _, status, _ in updates if status == 'sent')
+    return {'disputes': len(updates) + len(handed_back), 'sent': sent, 'failed': len(updates) - sent,
+            'released': len(handed_back), **counts}
+
+def _mark_failed(stage):
+    """on_error for per-mailing stages: pass the mailing on with its error so it's recorded"""
+    def on_error(mailings, error):
+        for mailing in mailings:
+            mailing['error'] = f"{stage}: {error}"
+        return mailings
+    return on_error
+
+def _record_failed(mailings, error, released):
+    """
+    on_error for the record stage: the outcomes couldn't be written. Disputes that went to
+    Lob stay claimed ('sending') with their checkpoints, so the next run records them
+    without re-sending (a 'submitted' letter is only recorded, a 'submitting' one gets
+    the same letter back from Lob); ones that never reached Lob are still handed back.
+    Returns how many were left unrecorded.
+    """
+    unsent = [section['dispute']['id'] for mailing in mailings
+              if not mailing.get('tracking_id') and not mailing.get('attempts') for section in mailing['sections']]
+    unrecorded = sum(len(mailing['sections']) for mailing in mailings) - len(unsent)
+    print(f"❌ {unrecorded} dispute outcome(s) not recorded, left for the next run: {error}")
+    try:
+        released.release(unsent)
+    except Exception as e:
+        print(f"⚠️  {len(unsent)} unsent dispute(s) not handed back (released when their claim times out): {e}")
+    return unrecorded
+
+def _release_failed(disputes, stage, error, released):
+    """on_error for the generate stage: nothing was made, so hand the disputes back"""
+    print(f"↩️  {len(disputes)} dispute(s) back to pending after {stage} error: {error}")
+    released.release(dispute['id'] for dispute in disputes)
+
+def _checkpoint(stage, entries):
+    """Save checkpoints from a worker thread (never fails the send)"""
+    try:
+        save_checkpoints(stage, entries)
+    except Exception as e:
+        print(f"⚠️  Checkpoint '{stage}' for dispute(s) {[entry['dispute_id'] for entry in entries]} not saved: {e}")
 
-    print("✅ Batch complete.")
+def _arg(name, default=None):
+    """Value after a --name flag on the command line"""
+    if name in sys.argv and sys.argv.index(name) + 1 < len(sys.argv):
+        return sys.argv[sys.argv.index(name) + 1]
+    return default
 
 if __name__ == "__main__":
     if "--check-status" in sys.argv:
         check_lob_status()
     else:
-        run_batch()
+        # Several of these can run at once (processes or nodes) - each claims its own disputes
+        if "--resume" in sys.argv:
+            # Restarting after a crash: take back its claims now instead of waiting for the
+            # timeout (re-sends reuse their idempotency keys, so nothing is mailed twice)
+            release_dead_claims()
+        user_id = _arg("--user-id")
+        run_batch(user_id=int(user_id) if user_id else None,
+                  chunk_size=int(_arg("--chunk-size", BATCH_CHUNK_SIZE)))
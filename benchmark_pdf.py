@@ -0,0 +1,78 @@
+"""
+Per-letter PDF render benchmark
+Compares the original generate_pdf (stylesheet + styles rebuilt per letter) with the
+reusable pdf_engine layout.
+
+Usage: python benchmark_pdf.py [letters]
+"""
+
+import io
+import sys
+import time
+from datetime import date
+
+from reportlab.lib.pagesizes import LETTER
+from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer
+from reportlab.lib.units import inch
+
+import metrics
+from pdf_engine import get_pdf_engine
+
+SAMPLE_LETTER = f"""{date.today().strftime("%B %d, %Y")}
+
+Experian
+P.O. Box 4500
+Allen, TX 75013
+
+Dear Sir or Madam:
+
+I am writing to dispute inaccurate information in my credit file. The account listed below is being reported incorrectly, and I am requesting an investigation under the Fair Credit Reporting Act (FCRA).
+
+Creditor: Capital One
+Account Number: 1234
+Dispute Reason: Not my account
+
+I have never opened, authorized or used this account. Please verify the account holder information with the furnisher and remove this account from my credit file if it cannot be verified.
+
+Please conduct a reasonable investigation within 30 days and send me written confirmation of the results, including a description of the procedure used to verify the information.
+
+Thank you for your prompt attention to this matter.
+
+Sincerely,"""
+
+def legacy_generate_pdf(text, out):
+    """generate_pdf as it was before pdf_engine (baseline)"""
+    doc = SimpleDocTemplate(out, pagesize=LETTER,
+                            rightMargin=72, leftMargin=72,
+                            topMargin=72, bottomMargin=18)
+    styles = getSampleStyleSheet()
+    normal_style = ParagraphStyle(
+        'CustomNormal',
+        parent=styles['Normal'],
+        fontSize=11,
+        leading=14,
+        spaceAfter=6
+    )
+    story = []
+    for para in text.split('\n\n'):
+        if para.strip():
+            story.append(Paragraph(para.replace('\n', '<br/>'), normal_style))
+            story.append(Spacer(1, 0.1 * inch))
+    doc.build(story)
+
+def benchmark(render, letters):
+    render(SAMPLE_LETTER, io.BytesIO())  # Warm-up (imports, font metrics)
+    timings = []
+    for _ in range(letters):
+        started = time.perf_counter()
+        render(SAMPLE_LETTER, io.BytesIO())
+        timings.append((time.perf_counter() - started) * 1000)
+    return metrics.summarize(timings)
+
+if __name__ == "__main__":
+    letters = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    print(f"📄 Rendering {letters} letters per variant (ms per letter)")
+    for name, render in (("legacy generate_pdf", legacy_generate_pdf),
+                         ("pdf_engine", get_pdf_engine().render)):
+        print(f"  {name:<20} {benchmark(render, letters)}")
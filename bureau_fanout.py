@@ -0,0 +1,157 @@
+"""
+Bureau Fan-out
+The same tradeline is usually disputed with Experian, Equifax and TransUnion. The letter
+body is generated once per tradeline; the other bureaus' letters are derived from it by
+swapping in their name and mailing address
+"""
+
+import re
+import threading
+from collections import OrderedDict
+from datetime import date
+
+import metrics
+from letter_similarity import REUSE_INDEX_SIZE, refresh_date
+
+# How each bureau is named in letters. A retargeted letter gets the target's name in the
+# same role: its legal name for any legal name, its dispute department (the Lob recipient,
+# mailer.BUREAU_ADDRESSES) for any department name, its brand for a bare brand mention.
+# Names are only ever taken whole from here, never built by swapping one word.
+BUREAUS = {
+    'experian': {
+        'brands': ['Experian'],
+        'legal_names': ['Experian Information Solutions, Inc.', 'Experian Information Solutions Inc.',
+                        'Experian Information Solutions'],
+        'department_names': ['Experian Dispute Department', 'Experian Disputes'],
+    },
+    'equifax': {
+        'brands': ['Equifax'],
+        'legal_names': ['Equifax Information Services LLC', 'Equifax Information Services, LLC',
+                        'Equifax Information Services', 'Equifax Credit Information Services, Inc.',
+                        'Equifax Credit Information Services'],
+        'department_names': [],  # Disputes go to Equifax Information Services LLC itself
+    },
+    'transunion': {
+        'brands': ['TransUnion', 'Trans Union'],
+        'legal_names': ['TransUnion LLC', 'Trans Union LLC', 'TransUnion, LLC', 'Trans Union, LLC'],
+        'department_names': ['TransUnion Consumer Solutions', 'Trans Union Consumer Solutions'],
+    },
+}
+# A brand followed by one of these (capitalized) is part of a name that isn't in BUREAUS -
+# it can't be retargeted without inventing a company name
+NAME_WORDS = r"(?:Information|Solutions|Services|Consumer|Dispute|Disputes|Department|LLC|Inc|Corp|Corporation|Company)\b"
+TRADELINE_FIELDS = ('creditor_name', 'account_number', 'reason', 'account_type', 'balance', 'notes')
+
+_tradelines = OrderedDict()  # tradeline key -> (bureau, letter, generated_on)
+_lock = threading.Lock()
+
+def _text(value):
+    """'' for missing values (None / NaN from pandas)"""
+    if value is None or (isinstance(value, float) and value != value):
+        return ''
+    return str(value).strip()
+
+def bureau_key(bureau):
+    """'Trans Union' / 'TransUnion' / 'transunion' -> 'transunion' (BUREAUS / BUREAU_ADDRESSES key)"""
+    return re.sub(r"[^a-z]", "", _text(bureau).lower())
+
+def tradeline_key(account_info):
+    """Everything that shapes the letter except the bureau it is addressed to"""
+    values = []
+    for field in TRADELINE_FIELDS:
+        value = _text(account_info.get(field))
+        if field == 'balance':
+            try:
+                value = f"{float(value):.2f}" if value else ''
+            except ValueError:
+                pass
+        values.append(value.lower())
+    return (account_info.get('user_id'),) + tuple(values)
+
+def _address_pattern(address):
+    """City, ST ZIP with flexible spacing/punctuation"""
+    return (rf"{re.escape(address['address_city'])},?\s+{re.escape(address['address_state'])}"
+            rf"\.?\s+{re.escape(address['address_zip'])}")
+
+def _any(names):
+    """Pattern matching any of the names as whole words (longest first)"""
+    names = sorted(names, key=len, reverse=True)
+    return "(?:" + "|".join(re.escape(name).replace(r"\ ", r"\s+") for name in names) + ")"
+
+def _recipient_block(address):
+    return (f"{address['name']}\n{address['address_line1']}\n"
+            f"{address['address_city']}, {address['address_state']} {address['address_zip']}")
+
+def _legal_name(key):
+    return BUREAUS[key]['legal_names'][0]
+
+def retarget_letter(letter, from_bureau, to_bureau):
+    """
+    Rewrite a letter addressed to one bureau for another: the recipient block as a whole,
+    then full names and bare brand mentions, each swapped for the target's name in the
+    same role (see BUREAUS). Returns None if anything of the original bureau is left or
+    a name couldn't be swapped whole.
+    """
+    from mailer import BUREAU_ADDRESSES
+
+    source, target = bureau_key(from_bureau), bureau_key(to_bureau)
+    if source == target:
+        return letter
+    if source not in BUREAUS or target not in BUREAUS:
+        return None
+    names, old_address, new_address = BUREAUS[source], BUREAU_ADDRESSES[source], BUREAU_ADDRESSES[target]
+    all_names = names['legal_names'] + names['department_names'] + names['brands'] + [old_address['name']]
+
+    # Recipient block: optional name line, P.O. box, city line
+    block = (rf"(?im)^[ \t]*(?:{_any(all_names)}[ \t]*\n[ \t]*)?{re.escape(old_address['address_line1'])}"
+             rf"[ \t]*\n[ \t]*{_address_pattern(old_address)}[ \t]*$")
+    letter = re.sub(block, lambda _: _recipient_block(new_address), letter)
+    # Address parts quoted elsewhere
+    letter = re.sub(_address_pattern(old_address), lambda _: _recipient_block(new_address).split("\n")[2], letter)
+    letter = re.sub(rf"(?<!\w){re.escape(old_address['address_line1'])}(?!\w)",
+                    lambda _: new_address['address_line1'], letter, flags=re.IGNORECASE)
+
+    replacements = {name: _legal_name(target) for name in names['legal_names']}
+    replacements.update({name: new_address['name'] for name in names['department_names'] + [old_address['name']]
+                         if name not in replacements})
+    by_name = {re.sub(r"\s+", " ", name).lower(): new for name, new in replacements.items()}
+    letter = re.sub(rf"(?<!\w){_any(replacements)}(?!\w)",
+                    lambda m: by_name[re.sub(r"\s+", " ", m.group(0)).lower()], letter, flags=re.IGNORECASE)
+
+    brands = _any(names['brands'])
+    if re.search(rf"(?<!\w)(?i:{brands}),?\s+{NAME_WORDS}", letter):
+        return None  # A name we don't know (e.g. "TransUnion Information Solutions")
+    letter = re.sub(rf"(?<!\w){brands}(?!\w)", lambda _: BUREAUS[target]['brands'][0], letter, flags=re.IGNORECASE)
+
+    leftovers = names['brands'] + [old_address['address_line1'], old_address['address_zip']]
+    if re.search(rf"(?<![\w-]){_any(leftovers)}(?![\w-])", letter, re.IGNORECASE):
+        return None
+    return letter
+
+def remember_tradeline_letter(account_info, letter):
+    """Keep the generated letter so the tradeline's other bureaus can be fanned out from it"""
+    if not letter or bureau_key(account_info.get('bureau')) not in BUREAUS:
+        return
+    with _lock:
+        _tradelines[tradeline_key(account_info)] = (account_info.get('bureau'), letter, date.today())
+        _tradelines.move_to_end(tradeline_key(account_info))
+        while len(_tradelines) > REUSE_INDEX_SIZE:
+            _tradelines.popitem(last=False)
+
+def fanout_letter(account_info):
+    """Letter for this bureau derived from one already generated for the same tradeline, or None"""
+    with _lock:
+        entry = _tradelines.get(tradeline_key(account_info))
+    if not entry:
+        return None
+
+    bureau, letter, generated_on = entry
+    if bureau_key(bureau) == bureau_key(account_info.get('bureau')):
+        return None  # Same bureau - a regeneration, not a fan-out
+    letter = retarget_letter(refresh_date(letter, generated_on), bureau, account_info.get('bureau'))
+    if letter:
+        metrics.incr("letters.fanout.hit")
+        print(f"📨 Fanned out {bureau} letter to {account_info.get('bureau')}")
+    else:
+        metrics.incr("letters.fanout.retarget_failed")
+    return letter
@@ -0,0 +1,102 @@
+"""
+Batch Checkpoints
+Per-dispute progress of a batch send (generated -> rendered -> submitting -> submitted
+-> recorded) and the deterministic Lob idempotency key for the letter. A run that dies
+part-way is resumed from here: letters already mailed are only recorded, and re-sends
+carry the same key so Lob returns the letter it already created instead of mailing
+another. 'submitting' is saved before the letter goes to Lob, with the disputes it
+carries, so a consolidated letter is re-sent as the same mailing, never regrouped.
+"""
+
+import hashlib
+
+from db import get_db_connection
+from psycopg2.extras import execute_values
+
+STAGES = ('generated', 'rendered', 'submitting', 'submitted', 'recorded')
+_STAGE_ORDER = "ARRAY[" + ", ".join(f"'{stage}'" for stage in STAGES) + "]"
+
+def letter_hash(letter_text):
+    return hashlib.sha256((letter_text or '').encode()).hexdigest()
+
+def pdf_hash(pdf):
+    """sha256 of rendered PDF bytes, to tell a saved PDF from one overwritten since"""
+    return hashlib.sha256(pdf).hexdigest()
+
+def idempotency_key(dispute_id, letter_text):
+    """Same dispute + same letter -> same key (a regenerated letter gets a new one)"""
+    return f"dispute-{dispute_id}-{letter_hash(letter_text)[:32]}"
+
+def mailing_idempotency_key(letters):
+    """Key for one Lob letter carrying several disputes' letters: (dispute_id, letter_text) pairs"""
+    combined = "\n".join(f"{dispute_id}:{letter_hash(letter_text)}"
+                          for dispute_id, letter_text in sorted(letters, key=lambda pair: pair[0]))
+    return f"mailing-{min(dispute_id for dispute_id, _ in letters)}-{letter_hash(combined)[:32]}"
+
+def load_checkpoints(dispute_ids):
+    """{dispute_id: checkpoint row} for the given disputes"""
+    dispute_ids = list(dispute_ids)
+    if not dispute_ids:
+        return {}
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute("SELECT * FROM batch_checkpoints WHERE dispute_id = ANY(%s)", (dispute_ids,))
+    rows = {row['dispute_id']: row for row in cur.fetchall()}
+    cur.close()
+    conn.close()
+    return rows
+
+def resume_point(checkpoint, letter_text):
+    """The checkpoint if it belongs to this letter text, else None (start over)"""
+    if checkpoint and checkpoint['letter_hash'] == letter_hash(letter_text):
+        return checkpoint
+    return None
+
+def save_checkpoints(stage, entries):
+    """
+    Advance disputes to stage. entries: dicts with dispute_id and letter_text, plus
+    pdf_path / pdf_sha256 (of the rendered bytes) / tracking_id where known, and the idempotency_key and mailing_dispute_ids
+    (every dispute in the same Lob letter, in order) of a consolidated mailing. Stages
+    only move forward (a late 'rendered' never overwrites 'submitted'); a different
+    letter restarts the checkpoint.
+    """
+    rows = [(entry['dispute_id'], stage, letter_hash(entry['letter_text']),
+             entry.get('idempotency_key') or idempotency_key(entry['dispute_id'], entry['letter_text']),
+             str(entry['pdf_path']) if entry.get('pdf_path') else None, entry.get('pdf_sha256'), entry.get('tracking_id'),
+             entry.get('mailing_dispute_ids') or [entry['dispute_id']])
+            for entry in entries]
+    if not rows:
+        return
+    conn = get_db_connection()
+    cur = conn.cursor()
+    execute_values(cur, f"""
+        INSERT INTO batch_checkpoints AS c
+            (dispute_id, stage, letter_hash, idempotency_key, pdf_path, pdf_sha256, tracking_id, mailing_dispute_ids)
+        VALUES %s
+        ON CONFLICT (dispute_id) DO UPDATE SET
+            stage = CASE
+                WHEN c.letter_hash IS DISTINCT FROM EXCLUDED.letter_hash
+                  OR array_position({_STAGE_ORDER}, EXCLUDED.stage) > array_position({_STAGE_ORDER}, c.stage)
+                THEN EXCLUDED.stage ELSE c.stage END,
+            tracking_id = CASE WHEN c.letter_hash IS DISTINCT FROM EXCLUDED.letter_hash
+                THEN EXCLUDED.tracking_id ELSE COALESCE(EXCLUDED.tracking_id, c.tracking_id) END,
+            pdf_path = COALESCE(EXCLUDED.pdf_path, c.pdf_path),
+            -- The hash goes with the file it was taken from, for this letter only
+            pdf_sha256 = CASE
+                WHEN EXCLUDED.pdf_sha256 IS NOT NULL THEN EXCLUDED.pdf_sha256
+                WHEN c.letter_hash IS DISTINCT FROM EXCLUDED.letter_hash
+                  OR (EXCLUDED.pdf_path IS NOT NULL AND EXCLUDED.pdf_path IS DISTINCT FROM c.pdf_path) THEN NULL
+                ELSE c.pdf_sha256 END,
+            -- Once submitting, the mailing is fixed: a resumed run re-sends exactly it
+            idempotency_key = CASE WHEN c.letter_hash IS NOT DISTINCT FROM EXCLUDED.letter_hash
+                  AND array_position({_STAGE_ORDER}, c.stage) >= array_position({_STAGE_ORDER}, 'submitting')
+                THEN c.idempotency_key ELSE EXCLUDED.idempotency_key END,
+            mailing_dispute_ids = CASE WHEN c.letter_hash IS NOT DISTINCT FROM EXCLUDED.letter_hash
+                  AND array_position({_STAGE_ORDER}, c.stage) >= array_position({_STAGE_ORDER}, 'submitting')
+                THEN c.mailing_dispute_ids ELSE EXCLUDED.mailing_dispute_ids END,
+            letter_hash = EXCLUDED.letter_hash,
+            updated_at = CURRENT_TIMESTAMP
+    """, rows, template="(%s, %s, %s, %s, %s, %s, %s, %s::integer[])")
+    conn.commit()
+    cur.close()
+    conn.close()
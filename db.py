@@ -14,6 +14,9 @@ if not DATABASE_URL:
 else:
     print(f"✅ Using database: {DATABASE_URL[:30]}...")  # Show first 30 chars for debugging
 
+# FCRA: a bureau has 30 days from receiving a dispute to investigate it
+BUREAU_RESPONSE_DAYS = 30
+
 # Railway provides postgres:// but psycopg2 needs postgresql://
 if DATABASE_URL.startswith('postgres://'):
     DATABASE_URL = DATABASE_URL.replace('postgres://', 'postgresql://', 1)
@@ -144,6 +147,86 @@ def init_db():
         )
     """)
     
+    # Generated letter cache columns (pdf_path was added by migrate_add_pdf_path.py)
+    c.execute("ALTER TABLE disputes ADD COLUMN IF NOT EXISTS pdf_path TEXT")
+    c.execute("ALTER TABLE disputes ADD COLUMN IF NOT EXISTS inputs_hash TEXT")
+    # Generated letter text (the PDF is rendered from it on demand)
+    c.execute("ALTER TABLE disputes ADD COLUMN IF NOT EXISTS letter_text TEXT")
+    c.execute("ALTER TABLE disputes ADD COLUMN IF NOT EXISTS letter_model TEXT")
+    c.execute("ALTER TABLE disputes ADD COLUMN IF NOT EXISTS prompt_version TEXT")
+    c.execute("ALTER TABLE disputes ADD COLUMN IF NOT EXISTS letter_generated_at TIMESTAMP")
+    # Batch claiming (status 'sending' while a batch run owns the dispute)
+    c.execute("ALTER TABLE disputes ADD COLUMN IF NOT EXISTS claimed_at TIMESTAMP")
+    c.execute("ALTER TABLE disputes ADD COLUMN IF NOT EXISTS claimed_by TEXT")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_disputes_status_user ON disputes (status, user_id)")
+    # Last Lob webhook event for the letter (see lob_webhooks.py)
+    c.execute("ALTER TABLE disputes ADD COLUMN IF NOT EXISTS last_event_at TIMESTAMP")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_disputes_tracking_id ON disputes (tracking_id)")
+    # Status polling schedule (see tracker.next_check_time); partial index = letters still in the mail
+    c.execute("ALTER TABLE disputes ADD COLUMN IF NOT EXISTS next_check_at TIMESTAMP")
+    c.execute("""
+        CREATE INDEX IF NOT EXISTS idx_disputes_next_check ON disputes (next_check_at NULLS FIRST)
+        WHERE status IN ('queued', 'sent', 'in_transit')
+    """)
+    
+    # Batch send progress per dispute (see checkpoints.py)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS batch_checkpoints (
+            dispute_id INTEGER PRIMARY KEY,
+            stage TEXT NOT NULL,
+            letter_hash TEXT NOT NULL,
+            idempotency_key TEXT NOT NULL,
+            pdf_path TEXT,
+            pdf_sha256 TEXT,
+            tracking_id TEXT,
+            mailing_dispute_ids INTEGER[],
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (dispute_id) REFERENCES disputes(id) ON DELETE CASCADE
+        )
+    """)
+    c.execute("ALTER TABLE batch_checkpoints ADD COLUMN IF NOT EXISTS mailing_dispute_ids INTEGER[]")
+    c.execute("ALTER TABLE batch_checkpoints ADD COLUMN IF NOT EXISTS pdf_sha256 TEXT")
+    
+    # Lob webhook events, stored once per event id (see lob_webhooks.py)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS lob_events (
+            event_id TEXT PRIMARY KEY,
+            event_type TEXT NOT NULL,
+            letter_id TEXT,
+            occurred_at TIMESTAMPTZ,
+            payload TEXT NOT NULL,
+            received_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            applied_at TIMESTAMP
+        )
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_lob_events_unapplied ON lob_events (received_at) WHERE applied_at IS NULL")
+    
+    # Lob letter templates, one per API base and template version (see lob_templates.py)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS lob_templates (
+            api_base TEXT NOT NULL,
+            version TEXT NOT NULL,
+            template_id TEXT NOT NULL,
+            name TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (api_base, version)
+        )
+    """)
+    # Tables keyed by version alone: their rows' API base isn't known, so those
+    # templates are registered again (once) instead of being used against the wrong one
+    c.execute("ALTER TABLE lob_templates ADD COLUMN IF NOT EXISTS api_base TEXT NOT NULL DEFAULT ''")
+    c.execute("""
+        DO $$
+        BEGIN
+            IF NOT EXISTS (SELECT 1 FROM information_schema.key_column_usage
+                           WHERE table_name = 'lob_templates' AND constraint_name = 'lob_templates_pkey'
+                             AND column_name = 'api_base') THEN
+                ALTER TABLE lob_templates DROP CONSTRAINT lob_templates_pkey;
+                ALTER TABLE lob_templates ADD PRIMARY KEY (api_base, version);
+            END IF;
+        END $$
+    """)
+    
     # Letter templates table
     c.execute("""
         CREATE TABLE IF NOT EXISTS letter_templates (
@@ -275,8 +358,8 @@ def log_dispute(user_id, account_number, bureau, description, tracking_id=None,
     conn = get_db_connection()
     c = conn.cursor()
     
-    # Calculate expected response date (30 days from send)
-    expected_date = (datetime.utcnow() + timedelta(days=30))
+    # Calculate expected response date (from send; moved to delivery once Lob reports it)
+    expected_date = (datetime.utcnow() + timedelta(days=BUREAU_RESPONSE_DAYS))
     
     c.execute("""
         INSERT INTO disputes 
@@ -491,19 +574,60 @@ def update_dispute_status(dispute_id, new_status, notes=None):
     conn.commit()
     conn.close()
 
-def update_dispute_pdf_path(dispute_id, pdf_path):
-    """Update dispute with generated PDF path"""
+def update_dispute_pdf_path(dispute_id, pdf_path, inputs_hash=None):
+    """Update dispute with generated PDF path (and the hash of the inputs it was built from)"""
     conn = get_db_connection()
     c = conn.cursor()
     
     c.execute(
-        "UPDATE disputes SET pdf_path = %s WHERE id = %s",
-        (str(pdf_path), dispute_id)
+        "UPDATE disputes SET pdf_path = %s, inputs_hash = %s WHERE id = %s",
+        (str(pdf_path), inputs_hash, dispute_id)
     )
     
     conn.commit()
     conn.close()
 
+def save_dispute_letter(dispute_id, letter_text, inputs_hash=None, letter_model=None, prompt_version=None):
+    """
+    Store the generated letter text and where it came from. Clears pdf_path - any
+    existing PDF was rendered from the previous text and is re-rendered on demand.
+    """
+    conn = get_db_connection()
+    c = conn.cursor()
+    
+    c.execute("""
+        UPDATE disputes
+        SET letter_text = %s, inputs_hash = %s, letter_model = %s, prompt_version = %s,
+            letter_generated_at = CURRENT_TIMESTAMP, pdf_path = NULL
+        WHERE id = %s
+    """, (letter_text, inputs_hash, letter_model, prompt_version, dispute_id))
+    
+    conn.commit()
+    conn.close()
+
+def get_dispute_for_generation(dispute_id):
+    """Get a single dispute joined with its account details (same join as get_user_disputes)"""
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute("""
+        SELECT 
+            d.*,
+            ua.account_type,
+            ua.balance,
+            ua.notes,
+            ua.reason
+        FROM disputes d
+        LEFT JOIN user_accounts ua 
+            ON d.account_number = ua.account_number 
+            AND d.bureau = ua.bureau
+            AND d.user_id = ua.user_id
+        WHERE d.id = %s
+        LIMIT 1
+    """, (dispute_id,))
+    dispute = c.fetchone()
+    conn.close()
+    return dict(dispute) if dispute else None
+
 def get_dispute_history(dispute_id):
     """Get history for a dispute"""
     conn = get_db_connection()
@@ -3,20 +3,20 @@ AI Document Analyzer
 Uses OpenAI to analyze credit reports, dispute responses, and supporting documents
 """
 
-import os
 import json
-from openai import OpenAI
 from dotenv import load_dotenv
 import PyPDF2
 
+from http_clients import get_openai_client as shared_openai_client
+
 load_dotenv()
 
 def get_openai_client():
-    """Lazy initialization of OpenAI client"""
-    api_key = os.getenv("OPENAI_API_KEY")
-    if not api_key:
+    """Shared OpenAI client (see http_clients)"""
+    client = shared_openai_client()
+    if client is None:
         raise ValueError("OPENAI_API_KEY environment variable not set")
-    return OpenAI(api_key=api_key)
+    return client
 
 def extract_text_from_pdf(pdf_path, max_pages=10):
     """Extract text from PDF file"""
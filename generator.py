@@ -1,39 +1,231 @@
 import pandas as pd
 from jinja2 import Environment, FileSystemLoader
-from reportlab.lib.pagesizes import LETTER
-from reportlab.pdfgen import canvas
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer
-from reportlab.lib.units import inch
 from pathlib import Path
 from datetime import date
+import io
 import os
-from ai_generator import generate_dispute_letter_ai
+import json
+import hashlib
+import time
+import threading
+from ai_generator import generate_dispute_letter_ai, generate_dispute_letters_batch
+from reason_classifier import classify_reason
+from letter_similarity import reuse_letter, remember_letter
+from bureau_fanout import tradeline_key, fanout_letter, remember_tradeline_letter
+import metrics
+from pdf_engine import get_pdf_engine
+from pdf_pool import render_pdfs
 
-def render_letter(row, template_dir="disputes/templates", use_ai=True):
+LETTER_INPUT_FIELDS = ('bureau', 'creditor_name', 'account_number', 'reason',
+                       'account_type', 'balance', 'notes')
+
+def account_info_from_dispute(dispute):
+    """Build letter inputs from a dispute row - handles None values from the LEFT JOIN"""
+    return {
+        'bureau': dispute['bureau'],
+        'creditor_name': dispute['creditor_name'] or 'Unknown',
+        'account_number': dispute['account_number'],
+        'reason': dispute['description'],
+        'account_type': dispute['account_type'] if dispute['account_type'] else '',
+        'balance': dispute['balance'] if dispute['balance'] else '',
+        'notes': dispute['notes'] if dispute['notes'] else '',
+        'user_id': dispute.get('user_id')
+    }
+
+def letter_inputs_hash(account_info):
+    """Stable hash of the fields that drive letter generation (used to detect stale letters)"""
+    normalized = {}
+    for field in LETTER_INPUT_FIELDS:
+        value = account_info.get(field)
+        if value is None or (isinstance(value, float) and value != value):
+            value = ''
+        elif isinstance(value, (int, float)):
+            value = f"{float(value):.2f}"
+        normalized[field] = str(value).strip()
+    payload = json.dumps(normalized, sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+def render_letter(row, template_dir="disputes/templates", use_ai=True, source_out=None):
     """
     Generate letter content - uses AI if enabled, falls back to template
-    AI tries Ollama first (local, free), then OpenAI if available
+    Common dispute reasons use a pre-approved letter variant, and a tradeline already
+    written for another bureau or a near-duplicate of an earlier AI letter is adapted
+    (no LLM call); otherwise AI tries Ollama first (local, free), then OpenAI if available.
+    source_out (optional) is filled with the letter's 'model' and 'prompt_version'.
     """
+    source_out = {} if source_out is None else source_out
     if use_ai:
+        account_info = _letter_account_info(row)
+        reason_class = classify_reason(account_info['reason'], account_info['notes'])
+        if reason_class:
+            source_out.update(model=f"fast_path:{reason_class}", prompt_version=None)
+            return render_reason_letter(account_info, reason_class, template_dir)
+        
+        reused = _reuse_existing_letter(account_info, source_out)
+        if reused:
+            return reused
+        
         # Try AI generation (Ollama or OpenAI)
-        account_info = {
-            'bureau': row.get('bureau'),
-            'creditor_name': row.get('creditor_name'),
-            'account_number': row.get('account_number'),
-            'reason': row.get('reason'),
-            'account_type': row.get('account_type', ''),
-            'balance': row.get('balance', ''),
-            'notes': row.get('notes', '')
-        }
-        ai_letter = generate_dispute_letter_ai(account_info)
+        metrics.incr("letters.llm")
+        ai_letter = generate_dispute_letter_ai(account_info, source_out=source_out)
         
         if ai_letter:
+            _remember_ai_letter(account_info, ai_letter)
             return ai_letter
         else:
             print("⚠️  AI generation failed, falling back to template")
     
-    # Fallback to Jinja2 template
+    source_out.update(model="template", prompt_version=None)
+    return render_template_letter(row, template_dir)
+
+def _letter_account_info(row):
+    return {
+        'bureau': row.get('bureau'),
+        'creditor_name': row.get('creditor_name'),
+        'account_number': row.get('account_number'),
+        'reason': row.get('reason'),
+        'account_type': row.get('account_type', ''),
+        'balance': row.get('balance', ''),
+        'notes': row.get('notes', ''),
+        'user_id': row.get('user_id')
+    }
+
+def _reuse_existing_letter(account_info, source_out):
+    """Same tradeline for another bureau (fan-out), else a near-duplicate AI letter"""
+    letter = fanout_letter(account_info)
+    if letter:
+        source_out.update(model="fanout", prompt_version=None)
+        return letter  # Keep fanning out from the generated letter, not from this copy
+    letter = reuse_letter(account_info)
+    if letter:
+        source_out.update(model="reuse", prompt_version=None)
+        remember_tradeline_letter(account_info, letter)
+    return letter
+
+def _remember_ai_letter(account_info, letter):
+    remember_letter(account_info, letter)
+    remember_tradeline_letter(account_info, letter)
+
+def render_letters(rows, template_dir="disputes/templates", use_ai=True, sources_out=None):
+    """
+    Generate letter content for several rows at once - common reasons use their
+    pre-approved variant, near-duplicates reuse an earlier AI letter, the rest are requested
+    from the AI in multi-account batches (see generate_dispute_letters_batch), template
+    fallback per row. A tradeline disputed with several bureaus is generated once and
+    fanned out to the other bureaus. sources_out (optional list) is filled with each
+    letter's model and prompt version.
+    """
+    rows = list(rows)
+    sources = [{} for _ in rows]
+    if sources_out is not None:
+        sources_out[:] = sources
+    if not use_ai:
+        for source in sources:
+            source.update(model="template", prompt_version=None)
+        return [render_template_letter(row, template_dir) for row in rows]
+    
+    letters = [None] * len(rows)
+    account_infos = [_letter_account_info(row) for row in rows]
+    representatives = {}  # tradeline -> index of the row that goes to the LLM
+    siblings = []
+    for index, account_info in enumerate(account_infos):
+        reason_class = classify_reason(account_info['reason'], account_info['notes'])
+        if reason_class:
+            sources[index].update(model=f"fast_path:{reason_class}", prompt_version=None)
+            letters[index] = render_reason_letter(account_info, reason_class, template_dir)
+            continue
+        letters[index] = _reuse_existing_letter(account_info, sources[index])
+        if letters[index]:
+            continue
+        key = tradeline_key(account_info)
+        if key in representatives:
+            siblings.append(index)
+        else:
+            representatives[key] = index
+    
+    _render_ai_letters(rows, account_infos, list(representatives.values()), letters, sources, template_dir)
+    
+    # Other bureaus for the same tradeline: merge in their address/wording, and only
+    # generate separately if that isn't possible (e.g. the first letter failed)
+    unresolved = []
+    for index in siblings:
+        letters[index] = fanout_letter(account_infos[index])
+        if letters[index]:
+            sources[index].update(model="fanout", prompt_version=None)
+        else:
+            unresolved.append(index)
+    _render_ai_letters(rows, account_infos, unresolved, letters, sources, template_dir)
+    return letters
+
+def _render_ai_letters(rows, account_infos, indexes, letters, sources, template_dir):
+    """Batched AI generation for the given rows, template fallback per row"""
+    if not indexes:
+        return
+    metrics.incr("letters.llm", len(indexes))
+    ai_sources = []
+    ai_letters = generate_dispute_letters_batch([account_infos[i] for i in indexes], sources_out=ai_sources)
+    for index, ai_letter, ai_source in zip(indexes, ai_letters, ai_sources):
+        if ai_letter:
+            _remember_ai_letter(account_infos[index], ai_letter)
+            sources[index].update(ai_source)
+        else:
+            print("⚠️  AI generation failed, falling back to template")
+            sources[index].update(model="template", prompt_version=None)
+        letters[index] = ai_letter or render_template_letter(rows[index], template_dir)
+
+_reason_envs = {}
+_reason_envs_lock = threading.Lock()
+
+def _reason_template(reason_class, template_dir):
+    """Compiled letter variant (templates are compiled once per process and cached)"""
+    with _reason_envs_lock:
+        env = _reason_envs.get(template_dir)
+        if env is None:
+            env = Environment(loader=FileSystemLoader(template_dir), trim_blocks=True,
+                              lstrip_blocks=True, auto_reload=False)
+            _reason_envs[template_dir] = env
+    return env.get_template(f"reasons/{reason_class}.j2")
+
+def _letter_value(value):
+    """'' for missing values (None / NaN from pandas)"""
+    if value is None or (isinstance(value, float) and value != value):
+        return ''
+    return str(value).strip()
+
+def _format_balance(balance):
+    try:
+        return f"{float(balance):,.2f}" if _letter_value(balance) else ''
+    except ValueError:
+        return _letter_value(balance)
+
+def render_reason_letter(account_info, reason_class, template_dir="disputes/templates"):
+    """Render the pre-approved letter variant for a classified dispute reason (no LLM call)"""
+    started = time.perf_counter()
+    letter = _reason_template(reason_class, template_dir).render(
+        today_date=date.today().strftime("%B %d, %Y"),
+        bureau=_letter_value(account_info.get('bureau')),
+        creditor_name=_letter_value(account_info.get('creditor_name')) or 'Unknown',
+        account_number=_letter_value(account_info.get('account_number')),
+        account_type=_letter_value(account_info.get('account_type')),
+        balance=_format_balance(account_info.get('balance')),
+        reason=_letter_value(account_info.get('reason')),
+        notes=_letter_value(account_info.get('notes'))
+    )
+    metrics.observe("letters.fast_path_seconds", time.perf_counter() - started)
+    metrics.incr("letters.fast_path")
+    metrics.incr(f"letters.fast_path.{reason_class}")
+    return letter
+
+def fast_path_fraction():
+    """Share of generated letters that used a pre-approved variant instead of the LLM"""
+    fast = metrics.get_counter("letters.fast_path")
+    total = fast + metrics.get_counter("letters.llm")
+    return round(fast / total, 3) if total else None
+
+metrics.register_gauge("letters.fast_path_fraction", fast_path_fraction)
+
+def render_template_letter(row, template_dir="disputes/templates"):
+    """Fallback letter from the Jinja2 template"""
     env = Environment(loader=FileSystemLoader(template_dir))
     template = env.get_template("dispute_letter.j2")
     
@@ -49,46 +241,53 @@ def render_letter(row, template_dir="disputes/templates", use_ai=True):
         ssn_last4="1234"
     )
 
-def generate_pdf(text, out_path):
-    """Generate PDF from text content with better formatting"""
-    doc = SimpleDocTemplate(str(out_path), pagesize=LETTER,
-                           rightMargin=72, leftMargin=72,
-                           topMargin=72, bottomMargin=18)
-    
-    # Create styles
-    styles = getSampleStyleSheet()
-    normal_style = ParagraphStyle(
-        'CustomNormal',
-        parent=styles['Normal'],
-        fontSize=11,
-        leading=14,
-        spaceAfter=6
-    )
-    
-    # Build document content
-    story = []
-    
-    # Split text into paragraphs and add to story
-    paragraphs = text.split('\n\n')
-    for para in paragraphs:
-        if para.strip():
-            # Replace single newlines with <br/> for line breaks
-            para_formatted = para.replace('\n', '<br/>')
-            p = Paragraph(para_formatted, normal_style)
-            story.append(p)
-            story.append(Spacer(1, 0.1 * inch))
-    
-    # Build PDF
-    doc.build(story)
+def generate_pdf(text, out_path=None):
+    """
+    Generate PDF from text content (layout/styles are reused, see pdf_engine).
+    Writes to out_path if given, otherwise returns the PDF bytes.
+    """
+    if out_path is not None:
+        get_pdf_engine().render(text, out_path)
+        return out_path
+    buffer = io.BytesIO()
+    get_pdf_engine().render(text, buffer)
+    return buffer.getvalue()
+
+def dispute_pdf(dispute):
+    """
+    PDF bytes for a dispute, rendered from its saved letter text on first use (and kept
+    under disputes/generated/ in the background). Disputes from before letter text was
+    stored fall back to their PDF on disk. None if there is no letter yet.
+    """
+    from pdf_store import pending_pdf, persist_pdf
+    from pregenerator import pregenerated_pdf_path
+    from db import update_dispute_pdf_path
+
+    pdf_path = dispute.get('pdf_path')
+    if pdf_path:
+        pending = pending_pdf(pdf_path)
+        if pending is not None:
+            return pending
+        if Path(pdf_path).exists():
+            return Path(pdf_path).read_bytes()
+
+    if not dispute.get('letter_text'):
+        return None
+    metrics.incr("pdf.lazy_render")
+    pdf_bytes = generate_pdf(dispute['letter_text'])
+    pdf_path = pregenerated_pdf_path(dispute)
+    persist_pdf(pdf_bytes, pdf_path)
+    update_dispute_pdf_path(dispute['id'], pdf_path, dispute.get('inputs_hash'))
+    return pdf_bytes
 
 def build_letters(csv_path="data/accounts.csv"):
     df = pd.read_csv(csv_path)
-    output_files = []
-    for _, row in df.iterrows():
-        text = render_letter(row)
+    rows = [row for _, row in df.iterrows()]
+    jobs = []
+    for row, text in zip(rows, render_letters(rows)):
         bureau_dir = Path(f"disputes/generated/{row['bureau'].lower()}")
         bureau_dir.mkdir(parents=True, exist_ok=True)
-        pdf_path = bureau_dir / f"{row['account_number']}.pdf"
-        generate_pdf(text, pdf_path)
-        output_files.append((pdf_path, row))
-    return output_files
+        jobs.append((text, bureau_dir / f"{row['account_number']}.pdf"))
+    # Render on all cores; wait for every PDF before handing the paths back
+    futures = render_pdfs(jobs)
+    return [(future.result(), row) for future, row in zip(futures, rows)]
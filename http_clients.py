@@ -0,0 +1,168 @@
+"""
+Shared Outbound HTTP Clients
+One keep-alive connection pool per process for Ollama, OpenAI, Lob, n8n and SendGrid
+instead of a new TCP/TLS connection (or a new OpenAI client) per call
+"""
+
+import os
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from dotenv import load_dotenv
+
+import metrics
+
+load_dotenv()
+
+HTTP_POOL_HOSTS = int(os.getenv("HTTP_POOL_HOSTS", "10"))  # Distinct hosts kept pooled
+HTTP_POOL_MAXSIZE = int(os.getenv("HTTP_POOL_MAXSIZE", "10"))  # Keep-alive connections per host
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "60"))
+
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "10"))
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "60"))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "2"))
+
+class PooledSession(requests.Session):
+    """requests.Session that applies the default (connect, read) timeout when a call doesn't set one"""
+
+    def request(self, method, url, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+        return super().request(method, url, **kwargs)
+
+
+_lock = threading.Lock()
+_lob_configured = False
+_session = None
+_session_pid = None
+_openai_client = None
+_openai_pid = None
+
+def _new_session():
+    session = PooledSession()
+    # Reconnect once if a pooled keep-alive connection was closed by the server;
+    # never retry reads, so non-idempotent POSTs (Lob letters) aren't sent twice
+    retry = Retry(total=1, connect=1, read=False, status=0, redirect=False)
+    adapter = HTTPAdapter(pool_connections=HTTP_POOL_HOSTS, pool_maxsize=HTTP_POOL_MAXSIZE,
+                          max_retries=retry)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+def get_session():
+    """
+    The process-wide pooled session.
+    Created lazily and again after a fork (gunicorn --preload), so workers never
+    share sockets with the master.
+    """
+    global _session, _session_pid
+    with _lock:
+        if _session is None or _session_pid != os.getpid():
+            _session = _new_session()
+            _session_pid = os.getpid()
+        return _session
+
+def get_openai_client():
+    """Shared OpenAI client (one httpx pool per process); None if OPENAI_API_KEY isn't set"""
+    global _openai_client, _openai_pid
+    api_key = os.getenv("OPENAI_API_KEY")
+    if not api_key:
+        return None
+
+    with _lock:
+        if _openai_client is None or _openai_pid != os.getpid():
+            import httpx
+            from openai import OpenAI, DefaultHttpxClient
+
+            http_client = DefaultHttpxClient(
+                limits=httpx.Limits(max_connections=OPENAI_MAX_CONNECTIONS,
+                                    max_keepalive_connections=OPENAI_MAX_CONNECTIONS),
+                timeout=httpx.Timeout(OPENAI_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+                event_hooks={"request": [_trace_openai_request]}
+            )
+            _openai_client = OpenAI(api_key=api_key, http_client=http_client,
+                                    max_retries=OPENAI_MAX_RETRIES)
+            _openai_pid = os.getpid()
+        return _openai_client
+
+def _trace_openai_request(request):
+    """Count OpenAI requests and the ones that had to open a new connection"""
+    metrics.incr("http.openai.requests")
+
+    def trace(event_name, info):
+        if event_name.endswith("connect_tcp.complete"):
+            metrics.incr("http.openai.new_connections")
+
+    request.extensions["trace"] = trace
+
+
+class _LobRequests:
+    """Stand-in for the `requests` module inside lob.api_requestor, backed by the shared session"""
+
+    def get(self, url, **kwargs):
+        return get_session().get(url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return get_session().post(url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return get_session().delete(url, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(requests, name)  # exceptions etc.
+
+
+def install_lob_session():
+    """Route the Lob SDK (which calls requests.get/post directly) through the shared pool"""
+    import lob.api_requestor
+    if not isinstance(lob.api_requestor.requests, _LobRequests):
+        lob.api_requestor.requests = _LobRequests()
+
+def lob_config():
+    """
+    The Lob SDK, set up once per process for every module that calls Lob (letters,
+    templates, status checks): API key, API base (LOB_API_BASE, e.g. lob_standin.py
+    locally) and the shared pool. Returns the lob module.
+    """
+    global _lob_configured
+    import lob
+    with _lock:
+        if not _lob_configured:
+            lob.api_key = os.getenv("LOB_API_KEY")
+            lob.api_base = os.getenv("LOB_API_BASE") or lob.api_base
+            install_lob_session()
+            _lob_configured = True
+    return lob
+
+def connection_stats():
+    """Per-host request count, new connections and reuse ratio of the shared session"""
+    with _lock:
+        session = _session if _session_pid == os.getpid() else None
+
+    stats = {}
+    if session is not None:
+        for adapter in set(session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in list(pools.keys()):
+                pool = pools.get(key)
+                if pool is None or not pool.num_requests:
+                    continue
+                stats[f"{pool.scheme}://{pool.host}:{pool.port}"] = {
+                    'requests': pool.num_requests,
+                    'new_connections': pool.num_connections,
+                    'reuse_ratio': round(1 - pool.num_connections / pool.num_requests, 3)
+                }
+
+    openai_requests = metrics.get_counter("http.openai.requests")
+    if openai_requests:
+        new_connections = metrics.get_counter("http.openai.new_connections")
+        stats["openai"] = {
+            'requests': openai_requests,
+            'new_connections': new_connections,
+            'reuse_ratio': round(1 - new_connections / openai_requests, 3)
+        }
+    return stats
+
+metrics.register_gauge("http.connections", connection_stats)
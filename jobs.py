@@ -0,0 +1,95 @@
+"""
+Background Jobs
+Batch sending and Lob status checks run in-process on a small background executor
+instead of a child `python3 batch_processor.py`; routes get a job id back immediately
+and poll /jobs/<id>. Job records live in this process (gunicorn runs one worker).
+"""
+
+import os
+import uuid
+import threading
+import traceback
+from collections import OrderedDict
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+
+import metrics
+
+load_dotenv()
+
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_HISTORY = 200  # Finished jobs kept for status lookups
+
+_lock = threading.Lock()
+_jobs = OrderedDict()  # job id -> job record
+_executor = None
+_executor_pid = None
+
+def _get_executor():
+    """Created lazily (and again after a fork) so gunicorn --preload forks stay clean"""
+    global _executor, _executor_pid
+    with _lock:
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="job")
+            _executor_pid = os.getpid()
+        return _executor
+
+def _run(job_id, func, args, kwargs):
+    with _lock:
+        job = _jobs[job_id]
+        job.update(status='running', started_at=datetime.utcnow())
+    print(f"▶️  Job {job['name']} ({job_id}) started")
+    try:
+        result = func(*args, **kwargs)
+        with _lock:
+            job.update(status='succeeded', result=result)
+        metrics.incr(f"jobs.{job['name']}.succeeded")
+        print(f"✅ Job {job['name']} ({job_id}) finished")
+    except Exception as e:
+        traceback.print_exc()
+        with _lock:
+            job.update(status='failed', error=str(e))
+        metrics.incr(f"jobs.{job['name']}.failed")
+    finally:
+        with _lock:
+            job['finished_at'] = datetime.utcnow()
+        metrics.observe(f"jobs.{job['name']}.seconds",
+                        (job['finished_at'] - job['started_at']).total_seconds())
+
+def submit_job(name, func, *args, user_id=None, exclusive=False, **kwargs):
+    """
+    Run func(*args, **kwargs) on the background executor and return the job record.
+    exclusive=True returns the same user's already queued/running job of the same name
+    instead of starting another (e.g. a double-clicked "Send to Lob").
+    """
+    with _lock:
+        if exclusive:
+            for job in _jobs.values():
+                if (job['name'] == name and job['user_id'] == user_id
+                        and job['status'] in ('queued', 'running')):
+                    return dict(job)
+        job_id = uuid.uuid4().hex[:12]
+        _jobs[job_id] = {
+            'id': job_id, 'name': name, 'user_id': user_id, 'status': 'queued',
+            'submitted_at': datetime.utcnow(), 'started_at': None, 'finished_at': None,
+            'result': None, 'error': None
+        }
+        finished = [jid for jid, job in _jobs.items() if job['status'] in ('succeeded', 'failed')]
+        for jid in finished[:max(0, len(finished) - JOB_HISTORY)]:
+            del _jobs[jid]
+        record = dict(_jobs[job_id])
+    metrics.incr(f"jobs.{name}.submitted")
+    _get_executor().submit(_run, job_id, func, args, kwargs)
+    return record
+
+def get_job(job_id):
+    """Copy of a job record, or None"""
+    with _lock:
+        job = _jobs.get(job_id)
+        return dict(job) if job else None
+
+def job_json(job):
+    """JSON-safe job record"""
+    return {key: value.isoformat() + 'Z' if isinstance(value, datetime) else value
+            for key, value in job.items()}
@@ -0,0 +1,267 @@
+"""
+Near-duplicate Letter Reuse
+MinHash/LSH index over the inputs of previously generated AI letters. A new dispute
+whose (normalized) reason, notes and account type closely match a prior one for the
+same user, creditor and bureau reuses that letter, with the account details swapped in deterministically,
+instead of another LLM call
+"""
+
+import os
+import re
+import hashlib
+import threading
+from collections import OrderedDict
+from datetime import date
+from dotenv import load_dotenv
+
+import metrics
+
+load_dotenv()
+
+REUSE_ENABLED = os.getenv("LETTER_REUSE", "1") == "1"
+REUSE_THRESHOLD = float(os.getenv("LETTER_REUSE_THRESHOLD", "0.8"))  # Min Jaccard similarity
+REUSE_INDEX_SIZE = int(os.getenv("LETTER_REUSE_INDEX_SIZE", "2000"))  # Letters kept per process
+
+NUM_PERM = 64
+BANDS = 16
+ROWS_PER_BAND = NUM_PERM // BANDS
+_PRIME = (1 << 61) - 1
+_PERMUTATIONS = [
+    (int.from_bytes(hashlib.blake2b(f"a{i}".encode(), digest_size=8).digest(), "big") % _PRIME or 1,
+     int.from_bytes(hashlib.blake2b(f"b{i}".encode(), digest_size=8).digest(), "big") % _PRIME)
+    for i in range(NUM_PERM)
+]
+
+# Shorthand seen in uploads/notes -> canonical token
+TOKEN_SYNONYMS = {
+    'acct': 'account', 'accnt': 'account', 'accounts': 'account',
+    'bal': 'balance', 'amt': 'amount', 'pd': 'paid', 'payed': 'paid',
+    'dup': 'duplicate', 'dupe': 'duplicate', 'duplicated': 'duplicate',
+    'info': 'information', 'incorrect': 'wrong', 'inaccurate': 'wrong', 'error': 'wrong',
+    'never': 'not', 'no': 'not', 'nor': 'not', 'without': 'not',
+    'me': 'my', 'opened': 'open', 'recognise': 'recognize',
+}
+STOPWORDS = {
+    'a', 'an', 'the', 'this', 'that', 'is', 'was', 'are', 'be', 'been', 'it', 'i', 'my',
+    'of', 'to', 'in', 'on', 'for', 'and', 'or', 'with', 'as', 'at', 'by', 'has', 'have', 'had'
+}
+NUMBER = re.compile(r"(?<![\d.,])(?:\d{1,3}(?:,\d{3})+|\d+)(?:\.\d+)?")  # 1,500.00 / 1500 / 30
+DATE_LINE = re.compile(r"\b(January|February|March|April|May|June|July|August|September|"
+                       r"October|November|December) \d{1,2}, \d{4}\b")
+
+def letter_tokens(account_info):
+    """
+    Normalized token set of the parts of a dispute that shape the letter's wording.
+    A negation stays on the word it modifies ("never late" -> not_late), so a dispute
+    and its opposite don't look alike.
+    """
+    text = " ".join(_text(account_info.get(field)) for field in ('reason', 'notes', 'account_type'))
+    tokens = set()
+    negated = False
+    for token in re.findall(r"[a-z0-9']+", text.lower()):
+        token = 'not' if token.endswith("n't") else TOKEN_SYNONYMS.get(token, token)
+        if token == 'not':
+            negated = True
+        elif token not in STOPWORDS:
+            tokens.add(f"not_{token}" if negated else token)
+            negated = False
+    if negated:
+        tokens.add('not')
+    return frozenset(tokens)
+
+def _negations(tokens):
+    return {token for token in tokens if token == 'not' or token.startswith('not_')}
+
+def minhash(tokens):
+    """NUM_PERM-value MinHash signature of a token set"""
+    hashed = [int.from_bytes(hashlib.blake2b(t.encode(), digest_size=8).digest(), "big") for t in tokens]
+    return tuple(min((a * h + b) % _PRIME for h in hashed) for a, b in _PERMUTATIONS)
+
+def jaccard(a, b):
+    return len(a & b) / len(a | b) if a or b else 1.0
+
+def _text(value):
+    """'' for missing values (None / NaN from pandas)"""
+    if value is None or (isinstance(value, float) and value != value):
+        return ''
+    return str(value).strip()
+
+def _scope(account_info):
+    """
+    Letters are only reused within one user, creditor and bureau (AI letters often
+    include the bureau's mailing address, which a name swap wouldn't fix)
+    """
+    creditor = " ".join(re.findall(r"[a-z0-9]+", _text(account_info.get('creditor_name')).lower()))
+    return (account_info.get('user_id'), creditor, _text(account_info.get('bureau')).lower())
+
+
+class LetterIndex:
+    """Bounded LRU of generated letters with LSH buckets for candidate lookup"""
+
+    def __init__(self, max_size=REUSE_INDEX_SIZE):
+        self.max_size = max_size
+        self._entries = OrderedDict()  # id -> (scope, tokens, signature, account_info, letter, generated_on)
+        self._buckets = {}  # (scope, band, band values) -> set of ids
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    def _band_keys(self, scope, signature):
+        return [(scope, band, signature[band * ROWS_PER_BAND:(band + 1) * ROWS_PER_BAND])
+                for band in range(BANDS)]
+
+    def add(self, account_info, letter):
+        tokens = letter_tokens(account_info)
+        if not tokens or not letter:
+            return
+        scope = _scope(account_info)
+        signature = minhash(tokens)
+        with self._lock:
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = (scope, tokens, signature, dict(account_info), letter, date.today())
+            for key in self._band_keys(scope, signature):
+                self._buckets.setdefault(key, set()).add(entry_id)
+            while len(self._entries) > self.max_size:
+                self._evict(next(iter(self._entries)))
+
+    def _evict(self, entry_id):
+        scope, _, signature, _, _, _ = self._entries.pop(entry_id)
+        for key in self._band_keys(scope, signature):
+            bucket = self._buckets.get(key)
+            if bucket is not None:
+                bucket.discard(entry_id)
+                if not bucket:
+                    del self._buckets[key]
+
+    def find(self, account_info, threshold=REUSE_THRESHOLD):
+        """Most similar prior (account_info, letter, generated_on, similarity) at or above threshold"""
+        tokens = letter_tokens(account_info)
+        if not tokens:
+            return None
+        scope = _scope(account_info)
+        signature = minhash(tokens)
+        with self._lock:
+            candidates = set()
+            for key in self._band_keys(scope, signature):
+                candidates |= self._buckets.get(key, set())
+            best = None
+            for entry_id in candidates:
+                _, entry_tokens, _, prior_info, letter, generated_on = self._entries[entry_id]
+                if _negations(entry_tokens) != _negations(tokens):
+                    continue  # One denies what the other says
+                similarity = jaccard(tokens, entry_tokens)  # Exact check on the LSH candidates
+                if similarity >= threshold and (best is None or similarity > best[3]):
+                    best = (prior_info, letter, generated_on, similarity)
+                    self._entries.move_to_end(entry_id)
+            return best
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+
+_index = LetterIndex()
+
+def _replace_value(letter, old, new, digits=False):
+    """Swap one account detail; digit values only match as whole numbers"""
+    old, new = _text(old), _text(new)
+    if not old or old == new:
+        return letter
+    pattern = rf"(?<!\d){re.escape(old)}(?!\d)" if digits else _phrase(old)
+    return re.sub(pattern, lambda _: new, letter, flags=0 if digits else re.IGNORECASE)
+
+def _phrase(text):
+    """Pattern matching text as a whole phrase (not inside a longer word)"""
+    return rf"(?<!\w){re.escape(text)}(?!\w)"
+
+def _balance_value(balance):
+    try:
+        value = float(_text(balance).replace(',', '').lstrip('$'))
+    except ValueError:
+        return None
+    return None if value != value else value
+
+def _balance_forms(balance):
+    """How a balance may be written in a letter, most specific first ($1,500.00 ... $1500)"""
+    value = _balance_value(balance)
+    if value is None:
+        return []
+    whole = value == int(value)
+    return [f"{value:,.2f}", f"{value:.2f}", f"{value:,.0f}" if whole else None, f"{value:.0f}" if whole else None]
+
+def _quotes_amount(letter, value):
+    """True if any number in the letter is this amount, however it's written"""
+    return any(float(number.replace(',', '')) == value
+               for number in NUMBER.findall(letter))
+
+def refresh_date(letter, generated_on):
+    """Move the letter's date line from the day it was generated to today"""
+    old_date = generated_on.strftime("%B %d, %Y").replace(" 0", " ")
+    today = date.today().strftime("%B %d, %Y")
+    return DATE_LINE.sub(lambda m: today if m.group(0).replace(" 0", " ") == old_date else m.group(0), letter)
+
+def adapt_letter(letter, prior_info, account_info, generated_on):
+    """
+    Rewrite a prior letter for new account details, or None if it can't be done safely
+    (e.g. the letter quotes a balance the new dispute doesn't have)
+    """
+    adapted = _replace_value(letter, prior_info.get('account_number'), account_info.get('account_number'), digits=True)
+    adapted = _replace_value(adapted, prior_info.get('creditor_name'), account_info.get('creditor_name'))
+
+    # A different reason or note is only carried over by swapping the exact phrase the
+    # letter quotes; wording built around the old one (paraphrased, or conceding it)
+    # can't be rewritten safely
+    for field in ('reason', 'notes'):
+        old, new = _text(prior_info.get(field)), _text(account_info.get(field))
+        if old.casefold() == new.casefold():
+            continue
+        if not old or not new or not re.search(_phrase(old), adapted, re.IGNORECASE):
+            return None
+        adapted = _replace_value(adapted, old, new)
+
+    old_balances = _balance_forms(prior_info.get('balance'))
+    new_balances = _balance_forms(account_info.get('balance')) or [None] * len(old_balances)
+    for old, new in zip(old_balances, new_balances):
+        pattern = rf"(?<![\d,.]){re.escape(old)}(?![\d,]|\.\d)" if old else None
+        if pattern and re.search(pattern, adapted):
+            if not new:
+                return None
+            adapted = re.sub(pattern, lambda _: new, adapted)
+    old_balance = _balance_value(prior_info.get('balance'))
+    if old_balance is not None and old_balance != _balance_value(account_info.get('balance')) \
+            and _quotes_amount(adapted, old_balance):
+        return None  # The old balance is still in there, written some other way
+
+    adapted = refresh_date(adapted, generated_on)
+
+    old_number = _text(prior_info.get('account_number'))
+    if old_number and old_number != _text(account_info.get('account_number')) and old_number in adapted:
+        return None
+    return adapted
+
+def remember_letter(account_info, letter):
+    """Index an AI-generated letter so near-duplicate disputes can reuse it"""
+    if REUSE_ENABLED and letter:
+        _index.add(account_info, letter)
+
+def reuse_letter(account_info):
+    """Adapted prior letter for a near-duplicate dispute, or None (counts hit/miss)"""
+    if not REUSE_ENABLED:
+        return None
+    match = _index.find(account_info)
+    letter = adapt_letter(match[1], match[0], account_info, match[2]) if match else None
+    if letter:
+        metrics.incr("letters.reuse.hit")
+        metrics.observe("letters.reuse.similarity", match[3])
+        print(f"♻️  Reusing similar letter (similarity {match[3]:.2f})")
+    else:
+        metrics.incr("letters.reuse.miss")
+    return letter
+
+def reuse_hit_rate():
+    hits = metrics.get_counter("letters.reuse.hit")
+    total = hits + metrics.get_counter("letters.reuse.miss")
+    return {'hit_rate': round(hits / total, 3) if total else None, 'threshold': REUSE_THRESHOLD,
+            'indexed': len(_index)}
+
+metrics.register_gauge("letters.reuse", reuse_hit_rate)
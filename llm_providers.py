@@ -0,0 +1,511 @@
+"""
+LLM Provider Registry & Router
+Tracks rolling latency, error rate and token throughput per provider/model and picks
+the backend for each call (latency budget, degraded backends, extra local endpoints)
+"""
+
+import os
+import json
+import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import requests
+from dotenv import load_dotenv
+
+import metrics
+from provider_health import get_breaker, register_probe, http_probe
+from http_clients import get_session, get_openai_client
+from prompts import record_prompt_usage
+
+load_dotenv()
+
+STATS_WINDOW = int(os.getenv("LLM_STATS_WINDOW", "100"))  # Calls kept per provider
+DEGRADED_ERROR_RATE = float(os.getenv("LLM_DEGRADED_ERROR_RATE", "0.5"))
+DEGRADED_MIN_SAMPLES = 5
+DEFAULT_LATENCY_BUDGET = float(os.getenv("LLM_LATENCY_BUDGET_SECONDS", "0")) or None
+
+# Hedged requests (off by default): duplicate slow calls to the next provider
+HEDGING_ENABLED = os.getenv("LLM_HEDGING", "0") == "1"
+HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", "95"))
+HEDGE_DEFAULT_DELAY = float(os.getenv("LLM_HEDGE_DEFAULT_DELAY_SECONDS", "15"))
+HEDGE_MAX_RATIO = float(os.getenv("LLM_HEDGE_MAX_RATIO", "0.1"))  # Max share of calls that get hedged
+HEDGE_WORKERS = int(os.getenv("LLM_HEDGE_WORKERS", "8"))
+
+OLLAMA_BASE_URL = os.getenv("OLLAMA_BASE_URL", "http://localhost:11434").rstrip("/")
+OLLAMA_CONNECT_TIMEOUT = float(os.getenv("OLLAMA_CONNECT_TIMEOUT", "2"))
+OLLAMA_READ_TIMEOUT = float(os.getenv("OLLAMA_READ_TIMEOUT", "60"))
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "30m")  # Keep the model (and its prompt cache) loaded
+
+class ProviderUnavailable(Exception):
+    """Raised when a provider's circuit is open or it isn't configured"""
+
+
+class CompletionCancelled(Exception):
+    """Raised when an in-flight completion is abandoned (e.g. the losing side of a hedge)"""
+
+
+class ProviderStats:
+    """Rolling window of call outcomes for one provider/model"""
+
+    def __init__(self, window=STATS_WINDOW):
+        self._calls = deque(maxlen=window)  # (latency_seconds, ok, completion_tokens)
+        self._lock = threading.Lock()
+
+    def record(self, latency, ok, tokens=0):
+        with self._lock:
+            self._calls.append((latency, ok, tokens or 0))
+
+    def latency_percentile(self, pct):
+        with self._lock:
+            latencies = [latency for latency, ok, _ in self._calls if ok]
+        return metrics.percentile(latencies, pct)
+
+    def error_rate(self):
+        with self._lock:
+            calls = list(self._calls)
+        if not calls:
+            return 0.0
+        return sum(1 for _, ok, _ in calls if not ok) / len(calls)
+
+    def sample_count(self):
+        with self._lock:
+            return len(self._calls)
+
+    def tokens_per_second(self):
+        with self._lock:
+            ok_calls = [(latency, tokens) for latency, ok, tokens in self._calls if ok and tokens]
+        total_time = sum(latency for latency, _ in ok_calls)
+        return round(sum(tokens for _, tokens in ok_calls) / total_time, 2) if total_time else None
+
+    def snapshot(self):
+        p50, p95, p99 = (self.latency_percentile(p) for p in (50, 95, 99))
+        return {
+            'samples': self.sample_count(),
+            'p50_seconds': round(p50, 3) if p50 is not None else None,
+            'p95_seconds': round(p95, 3) if p95 is not None else None,
+            'p99_seconds': round(p99, 3) if p99 is not None else None,
+            'error_rate': round(self.error_rate(), 3),
+            'tokens_per_second': self.tokens_per_second()
+        }
+
+
+class LLMProvider:
+    """Base provider: breaker gating, timing and stats around a backend-specific _complete()"""
+
+    kind = None
+
+    def __init__(self, model, tier="standard", priority=0, name=None):
+        self.model = model
+        self.tier = tier
+        self.priority = priority  # Lower = preferred when several meet the budget (cost/locality)
+        self.name = name or f"{self.kind}:{model}"
+        self.stats = ProviderStats()
+        self.breaker = get_breaker(self.breaker_name())
+        metrics.register_gauge(f"provider.{self.name}", self.stats.snapshot)
+
+    def breaker_name(self):
+        return self.name
+
+    def is_configured(self):
+        return True
+
+    def is_available(self):
+        return self.is_configured() and self.breaker.is_available()
+
+    def is_degraded(self):
+        return (self.stats.sample_count() >= DEGRADED_MIN_SAMPLES
+                and self.stats.error_rate() >= DEGRADED_ERROR_RATE)
+
+    def complete(self, system, prompt, temperature=0.7, max_tokens=800, cancel=None,
+                 json_schema=None, usage_out=None, prompt_version=None):
+        """
+        Run one completion; returns the text or raises (ProviderUnavailable when fast-failing).
+
+        The backend is read as a stream so a set `cancel` event aborts the request
+        mid-generation (CompletionCancelled) instead of letting it run to the end.
+        json_schema constrains the output to structured JSON; usage_out (dict) receives
+        prompt/completion/cached token counts, time to first token and latency.
+        prompt_version tags the TTFT / cached-token metrics (see prompts.record_prompt_usage).
+        """
+        return "".join(self.stream(system, prompt, temperature, max_tokens, cancel,
+                                   json_schema, usage_out, prompt_version)).strip()
+
+    def stream(self, system, prompt, temperature=0.7, max_tokens=800, cancel=None,
+               json_schema=None, usage_out=None, prompt_version=None):
+        """
+        Yield text chunks as the backend produces them, with the same breaker, stats and
+        metrics accounting as complete(). Closing the generator early (e.g. the browser
+        went away mid-preview) aborts the backend request and counts as a cancellation.
+        """
+        if not self.is_configured():
+            raise ProviderUnavailable(f"{self.name} not configured")
+        if not self.breaker.allow_request():
+            raise ProviderUnavailable(f"{self.name} circuit open")
+
+        started = time.monotonic()
+        usage = {}
+        has_text = False
+        backend = self._stream(system, prompt, temperature, max_tokens, usage, json_schema)
+        try:
+            for chunk in backend:
+                if cancel is not None and cancel.is_set():
+                    raise CompletionCancelled(f"{self.name} cancelled")
+                if 'ttft' not in usage:
+                    usage['ttft'] = time.monotonic() - started
+                has_text = has_text or bool(chunk.strip())
+                yield chunk
+            if not has_text:
+                raise ValueError("empty completion")
+        except (CompletionCancelled, GeneratorExit):
+            self.breaker.release_trial()
+            metrics.incr(f"provider.{self.name}.cancelled")
+            raise
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            # Backend down or hung - open the circuit right away
+            self._record_failure(started, trip=True)
+            raise
+        except Exception:
+            self._record_failure(started)
+            raise
+        finally:
+            backend.close()  # Closes the HTTP response so the backend stops generating
+
+        latency = time.monotonic() - started
+        self.breaker.record_success()
+        self.stats.record(latency, True, usage.get('completion_tokens', 0))
+        metrics.observe(f"provider.{self.name}.latency_seconds", latency)
+        metrics.incr(f"provider.{self.name}.success")
+        metrics.incr(f"provider.{self.name}.prompt_tokens", usage.get('prompt_tokens', 0))
+        metrics.incr(f"provider.{self.name}.completion_tokens", usage.get('completion_tokens', 0))
+        metrics.incr(f"provider.{self.name}.cached_tokens", usage.get('cached_tokens') or 0)
+        if usage.get('ttft') is not None:
+            metrics.observe(f"provider.{self.name}.ttft_seconds", usage['ttft'])
+        record_prompt_usage(prompt_version, usage)
+        if usage_out is not None:
+            usage_out.update(usage, latency=latency, provider=self.name, prompt_version=prompt_version)
+
+    def _record_failure(self, started, trip=False):
+        self.breaker.record_failure(trip=trip)
+        self.stats.record(time.monotonic() - started, False)
+        metrics.incr(f"provider.{self.name}.errors")
+
+    def _stream(self, system, prompt, temperature, max_tokens, usage, json_schema=None):
+        """Yield text chunks as the backend produces them; fill `usage` (prompt/completion/cached_tokens)"""
+        raise NotImplementedError
+
+
+class OllamaProvider(LLMProvider):
+    """Local (or LAN) Ollama endpoint"""
+
+    kind = "ollama"
+
+    def __init__(self, model, base_url=OLLAMA_BASE_URL, **kwargs):
+        self.base_url = base_url.rstrip("/")
+        if self.base_url != OLLAMA_BASE_URL:
+            kwargs.setdefault("name", f"{self.kind}:{model}@{self.base_url}")
+        super().__init__(model, **kwargs)
+        register_probe(self.breaker_name(), http_probe(f"{self.base_url}/api/tags"))
+
+    def breaker_name(self):
+        # One breaker per endpoint - the default endpoint keeps the 'ollama' breaker name
+        return "ollama" if self.base_url == OLLAMA_BASE_URL else f"ollama@{self.base_url}"
+
+    def _stream(self, system, prompt, temperature, max_tokens, usage, json_schema=None):
+        # Prefix reuse relies only on the server's prompt cache: keep_alive keeps the model
+        # loaded, and the identical system prefix is matched against its KV cache. The
+        # returned `context` isn't passed back - it holds the previous prompt and answer,
+        # so replaying it would carry one customer's letter into the next.
+        payload = {
+            "model": self.model,
+            "prompt": prompt,
+            "stream": True,
+            "keep_alive": OLLAMA_KEEP_ALIVE,
+            "options": {
+                "temperature": temperature,
+                "top_p": 0.9,
+                "num_predict": max_tokens  # Limit response length
+            }
+        }
+        if system:
+            payload["system"] = system
+        if json_schema:
+            payload["format"] = json_schema  # Ollama structured outputs
+
+        response = get_session().post(
+            f"{self.base_url}/api/generate",
+            json=payload,
+            stream=True,
+            timeout=(OLLAMA_CONNECT_TIMEOUT, OLLAMA_READ_TIMEOUT)
+        )
+        try:
+            if response.status_code != 200:
+                raise RuntimeError(f"Ollama API error: {response.status_code}")
+
+            # Ollama streams one JSON object per line; the last one has done=true and the stats
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                event = json.loads(line)
+                if event.get("error"):
+                    raise RuntimeError(f"Ollama error: {event['error']}")
+                if event.get("response"):
+                    yield event["response"]
+                if event.get("done"):
+                    usage['prompt_tokens'] = event.get("prompt_eval_count", 0)
+                    usage['completion_tokens'] = event.get("eval_count", 0)
+                    # Ollama reports no cached-token count; prompt eval time drops when the
+                    # static prefix is reused from the loaded model's KV cache
+                    if event.get("prompt_eval_duration") is not None:
+                        usage['prompt_eval_seconds'] = event["prompt_eval_duration"] / 1e9
+                    break
+        finally:
+            response.close()
+
+
+class OpenAIProvider(LLMProvider):
+    """OpenAI chat completions model"""
+
+    kind = "openai"
+
+    def is_configured(self):
+        return bool(os.getenv("OPENAI_API_KEY"))
+
+    def _stream(self, system, prompt, temperature, max_tokens, usage, json_schema=None):
+        client = get_openai_client()
+        if not client:
+            raise ProviderUnavailable("OpenAI client unavailable")
+
+        messages = []
+        if system:
+            messages.append({"role": "system", "content": system})
+        messages.append({"role": "user", "content": prompt})
+
+        extra = {}
+        if json_schema:
+            extra["response_format"] = {
+                "type": "json_schema",
+                "json_schema": {"name": "structured_output", "strict": True, "schema": json_schema}
+            }
+
+        stream = client.chat.completions.create(
+            model=self.model,
+            messages=messages,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            stream=True,
+            stream_options={"include_usage": True},
+            **extra
+        )
+        try:
+            for chunk in stream:
+                if chunk.usage:
+                    usage['prompt_tokens'] = chunk.usage.prompt_tokens
+                    usage['completion_tokens'] = chunk.usage.completion_tokens
+                    details = getattr(chunk.usage, "prompt_tokens_details", None)
+                    usage['cached_tokens'] = getattr(details, "cached_tokens", 0) or 0
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        finally:
+            stream.close()
+
+
+_providers = []
+_providers_lock = threading.Lock()
+_decisions = deque(maxlen=50)
+
+def register_provider(provider):
+    """Add a provider to the registry (e.g. another local model endpoint)"""
+    with _providers_lock:
+        _providers.append(provider)
+    return provider
+
+def get_provider(name):
+    with _providers_lock:
+        return next((p for p in _providers if p.name == name), None)
+
+def get_providers(tier="standard"):
+    with _providers_lock:
+        return [p for p in _providers if p.tier == tier]
+
+def _register_default_providers():
+    # Same order as before routing existed: local Ollama, then gpt-4o-mini; gpt-4 for premium
+    register_provider(OllamaProvider("llama3.2", priority=0))
+    register_provider(OpenAIProvider("gpt-4o-mini", priority=10))
+    register_provider(OpenAIProvider("gpt-4", tier="premium", priority=10))
+
+    # Extra local endpoints: OLLAMA_EXTRA_ENDPOINTS="http://gpu-1:11434|llama3.1:8b,http://gpu-2:11434"
+    for entry in filter(None, (e.strip() for e in os.getenv("OLLAMA_EXTRA_ENDPOINTS", "").split(","))):
+        url, _, model = entry.partition("|")
+        register_provider(OllamaProvider(model or "llama3.2", base_url=url, priority=1))
+
+def route(tier="standard", latency_budget=DEFAULT_LATENCY_BUDGET):
+    """
+    Order the providers of a tier for one call.
+
+    Available, healthy providers whose p95 latency fits the budget come first (by priority,
+    then p95); providers without enough history are treated as fitting so they get explored.
+    Degraded or over-budget providers stay at the end as a last resort.
+    """
+    candidates = [p for p in get_providers(tier) if p.is_available()]
+
+    def fits_budget(provider):
+        if not latency_budget:
+            return True
+        p95 = provider.stats.latency_percentile(95)
+        return p95 is None or p95 <= latency_budget
+
+    def sort_key(provider):
+        p95 = provider.stats.latency_percentile(95)
+        return (provider.is_degraded(), not fits_budget(provider), provider.priority,
+                p95 if p95 is not None else 0.0)
+
+    ordered = sorted(candidates, key=sort_key)
+    _log_decision(tier, latency_budget, ordered)
+    return ordered
+
+def _log_decision(tier, latency_budget, ordered):
+    decision = {
+        'at': time.time(),
+        'tier': tier,
+        'latency_budget': latency_budget,
+        'order': [p.name for p in ordered],
+        'p95': {p.name: p.stats.latency_percentile(95) for p in ordered},
+        'degraded': [p.name for p in ordered if p.is_degraded()]
+    }
+    _decisions.append(decision)
+    if ordered:
+        metrics.incr(f"router.chose.{ordered[0].name}")
+    else:
+        metrics.incr(f"router.no_provider.{tier}")
+    print(f"🧭 [router] tier={tier} budget={latency_budget} order={decision['order']}")
+
+def recent_decisions():
+    return list(_decisions)
+
+def complete_with_routing(build_request, tier="standard", latency_budget=DEFAULT_LATENCY_BUDGET):
+    """
+    Try routed providers in order until one returns text.
+
+    build_request(provider) -> dict of complete() kwargs (system, prompt, temperature,
+    max_tokens) so each backend can get its own wording and limits.
+    Returns (text, provider) or (None, None) if every provider failed or was unavailable.
+    """
+    return _complete_in_order(build_request, route(tier, latency_budget))
+
+class HedgeBudget:
+    """Caps hedged (duplicate) requests to a fraction of recent calls"""
+
+    def __init__(self, max_ratio=HEDGE_MAX_RATIO, window=200):
+        self.max_ratio = max_ratio
+        self._calls = deque(maxlen=window)  # True where the call was hedged
+        self._lock = threading.Lock()
+
+    def record_call(self):
+        """Register a new (not yet hedged) call in the window"""
+        with self._lock:
+            self._calls.append(False)
+
+    def try_spend(self):
+        """Mark the latest call as hedged if that keeps us within the ratio"""
+        with self._lock:
+            if not self._calls:
+                return False
+            hedged = sum(self._calls)
+            if (hedged + 1) / len(self._calls) > self.max_ratio:
+                return False
+            self._calls[-1] = True
+            return True
+
+    def ratio(self):
+        with self._lock:
+            return round(sum(self._calls) / len(self._calls), 3) if self._calls else 0.0
+
+
+hedge_budget = HedgeBudget()
+_hedge_executor = None
+_hedge_executor_pid = None
+_hedge_executor_lock = threading.Lock()
+
+def _get_hedge_executor():
+    """Lazily created (per process) pool that runs the primary and hedge requests"""
+    global _hedge_executor, _hedge_executor_pid
+    with _hedge_executor_lock:
+        if _hedge_executor is None or _hedge_executor_pid != os.getpid():
+            _hedge_executor = ThreadPoolExecutor(max_workers=HEDGE_WORKERS, thread_name_prefix="llm-hedge")
+            _hedge_executor_pid = os.getpid()
+        return _hedge_executor
+
+def hedge_delay(provider):
+    """Seconds to wait on the primary before hedging: its HEDGE_PERCENTILE latency"""
+    if provider.stats.sample_count() < DEGRADED_MIN_SAMPLES:
+        return HEDGE_DEFAULT_DELAY
+    return provider.stats.latency_percentile(HEDGE_PERCENTILE) or HEDGE_DEFAULT_DELAY
+
+def complete_hedged(build_request, tier="standard", latency_budget=DEFAULT_LATENCY_BUDGET):
+    """
+    Like complete_with_routing, but if the primary hasn't answered within its
+    percentile-based delay, send the same request to the next provider and take
+    whichever finishes first; the loser is cancelled. Hedges are capped by hedge_budget.
+    Returns (text, provider) or (None, None).
+    """
+    candidates = route(tier, latency_budget)
+    hedge_budget.record_call()
+    if len(candidates) < 2:
+        return _complete_in_order(build_request, candidates)
+
+    primary, secondary = candidates[0], candidates[1]
+    executor = _get_hedge_executor()
+    cancels = {primary: threading.Event(), secondary: threading.Event()}
+
+    def run(provider):
+        return provider.complete(**build_request(provider), cancel=cancels[provider])
+
+    futures = {executor.submit(run, primary): primary}
+    done, _ = wait(futures, timeout=hedge_delay(primary))
+
+    if not done:
+        if hedge_budget.try_spend():
+            print(f"🪁 [hedge] {primary.name} slow, hedging with {secondary.name}")
+            metrics.incr("hedge.fired")
+            futures[executor.submit(run, secondary)] = secondary
+        else:
+            metrics.incr("hedge.budget_exhausted")
+
+    pending = set(futures)
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            provider = futures[future]
+            try:
+                text = future.result()
+            except Exception as e:
+                if not isinstance(e, CompletionCancelled):
+                    print(f"⚠️  {provider.name} failed: {e}")
+                continue
+
+            # Winner - cancel the other side (aborts its stream, or skips it if not started)
+            for other_future in pending:
+                cancels[futures[other_future]].set()
+                other_future.cancel()
+            if len(futures) > 1:
+                metrics.incr(f"hedge.won_by_{'primary' if provider is primary else 'hedge'}")
+            return text, provider
+
+    # Both racing requests failed - fall back to the remaining providers in order
+    tried = set(futures.values())
+    return _complete_in_order(build_request, [p for p in candidates if p not in tried])
+
+def _complete_in_order(build_request, providers):
+    for provider in providers:
+        try:
+            return provider.complete(**build_request(provider)), provider
+        except ProviderUnavailable as e:
+            print(f"⏭️  {e}")
+        except Exception as e:
+            print(f"⚠️  {provider.name} failed: {e}")
+    return None, None
+
+metrics.register_gauge("hedge.ratio", hedge_budget.ratio)
+metrics.register_gauge("router.recent_decisions", lambda: recent_decisions()[-10:])
+_register_default_providers()
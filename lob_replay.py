@@ -0,0 +1,115 @@
+"""
+Lob Event Replay
+Records Lob webhook events from the lob_events table to a JSONL file, and replays a
+recorded stream against a /webhooks/lob endpoint (a local dev server or staging),
+signed the way Lob signs them. Duplicates and shuffling exercise the dedupe and the
+out-of-order handling.
+
+Usage:
+    python3 lob_replay.py --export events.jsonl [--since 2026-01-01]
+    python3 lob_replay.py events.jsonl [--url http://localhost:5000/webhooks/lob]
+        [--rate 20] [--realtime 60] [--duplicates 0.1] [--shuffle]
+
+--rate: events per second (default: as fast as the endpoint answers)
+--realtime: keep the recorded spacing between events, sped up this many times
+--duplicates: fraction of events sent a second time
+Signing uses LOB_WEBHOOK_SECRET (the same secret the endpoint verifies with).
+"""
+
+import sys
+import json
+import time
+import random
+from datetime import datetime
+from dotenv import load_dotenv
+
+load_dotenv()
+
+def export_events(path, since=None):
+    """Write stored events (oldest first) to a JSONL file; returns how many"""
+    from db import get_db_connection
+
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT payload FROM lob_events
+        WHERE %s::timestamp IS NULL OR received_at >= %s::timestamp
+        ORDER BY occurred_at NULLS LAST, received_at
+    """, (since, since))
+    rows = cur.fetchall()
+    cur.close()
+    conn.close()
+
+    with open(path, "w") as f:
+        for row in rows:
+            f.write(row['payload'] + "\n")
+    print(f"💾 Exported {len(rows)} event(s) to {path}")
+    return len(rows)
+
+def load_events(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def _occurred(event):
+    try:
+        return datetime.fromisoformat(event['date_created'].replace('Z', '+00:00')).timestamp()
+    except (KeyError, AttributeError, ValueError):
+        return None
+
+def replay_events(events, url, rate=0, realtime=0, duplicates=0.0, shuffle=False):
+    """POST each event, freshly signed, to url; returns a count per response status"""
+    import requests
+    from lob_webhooks import LOB_WEBHOOK_SECRET, sign
+
+    if not LOB_WEBHOOK_SECRET:
+        raise SystemExit("LOB_WEBHOOK_SECRET is not set")
+    events = list(events)
+    events += [event for event in events if random.random() < duplicates]
+    if shuffle:
+        random.shuffle(events)
+
+    session = requests.Session()
+    results = {}
+    started = time.perf_counter()
+    previous = None
+    for event in events:
+        occurred = _occurred(event)
+        if realtime and previous is not None and occurred is not None:
+            time.sleep(max(0, occurred - previous) / realtime)
+        elif rate:
+            time.sleep(1 / rate)
+        previous = occurred if occurred is not None else previous
+
+        body = json.dumps(event)
+        timestamp = str(int(time.time() * 1000))
+        response = session.post(url, data=body, headers={
+            'Content-Type': 'application/json',
+            'Lob-Signature-Timestamp': timestamp,
+            'Lob-Signature': sign(body, timestamp)
+        }, timeout=30)
+        results[response.status_code] = results.get(response.status_code, 0) + 1
+        if response.status_code != 200:
+            print(f"⚠️ {event.get('id')}: {response.status_code} {response.text[:200]}")
+
+    elapsed = time.perf_counter() - started
+    print(f"📨 Replayed {len(events)} event(s) in {elapsed:.1f}s: {results}")
+    return results
+
+def _arg(name, default=None):
+    """Value after a --name flag on the command line"""
+    if name in sys.argv and sys.argv.index(name) + 1 < len(sys.argv):
+        return sys.argv[sys.argv.index(name) + 1]
+    return default
+
+if __name__ == "__main__":
+    if "--export" in sys.argv:
+        export_events(_arg("--export"), since=_arg("--since"))
+    elif len(sys.argv) > 1 and not sys.argv[1].startswith("--"):
+        replay_events(load_events(sys.argv[1]),
+                      _arg("--url", "http://localhost:5000/webhooks/lob"),
+                      rate=float(_arg("--rate", 0)),
+                      realtime=float(_arg("--realtime", 0)),
+                      duplicates=float(_arg("--duplicates", 0)),
+                      shuffle="--shuffle" in sys.argv)
+    else:
+        print(__doc__)
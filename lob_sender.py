@@ -0,0 +1,172 @@
+"""
+Concurrent Lob Sender
+Submits letters to Lob from a thread pool, paced by a token bucket matched to Lob's
+API rate limit, retrying rate-limited (429) and server-error (5xx) responses with
+jittered exponential backoff. A mailing day is bounded by the rate limit instead of
+one upload's latency after another.
+"""
+
+import os
+import json
+import time
+import random
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from dotenv import load_dotenv
+
+import metrics
+
+load_dotenv()
+
+# Lob allows 150 requests per 5 seconds per endpoint; stay a little under it by default
+LOB_RATE_PER_SECOND = float(os.getenv("LOB_RATE_PER_SECOND", "25"))
+LOB_RATE_BURST = int(os.getenv("LOB_RATE_BURST", "50"))
+LOB_SEND_CONCURRENCY = int(os.getenv("LOB_SEND_CONCURRENCY", "8"))
+LOB_SEND_RETRIES = int(os.getenv("LOB_SEND_RETRIES", "4"))
+LOB_BACKOFF_BASE = float(os.getenv("LOB_BACKOFF_BASE", "0.5"))  # Seconds, doubled per attempt
+LOB_BACKOFF_MAX = float(os.getenv("LOB_BACKOFF_MAX", "20"))
+# Spend estimate for the lob.* metrics - set these to your Lob plan's prices
+LOB_COST_PER_LETTER = float(os.getenv("LOB_COST_PER_LETTER", "0.90"))  # Envelope, first page, postage
+LOB_COST_PER_EXTRA_PAGE = float(os.getenv("LOB_COST_PER_EXTRA_PAGE", "0.10"))
+
+class TokenBucket:
+    """Thread-safe token bucket: acquire() blocks until a request may be made"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.capacity = max(1, burst)
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Take one token; returns the seconds spent waiting"""
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return waited
+                delay = (1 - self._tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
+_bucket = TokenBucket(LOB_RATE_PER_SECOND, LOB_RATE_BURST)
+
+def is_retryable(error, idempotent=False):
+    """
+    Rate limited or a Lob-side failure (the request can be made again). With an
+    idempotency key, timeouts/dropped connections and unparseable error pages are
+    retried too - Lob won't create the letter twice.
+    """
+    import requests
+    from lob.error import APIConnectionError, LobError
+
+    if isinstance(error, APIConnectionError):
+        return True
+    if idempotent and isinstance(error, (requests.RequestException, ValueError)):
+        return True
+    status = getattr(error, 'http_status', None) if isinstance(error, LobError) else None
+    return status is not None and (status == 429 or status >= 500)
+
+def backoff_delay(attempt):
+    """Full-jitter exponential backoff for the given retry (1-based)"""
+    return random.uniform(0, min(LOB_BACKOFF_MAX, LOB_BACKOFF_BASE * 2 ** (attempt - 1)))
+
+def estimated_cost(pages):
+    """Estimated price of one letter of this many pages"""
+    return LOB_COST_PER_LETTER + LOB_COST_PER_EXTRA_PAGE * max(0, pages - 1)
+
+def _record_spend(pdf, merge_variables=None):
+    """
+    Bytes uploaded, pages and estimated spend of an accepted letter. A template letter
+    isn't rendered here, so it counts one page per section (Lob bills what it prints).
+    """
+    from pdf_engine import pdf_page_count
+    if merge_variables is not None:
+        pages = len(merge_variables['sections'])
+        uploaded = len(json.dumps(merge_variables))
+    elif isinstance(pdf, (bytes, bytearray)):
+        pages = pdf_page_count(pdf)
+        uploaded = len(pdf)
+    else:
+        return {}
+    spend = {'bytes': uploaded, 'pages': pages, 'cost': estimated_cost(pages)}
+    metrics.incr("lob.letters")
+    metrics.incr("lob.bytes_uploaded", spend['bytes'])
+    metrics.incr("lob.pages", pages)
+    metrics.incr("lob.estimated_cost", spend['cost'])
+    return spend
+
+def send_with_retries(pdf, bureau, description, retries=LOB_SEND_RETRIES, idempotency_key=None,
+                      template_id=None, merge_variables=None):
+    """
+    Create one Lob letter, retrying 429/5xx. pdf may be bytes, a path, or a Future
+    resolving to either (e.g. from the PDF render pool); or, with template_id, the letter
+    is created from that Lob template and merge_variables instead (pdf is ignored).
+    Returns {'tracking_id', 'error', 'attempts'} (plus 'bytes', 'pages' and 'cost' for
+    an accepted in-memory PDF or template letter) - never raises.
+    """
+    from mailer import create_letter, create_template_letter
+
+    attempts = 0
+    try:
+        if isinstance(pdf, Future):
+            pdf = pdf.result()
+        while True:
+            attempts += 1
+            metrics.observe("lob.rate_wait_seconds", _bucket.acquire())
+            started = time.perf_counter()
+            try:
+                if template_id:
+                    response = create_template_letter(template_id, merge_variables, bureau,
+                                                      description, idempotency_key)
+                else:
+                    response = create_letter(pdf, bureau, description, idempotency_key)
+                metrics.observe("lob.send_seconds", time.perf_counter() - started)
+                metrics.incr("lob.send.ok")
+                print(f"✅ {bureau.title()} letter sent: {response['id']}")
+                return {'tracking_id': response['id'], 'error': None, 'attempts': attempts,
+                        **_record_spend(pdf, merge_variables if template_id else None)}
+            except Exception as e:
+                if attempts > retries or not is_retryable(e, idempotent=bool(idempotency_key)):
+                    raise
+                delay = backoff_delay(attempts)
+                metrics.incr("lob.send.retries")
+                print(f"⏳ Lob {getattr(e, 'http_status', 'error')} for {description} - retry {attempts} in {delay:.1f}s")
+                time.sleep(delay)
+    except Exception as e:
+        metrics.incr("lob.send.failed")
+        print(f"❌ Failed to send {bureau.title()} letter: {e}")
+        return {'tracking_id': None, 'error': str(e), 'attempts': attempts}
+
+def _send_job(job, on_sent):
+    outcome = {**job, **send_with_retries(job['pdf'], job['bureau'], job['description'],
+                                          idempotency_key=job.get('idempotency_key'))}
+    if on_sent and outcome['tracking_id']:
+        on_sent(outcome)
+    return outcome
+
+def send_letters(jobs, concurrency=LOB_SEND_CONCURRENCY, on_sent=None):
+    """
+    Send many letters concurrently. jobs: dicts with 'pdf', 'bureau', 'description',
+    optionally 'idempotency_key' (plus any keys the caller wants back). Returns one
+    outcome per job, in order: the job's keys plus 'tracking_id', 'error' and 'attempts'.
+    on_sent(outcome) is called from the sending thread as soon as a letter is accepted.
+    """
+    jobs = list(jobs)
+    if not jobs:
+        return []
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(jobs))),
+                            thread_name_prefix="lob-send") as pool:
+        futures = [pool.submit(_send_job, job, on_sent) for job in jobs]
+        outcomes = [future.result() for future in futures]
+    elapsed = time.perf_counter() - started
+    sent = sum(1 for outcome in outcomes if outcome['tracking_id'])
+    print(f"📬 Sent {sent}/{len(jobs)} letter(s) in {elapsed:.1f}s ({len(jobs) / elapsed:.1f}/s)")
+    return outcomes
@@ -0,0 +1,333 @@
+"""
+Lob Stand-in
+A local stand-in for the parts of the Lob API the batch sender uses: template
+registration, letter creation (uploaded PDF, or template + merge variables, honoring
+Idempotency-Key) and letter retrieval. Template letters are rendered here from their
+merge variables, and every letter keeps the text it would print, so a batch sent in
+pdf mode and again in template mode can be compared letter by letter.
+
+Usage:
+    python3 lob_standin.py [--port 8100]
+        then run the app or batch with LOB_API_BASE=http://localhost:8100/v1
+    python3 lob_standin.py --parity [letter.txt ...] [--from-db 100]
+
+--parity: render each letter both ways (pdf_engine PDF, and the Lob template with its
+merge variables) and check they print the same text; with no files, checks the
+sample letters below, or the newest saved letters with --from-db.
+"""
+
+import io
+import re
+import sys
+import json
+import uuid
+import threading
+from html import escape, unescape
+from html.parser import HTMLParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+SAMPLE_LETTERS = [
+    "Dear Experian,\n\nI am writing to dispute the AT&T account (#1234) reported as \"late\" <30 days>.\n"
+    "Account: AT&T Mobility\nBalance: $1,250.00\n\n" + "This information is inaccurate and must be "
+    "investigated under the FCRA. " * 25 + "\n\nSincerely,",
+    "To whom it may concern,\n\nPlease remove the collection account below.\n\n\n\nThank you.",
+]
+
+# --- Rendering ----------------------------------------------------------------------
+
+_BLOCK = re.compile(r"\{\{#(each|if) (\w+)\}\}|\{\{/(each|if)\}\}")
+_VALUE = re.compile(r"\{\{\{\s*([\w.]+)\s*\}\}\}|\{\{\s*([\w.]+)\s*\}\}")
+
+def _lookup(name, context):
+    if name == "this":
+        return context[-1]
+    for scope in reversed(context):
+        if isinstance(scope, dict) and name in scope:
+            return scope[name]
+    return ""
+
+def _block_end(html, start, kind):
+    """Index of the {{/kind}} closing the block opened just before start, and its length"""
+    depth = 1
+    for match in _BLOCK.finditer(html, start):
+        if match.group(1) == kind:
+            depth += 1
+        elif match.group(3) == kind:
+            depth -= 1
+            if depth == 0:
+                return match.start(), match.end()
+    raise ValueError(f"unclosed {{{{#{kind}}}}}")
+
+def _render(html, context):
+    out = []
+    position = 0
+    while True:
+        match = _BLOCK.search(html, position)
+        if match is None or not match.group(1):
+            if match is not None:
+                raise ValueError(f"unexpected {match.group(0)}")
+            out.append(_values(html[position:], context))
+            return "".join(out)
+        out.append(_values(html[position:match.start()], context))
+        kind, name = match.group(1), match.group(2)
+        end, after = _block_end(html, match.end(), kind)
+        body = html[match.end():end]
+        value = _lookup(name, context)
+        if kind == "each":
+            out.extend(_render(body, context + [item]) for item in value or [])
+        elif value:
+            out.append(_render(body, context))
+        position = after
+
+def _values(html, context):
+    def value(match):
+        if match.group(1):
+            return str(_lookup(match.group(1), context))
+        return escape(str(_lookup(match.group(2), context)))
+    return _VALUE.sub(value, html)
+
+def render_template(html, merge_variables):
+    """
+    Fill in a Lob HTML template: the Handlebars subset the letter template uses
+    ({{name}} escaped, {{{name}}} raw, {{#each}}, {{#if}}, {{this}})
+    """
+    return _render(html, [merge_variables or {}])
+
+class _TextParser(HTMLParser):
+    """Visible text of an HTML page, one line per block element"""
+    BREAKS = {'p', 'div', 'span', 'br', 'li', 'tr', 'h1', 'h2', 'h3'}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self.hidden = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in ('style', 'head', 'script'):
+            self.hidden += 1
+        elif tag in self.BREAKS:
+            self.parts.append("\n")
+
+    def handle_endtag(self, tag):
+        if tag in ('style', 'head', 'script'):
+            self.hidden -= 1
+        elif tag in self.BREAKS:
+            self.parts.append("\n")
+
+    def handle_data(self, data):
+        if not self.hidden:
+            self.parts.append(data)
+
+def html_text(html):
+    parser = _TextParser()
+    parser.feed(html)
+    parser.close()
+    return re.sub(r"\n\s*\n+", "\n", "".join(parser.parts)).strip()
+
+def pdf_text(data):
+    from PyPDF2 import PdfReader
+    return "\n".join(page.extract_text() for page in PdfReader(io.BytesIO(data)).pages).strip()
+
+def _printed(text):
+    """Text as printed, ignoring line wrapping"""
+    return "".join(unescape(text).split())
+
+def compare_text(expected, actual):
+    """None if both print the same text, else a short description of the first difference"""
+    expected, actual = _printed(expected), _printed(actual)
+    if expected == actual:
+        return None
+    at = next((i for i, (a, b) in enumerate(zip(expected, actual)) if a != b), min(len(expected), len(actual)))
+    return f"differs at {at}: {expected[max(0, at - 30):at + 30]!r} vs {actual[max(0, at - 30):at + 30]!r}"
+
+def check_parity(texts):
+    """
+    Render one letter (a text, or a list of sections) as the PDF we upload and as Lob
+    would fill in the template; None if they print the same text, else the difference
+    """
+    from pdf_engine import get_pdf_engine
+    from lob_templates import template_html, merge_variables
+
+    out = io.BytesIO()
+    get_pdf_engine().render(texts, out)
+    rendered = html_text(render_template(template_html(), merge_variables(texts)))
+    return compare_text(pdf_text(out.getvalue()), rendered)
+
+# --- Server -------------------------------------------------------------------------
+
+class StandInLob(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address):
+        super().__init__(address, _Handler)
+        self.lock = threading.Lock()
+        self.templates = {}  # id -> template
+        self.letters = {}  # id -> letter (with the text it would print)
+        self.idempotent = {}  # Idempotency-Key -> letter id
+        self.requests = []  # (method, path, request bytes)
+
+    def create_template(self, form):
+        template_id = f"tmpl_{uuid.uuid4().hex[:20]}"
+        template = {'id': template_id, 'object': 'template', 'description': form.get('description'),
+                    'published_version': {'id': f"vrsn_{uuid.uuid4().hex[:20]}", 'html': form['html']}}
+        with self.lock:
+            self.templates[template_id] = template
+        return template
+
+    def create_letter(self, form, pdf, key):
+        with self.lock:
+            if key in self.idempotent:
+                return self.letters[self.idempotent[key]]
+        letter = {'id': f"ltr_{uuid.uuid4().hex[:20]}", 'object': 'letter',
+                  'description': form.get('description'), 'to': form.get('to'), 'from': form.get('from'),
+                  'tracking_events': [], 'deleted': False}
+        if pdf is not None:
+            letter.update(source='pdf', text=pdf_text(pdf))
+        else:
+            template = self.templates.get(form.get('file'))
+            if template is None:
+                raise LookupError(f"template {form.get('file')} not found")
+            variables = json.loads(form.get('merge_variables') or '{}')
+            html = render_template(template['published_version']['html'], variables)
+            letter.update(source='template', template_id=template['id'], merge_variables=variables,
+                          text=html_text(html))
+        with self.lock:
+            self.letters[letter['id']] = letter
+            if key:
+                self.idempotent[key] = letter['id']
+        return letter
+
+def _form_fields(handler, body):
+    """Fields of a urlencoded or multipart body (to[name] style keys nested), plus any uploaded file"""
+    from email.parser import BytesParser
+    from email.policy import HTTP
+
+    content_type = handler.headers.get('Content-Type', '')
+    fields, upload = {}, None
+    if content_type.startswith('multipart/form-data'):
+        message = BytesParser(policy=HTTP).parsebytes(
+            f"Content-Type: {content_type}\r\n\r\n".encode() + body)
+        for part in message.iter_parts():
+            name = part.get_param('name', header='content-disposition')
+            if part.get_filename():
+                upload = part.get_payload(decode=True)
+            else:
+                fields[name] = part.get_payload(decode=True).decode()
+    else:
+        fields = {name: values[0] for name, values in parse_qs(body.decode(), keep_blank_values=True).items()}
+
+    nested = {}
+    for name, value in fields.items():
+        match = re.fullmatch(r"(\w+)\[(\w+)\]", name)
+        if match:
+            nested.setdefault(match.group(1), {})[match.group(2)] = value
+        else:
+            nested[name] = value
+    return nested, upload
+
+class _Handler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _error(self, status, message):
+        self._reply(status, {'error': {'message': message, 'status_code': status}})
+
+    def do_GET(self):
+        match = re.fullmatch(r"/v1/(letters|templates)/(\w+)", self.path)
+        store = getattr(self.server, match.group(1)) if match else {}
+        item = store.get(match.group(2)) if match else None
+        if item is None:
+            return self._error(404, "not found")
+        self._reply(200, item)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        with self.server.lock:
+            self.server.requests.append(('POST', self.path, len(body)))
+        form, upload = _form_fields(self, body)
+        try:
+            if self.path == "/v1/templates":
+                if not form.get('html'):
+                    return self._error(422, "html is required")
+                return self._reply(200, self.server.create_template(form))
+            if self.path == "/v1/letters":
+                if not form.get('to') or not form.get('from') or (upload is None and not form.get('file')):
+                    return self._error(422, "to, from and file are required")
+                return self._reply(200, self.server.create_letter(form, upload, self.headers.get('Idempotency-Key')))
+        except LookupError as e:
+            return self._error(404, str(e))
+        except Exception as e:
+            return self._error(422, str(e))
+        self._error(404, "not found")
+
+def serve(port=8100):
+    """Start the stand-in on a background thread; returns the server"""
+    server = StandInLob(("127.0.0.1", port))
+    threading.Thread(target=server.serve_forever, name="lob-standin", daemon=True).start()
+    return server
+
+# --- Command line -------------------------------------------------------------------
+
+def _saved_letters(limit):
+    from db import get_db_connection
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT id, letter_text FROM disputes
+        WHERE letter_text IS NOT NULL
+        ORDER BY letter_generated_at DESC NULLS LAST
+        LIMIT %s
+    """, (limit,))
+    rows = cur.fetchall()
+    cur.close()
+    conn.close()
+    return [(f"dispute {row['id']}", row['letter_text']) for row in rows]
+
+def run_parity(letters):
+    """Check each (name, text) letter, plus all of them as one consolidated letter"""
+    letters = list(letters)
+    if len(letters) > 1:
+        letters.append((f"{len(letters)} letters consolidated", [text for _, text in letters]))
+    failed = 0
+    for name, texts in letters:
+        difference = check_parity(texts)
+        if difference:
+            failed += 1
+            print(f"❌ {name}: {difference}")
+        else:
+            print(f"✅ {name}")
+    print(f"🧾 Parity: {len(letters) - failed}/{len(letters)} letter(s) print the same text")
+    return failed == 0
+
+def _arg(name, default=None):
+    """Value after a --name flag on the command line"""
+    if name in sys.argv and sys.argv.index(name) + 1 < len(sys.argv):
+        return sys.argv[sys.argv.index(name) + 1]
+    return default
+
+if __name__ == "__main__":
+    if "--parity" in sys.argv:
+        files = [arg for arg in sys.argv[sys.argv.index("--parity") + 1:] if not arg.startswith("--")]
+        if _arg("--from-db"):
+            letters = _saved_letters(int(_arg("--from-db")))
+        elif files:
+            letters = [(path, open(path).read()) for path in files]
+        else:
+            letters = [(f"sample {number}", text) for number, text in enumerate(SAMPLE_LETTERS, 1)]
+        sys.exit(0 if run_parity(letters) else 1)
+    elif "--help" in sys.argv:
+        print(__doc__)
+    else:
+        port = int(_arg("--port", 8100))
+        serve(port)
+        print(f"📮 Lob stand-in on http://localhost:{port}/v1 (Ctrl+C to stop)")
+        threading.Event().wait()
@@ -0,0 +1,136 @@
+"""
+Lob Letter Templates
+Template send mode (LOB_SEND_MODE=template): the letter layout is registered with Lob
+once as an HTML template, and each letter is created from it with only its text as
+merge variables - a few KB of JSON instead of an uploaded PDF, and nothing to render
+before the send. The HTML mirrors pdf_engine's layout; changing it makes a new
+version, registered as a new Lob template, so letters already created keep the layout
+they were mailed with. lob_standin.py checks both modes print the same text.
+"""
+
+import os
+import json
+import hashlib
+import threading
+from dotenv import load_dotenv
+
+import metrics
+from pdf_engine import letter_paragraphs
+
+load_dotenv()
+
+LOB_SEND_MODE = os.getenv("LOB_SEND_MODE", "pdf")  # pdf | template
+# Letters whose merge variables are larger than this are sent as PDFs instead
+LOB_MERGE_VARIABLES_MAX_BYTES = int(os.getenv("LOB_MERGE_VARIABLES_MAX_BYTES", "25000"))
+TEMPLATE_NAME = "dispute-letter"
+
+# Same page, margins, type and spacing as pdf_engine.LetterPdfEngine (points: 72 = 1in)
+TEMPLATE_HTML = """<html>
+<head>
+<meta charset="UTF-8">
+<style>
+  @page { size: 8.5in 11in; margin: 0; }
+  body { margin: 0; font-family: Helvetica, Arial, sans-serif; font-size: 11pt; line-height: 14pt; }
+  .page { padding: 72pt 72pt 18pt 72pt; }
+  .section + .section { page-break-before: always; }
+  p { margin: 0 0 13.2pt 0; }
+  .line { display: block; min-height: 14pt; white-space: pre-wrap; }
+</style>
+</head>
+<body>
+<div class="page">
+{{#each sections}}
+<div class="section">
+{{#each paragraphs}}<p>{{#each lines}}<span class="line">{{this}}</span>{{/each}}</p>{{/each}}
+</div>
+{{/each}}
+</div>
+</body>
+</html>
+"""
+
+_lock = threading.Lock()
+_template_ids = {}  # (api_base, version) -> Lob template id, for this process
+
+def template_html():
+    """The letter template (Lob fills in the merge variables)"""
+    return TEMPLATE_HTML
+
+def template_version(html=None):
+    """Content hash of the template: a new layout is a new version"""
+    return hashlib.sha256((html or template_html()).encode()).hexdigest()[:12]
+
+def merge_variables(texts):
+    """Merge variables for one letter: a letter text, or a list of them (one section each)"""
+    if isinstance(texts, str):
+        texts = [texts]
+    return {'sections': [{'paragraphs': [{'lines': lines} for lines in letter_paragraphs(text)]}
+                         for text in texts]}
+
+def template_letter(texts):
+    """Merge variables for the letter, or None if it's too large to send that way"""
+    variables = merge_variables(texts)
+    if len(json.dumps(variables)) > LOB_MERGE_VARIABLES_MAX_BYTES:
+        metrics.incr("lob_templates.too_large")
+        return None
+    return variables
+
+def _stored_template_id(api_base, version):
+    from db import get_db_connection
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute("SELECT template_id FROM lob_templates WHERE api_base = %s AND version = %s", (api_base, version))
+    row = cur.fetchone()
+    cur.close()
+    conn.close()
+    return row['template_id'] if row else None
+
+def _save_template_id(api_base, version, template_id):
+    """Store the id, or return the one another process stored first"""
+    from db import get_db_connection
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute("""
+        INSERT INTO lob_templates (api_base, version, template_id, name) VALUES (%s, %s, %s, %s)
+        ON CONFLICT (api_base, version) DO UPDATE SET version = EXCLUDED.version
+        RETURNING template_id
+    """, (api_base, version, template_id, TEMPLATE_NAME))
+    template_id = cur.fetchone()['template_id']
+    conn.commit()
+    cur.close()
+    conn.close()
+    return template_id
+
+def register_template(html, version):
+    """Create the template with Lob; returns its id"""
+    from http_clients import get_session, lob_config
+
+    lob = lob_config()
+    response = get_session().post(f"{lob.api_base}/templates", auth=(lob.api_key, ''), data={
+        'description': f"{TEMPLATE_NAME} {version}",
+        'html': html
+    })
+    response.raise_for_status()
+    metrics.incr("lob_templates.registered")
+    print(f"🧾 Registered Lob template {TEMPLATE_NAME} {version}: {response.json()['id']}")
+    return response.json()['id']
+
+def ensure_template():
+    """
+    Lob template id for the current template version, registered with Lob the first
+    time any process needs it (looked up in lob_templates after that). Ids are per API
+    base: a template registered with the stand-in or a test account doesn't exist live.
+    """
+    from http_clients import lob_config
+
+    api_base = lob_config().api_base
+    html = template_html()
+    version = template_version(html)
+    with _lock:
+        template_id = _template_ids.get((api_base, version))
+        if template_id is None:
+            template_id = _stored_template_id(api_base, version)
+            if template_id is None:
+                template_id = _save_template_id(api_base, version, register_template(html, version))
+            _template_ids[api_base, version] = template_id
+        return template_id
@@ -0,0 +1,248 @@
+"""
+Lob Webhooks
+Letter tracking events pushed by Lob to POST /webhooks/lob replace polling every open
+letter. Each event is verified (HMAC-SHA256 of "<timestamp>.<body>" with the webhook
+secret), stored once per event id, and applied to disputes in batches by a background
+thread. tracker.check_lob_status only polls letters webhooks have gone quiet on.
+"""
+
+import os
+import hmac
+import json
+import time
+import hashlib
+import threading
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+from psycopg2.extras import execute_values
+
+import metrics
+from db import get_db_connection, BUREAU_RESPONSE_DAYS
+
+load_dotenv()
+
+LOB_WEBHOOK_SECRET = os.getenv("LOB_WEBHOOK_SECRET")
+LOB_WEBHOOK_TOLERANCE_SECONDS = int(os.getenv("LOB_WEBHOOK_TOLERANCE_SECONDS", "300"))  # Replay window
+LOB_WEBHOOK_BATCH_SECONDS = float(os.getenv("LOB_WEBHOOK_BATCH_SECONDS", "2"))  # Gather events this long
+LOB_WEBHOOK_BATCH_SIZE = 500  # Events applied per transaction
+# Letters webhooks are reporting on aren't polled until they've been quiet this long
+LOB_RECONCILE_AFTER_HOURS = int(os.getenv("LOB_RECONCILE_AFTER_HOURS", "24"))
+
+# Lob tracking event (webhook event type or a letter's tracking_events name) -> dispute status
+STATUS_BY_EVENT = {
+    'mailed': 'in_transit',
+    'in_transit': 'in_transit',
+    'in_local_area': 'in_transit',
+    're_routed': 'in_transit',
+    'pickup_available': 'in_transit',
+    'processed_for_delivery': 'delivered',
+    'delivered': 'delivered',
+    'returned_to_sender': 'returned_to_sender',
+    'deleted': 'cancelled'
+}
+
+# Statuses only move forward (events can arrive late or out of order)
+STATUS_RANK = {'queued': 0, 'sent': 0, 'in_transit': 1, 'delivered': 2,
+               'returned_to_sender': 3, 'cancelled': 3, 'invalid_tracking_id': 3}
+_RANK_SQL = ("CASE d.status " + " ".join(f"WHEN '{status}' THEN {rank}"
+                                         for status, rank in STATUS_RANK.items()) + " END")
+
+_lock = threading.Lock()
+_applier = None
+_applier_pid = None
+_apply_scheduled = False
+
+def letter_status(event_name):
+    """Dispute status for a Lob event ('letter.in_transit', 'letter.certified.delivered',
+    'In Local Area'...), or None for events that don't change it (created, rendered...)"""
+    name = (event_name or '').lower()
+    for prefix in ('letter.', 'certified.'):
+        if name.startswith(prefix):
+            name = name[len(prefix):]
+    return STATUS_BY_EVENT.get(name.replace('-', '_').replace(' ', '_'))
+
+def _timestamp_seconds(timestamp):
+    """Lob-Signature-Timestamp as epoch seconds (sent as epoch ms or an ISO date)"""
+    try:
+        value = float(timestamp)
+        return value / 1000 if value > 1e11 else value
+    except (TypeError, ValueError):
+        return datetime.fromisoformat(timestamp.replace('Z', '+00:00')).timestamp()
+
+def sign(body, timestamp, secret=None):
+    """Hex HMAC-SHA256 Lob puts in Lob-Signature (also used by lob_replay)"""
+    secret = secret or LOB_WEBHOOK_SECRET
+    if isinstance(body, str):
+        body = body.encode()
+    return hmac.new(secret.encode(), f"{timestamp}.".encode() + body, hashlib.sha256).hexdigest()
+
+def verify_signature(body, timestamp, signature, secret=None):
+    """True if the request was signed with our webhook secret within the tolerance window"""
+    secret = secret or LOB_WEBHOOK_SECRET
+    if not secret or not timestamp or not signature:
+        return False
+    try:
+        age = abs(time.time() - _timestamp_seconds(timestamp))
+    except (AttributeError, ValueError):
+        return False
+    if age > LOB_WEBHOOK_TOLERANCE_SECONDS:
+        return False
+    return hmac.compare_digest(sign(body, timestamp, secret), signature)
+
+def utc_naive(value):
+    """An ISO string or aware datetime as naive UTC (how disputes store timestamps)"""
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if value is not None and value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+def apply_letter_statuses(cur, rows, match_on='tracking_id'):
+    """
+    Write letter statuses in one set-based statement on the caller's transaction, with a
+    dispute_history row per change. rows: (tracking_id, or dispute id with match_on='id';
+    new status; when it happened, naive UTC or None for now; history note).
+    Only forward moves are applied (see STATUS_RANK); reaching 'delivered' starts the
+    bureau's response clock. Returns the number of disputes changed.
+    """
+    if not rows:
+        return 0
+    key = {'tracking_id': 'd.tracking_id', 'id': 'd.id'}[match_on]
+    execute_values(cur, f"""
+        WITH changes AS (
+            SELECT d.id, d.status AS old_status, v.status AS new_status, v.occurred_at, v.note
+            FROM disputes d
+            JOIN (VALUES %s) AS v (ref, status, rank, occurred_at, note) ON {key} = v.ref
+            WHERE v.rank > {_RANK_SQL}
+            FOR UPDATE OF d
+        ), updated AS (
+            UPDATE disputes AS d
+            SET status = c.new_status,
+                expected_response_date = CASE WHEN c.new_status = 'delivered'
+                    THEN COALESCE(c.occurred_at, LOCALTIMESTAMP) + INTERVAL '{BUREAU_RESPONSE_DAYS} days'
+                    ELSE d.expected_response_date END
+            FROM changes c
+            WHERE d.id = c.id
+        )
+        INSERT INTO dispute_history (dispute_id, action, old_status, new_status, notes)
+        SELECT id, 'status_change', old_status, new_status, note
+        FROM changes
+    """, [(key_value, status, STATUS_RANK[status], occurred_at, note)
+          for key_value, status, occurred_at, note in rows],
+        template="(%s, %s, %s::integer, %s::timestamp, %s)", page_size=len(rows))
+    return cur.rowcount
+
+def ingest_events(events):
+    """Store letter events, skipping ids already seen; returns the number that were new"""
+    rows = []
+    for event in events:
+        event_type = (event.get('event_type') or {}).get('id', '')
+        letter = event.get('body') or {}
+        if not event.get('id') or not event_type.startswith('letter.'):
+            continue
+        rows.append((event['id'], event_type, letter.get('id'), event.get('date_created'),
+                     json.dumps(event)))
+    if not rows:
+        return 0
+
+    conn = get_db_connection()
+    cur = conn.cursor()
+    inserted = execute_values(cur, """
+        INSERT INTO lob_events (event_id, event_type, letter_id, occurred_at, payload)
+        VALUES %s
+        ON CONFLICT (event_id) DO NOTHING
+        RETURNING event_id
+    """, rows, template="(%s, %s, %s, %s::timestamptz, %s)", fetch=True)
+    conn.commit()
+    cur.close()
+    conn.close()
+
+    metrics.incr("lob_webhooks.received", len(rows))
+    metrics.incr("lob_webhooks.duplicates", len(rows) - len(inserted))
+    return len(inserted)
+
+def apply_pending_events(limit=LOB_WEBHOOK_BATCH_SIZE):
+    """
+    Apply stored, not yet applied events to their disputes in one transaction: the most
+    advanced status per letter wins, statuses never move backwards, and every change is
+    logged to dispute_history. Returns {'events', 'updated'}.
+    """
+    started = time.perf_counter()
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT event_id, event_type, letter_id, occurred_at FROM lob_events
+        WHERE applied_at IS NULL
+        ORDER BY occurred_at NULLS LAST, received_at
+        LIMIT %s
+        FOR UPDATE SKIP LOCKED
+    """, (limit,))
+    events = cur.fetchall()
+    if not events:
+        cur.close()
+        conn.close()
+        return {'events': 0, 'updated': 0}
+
+    # One row per letter: its most advanced status in this batch
+    latest = {}
+    for event in events:
+        status = letter_status(event['event_type'])
+        if not event['letter_id'] or not status:
+            continue
+        current = latest.get(event['letter_id'])
+        if current is None or STATUS_RANK[status] >= STATUS_RANK[current[0]]:
+            latest[event['letter_id']] = (status, utc_naive(event['occurred_at']), event['event_type'])
+    updated = apply_letter_statuses(cur, [
+        (letter_id, status, occurred_at, f"Lob webhook: {event_type}")
+        for letter_id, (status, occurred_at, event_type) in latest.items()])
+
+    # Letters webhooks are reporting on drop out of the reconciliation sweep for a while
+    letter_ids = sorted({event['letter_id'] for event in events if event['letter_id']})
+    if letter_ids:
+        cur.execute("""
+            UPDATE disputes
+            SET last_event_at = CURRENT_TIMESTAMP,
+                next_check_at = GREATEST(next_check_at, CURRENT_TIMESTAMP + %s * INTERVAL '1 hour')
+            WHERE tracking_id = ANY(%s)
+        """, (LOB_RECONCILE_AFTER_HOURS, letter_ids))
+    cur.execute("UPDATE lob_events SET applied_at = CURRENT_TIMESTAMP WHERE event_id = ANY(%s)",
+                ([event['event_id'] for event in events],))
+    conn.commit()
+    cur.close()
+    conn.close()
+
+    now = datetime.now(timezone.utc)
+    for event in events:
+        if event['occurred_at']:
+            metrics.observe("lob_webhooks.lag_seconds", (now - event['occurred_at']).total_seconds())
+    metrics.incr("lob_webhooks.applied", len(events))
+    metrics.observe("lob_webhooks.apply_seconds", time.perf_counter() - started)
+    print(f"📨 Applied {len(events)} Lob event(s): {updated} dispute status change(s)")
+    return {'events': len(events), 'updated': updated}
+
+def _apply_batch():
+    """Background: wait for more events to arrive, then apply everything pending"""
+    global _apply_scheduled
+    time.sleep(LOB_WEBHOOK_BATCH_SECONDS)
+    with _lock:
+        _apply_scheduled = False
+    try:
+        while apply_pending_events()['events'] >= LOB_WEBHOOK_BATCH_SIZE:
+            pass
+    except Exception as e:
+        metrics.incr("lob_webhooks.apply_failed")
+        print(f"❌ Failed to apply Lob events (kept for the next batch): {e}")
+
+def schedule_apply():
+    """Apply pending events shortly, batching everything received in the meantime"""
+    global _applier, _applier_pid, _apply_scheduled
+    with _lock:
+        if _applier is None or _applier_pid != os.getpid():
+            _applier = ThreadPoolExecutor(max_workers=1, thread_name_prefix="lob-events")
+            _applier_pid = os.getpid()
+            _apply_scheduled = False
+        if _apply_scheduled:
+            return
+        _apply_scheduled = True
+        _applier.submit(_apply_batch)
@@ -1,8 +1,11 @@
-import lob, os
+import io
+import lob
 from dotenv import load_dotenv
 
+from http_clients import lob_config
+
 load_dotenv()
-lob.api_key = os.getenv("LOB_API_KEY")
+lob_config()  # Key, API base and pooled connections to api.lob.com
 
 BUREAU_ADDRESSES = {
     "experian": {
@@ -36,19 +39,48 @@ FROM_ADDRESS = {
     "address_zip": "33602"
 }
 
-def send_letter(file_path, bureau, description):
-    """Mail letter through Lob and return tracking ID."""
+def pdf_file(pdf):
+    """
+    File object for Lob's multipart upload: wraps in-memory PDF bytes/memoryview,
+    or opens a path (streamed by requests, not read up front)
+    """
+    if isinstance(pdf, (bytes, bytearray, memoryview)):
+        f = io.BytesIO(pdf)
+        f.name = "letter.pdf"
+        return f
+    return open(pdf, "rb")
+
+def create_letter(pdf, bureau, description, idempotency_key=None):
+    """
+    Create the Lob letter (PDF bytes or a file path); raises lob.error.LobError on failure.
+    With an idempotency_key, repeating the call returns the letter Lob already created.
+    """
+    with pdf_file(pdf) as f:
+        return _create(f, bureau, description, idempotency_key)
+
+def create_template_letter(template_id, merge_variables, bureau, description, idempotency_key=None):
+    """
+    Create the Lob letter from a registered template (see lob_templates) and the
+    letter's merge variables; raises lob.error.LobError on failure.
+    """
+    return _create(template_id, bureau, description, idempotency_key, merge_variables=merge_variables)
+
+def _create(file, bureau, description, idempotency_key, **extra):
+    if idempotency_key:
+        extra['headers'] = {'Idempotency-Key': idempotency_key}
+    return lob.Letter.create(
+        description=description,
+        to_address=BUREAU_ADDRESSES[bureau.lower()],
+        from_address=FROM_ADDRESS,
+        file=file,
+        color=False,
+        **extra
+    )
+
+def send_letter(pdf, bureau, description):
+    """Mail letter (PDF bytes or a file path) through Lob and return tracking ID."""
     try:
-        with open(file_path, "rb") as f:
-            file_bytes = f.read()
-
-        response = lob.Letter.create(
-            description=description,
-            to_address=BUREAU_ADDRESSES[bureau.lower()],
-            from_address=FROM_ADDRESS,
-            file=file_bytes,
-            color=False
-        )
+        response = create_letter(pdf, bureau, description)
         print(f"✅ {bureau.title()} letter sent: {response['id']}")
         return response["id"]
     except Exception as e:
@@ -3,10 +3,11 @@ SendGrid Email Service for Magic Link Authentication
 """
 import os
 import logging
-from sendgrid import SendGridAPIClient
 from sendgrid.helpers.mail import Mail
 from dotenv import load_dotenv
 
+from http_clients import get_session
+
 load_dotenv()
 
 # Configure logging
@@ -18,6 +19,19 @@ logger = logging.getLogger(__name__)
 
 SENDGRID_API_KEY = os.getenv('SENDGRID_API_KEY')
 FROM_EMAIL = os.getenv('FROM_EMAIL', 'noreply@nextcredit.app')
+SENDGRID_SEND_URL = 'https://api.sendgrid.com/v3/mail/send'
+
+def send_message(message: Mail):
+    """
+    Send a Mail through SendGrid's v3 API on the shared keep-alive session
+    (SendGridAPIClient opens a new urllib connection for every send)
+    """
+    return get_session().post(
+        SENDGRID_SEND_URL,
+        json=message.get(),
+        headers={'Authorization': f'Bearer {SENDGRID_API_KEY}'},
+        timeout=(5, 30)
+    )
 
 def send_magic_link_email(to_email: str, magic_link: str, username: str = None) -> bool:
     """
@@ -122,14 +136,13 @@ def send_magic_link_email(to_email: str, magic_link: str, username: str = None)
     )
     
     try:
-        sg = SendGridAPIClient(SENDGRID_API_KEY)
-        response = sg.send(message)
+        response = send_message(message)
         
         if response.status_code in [200, 201, 202]:
             logger.info(f"✅ Magic link email sent to {to_email}")
             return True
         else:
-            logger.error(f"❌ SendGrid error: {response.status_code} - {response.body}")
+            logger.error(f"❌ SendGrid error: {response.status_code} - {response.text}")
             return False
             
     except Exception as e:
@@ -227,8 +240,7 @@ def send_welcome_email(to_email: str, username: str) -> bool:
     )
     
     try:
-        sg = SendGridAPIClient(SENDGRID_API_KEY)
-        response = sg.send(message)
+        response = send_message(message)
         
         if response.status_code in [200, 201, 202]:
             logger.info(f"✅ Welcome email sent to {to_email}")
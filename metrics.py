@@ -0,0 +1,80 @@
+"""
+In-process Metrics
+Lightweight counters, gauges and timings for the AI/mailing pipeline, exposed at /api/metrics
+"""
+
+import threading
+from collections import defaultdict, deque
+
+TIMING_WINDOW = 500  # Samples kept per timing series
+
+_lock = threading.Lock()
+_counters = defaultdict(int)
+_gauges = {}
+_gauge_callbacks = {}
+_timings = defaultdict(lambda: deque(maxlen=TIMING_WINDOW))
+
+def incr(name, value=1):
+    """Increment a counter"""
+    with _lock:
+        _counters[name] += value
+
+def set_gauge(name, value):
+    """Set a gauge to its current value"""
+    with _lock:
+        _gauges[name] = value
+
+def register_gauge(name, callback):
+    """Register a gauge whose value is computed when metrics are read"""
+    with _lock:
+        _gauge_callbacks[name] = callback
+
+def observe(name, value):
+    """Record a timing/size sample (seconds, tokens, bytes...)"""
+    with _lock:
+        _timings[name].append(value)
+
+def get_counter(name):
+    with _lock:
+        return _counters.get(name, 0)
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of numbers (None if empty)"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100.0 * len(ordered))) - 1))
+    return ordered[index]
+
+def summarize(values):
+    """Count/mean/p50/p95/p99 summary of samples"""
+    values = list(values)
+    if not values:
+        return {'count': 0}
+    return {
+        'count': len(values),
+        'mean': round(sum(values) / len(values), 4),
+        'p50': round(percentile(values, 50), 4),
+        'p95': round(percentile(values, 95), 4),
+        'p99': round(percentile(values, 99), 4)
+    }
+
+def snapshot():
+    """Current values of all metrics as a JSON-serializable dict"""
+    with _lock:
+        counters = dict(_counters)
+        gauges = dict(_gauges)
+        callbacks = dict(_gauge_callbacks)
+        timings = {name: list(samples) for name, samples in _timings.items()}
+
+    for name, callback in callbacks.items():
+        try:
+            gauges[name] = callback()
+        except Exception as e:
+            gauges[name] = f"error: {e}"
+
+    return {
+        'counters': counters,
+        'gauges': gauges,
+        'timings': {name: summarize(samples) for name, samples in timings.items()}
+    }
@@ -0,0 +1,80 @@
+"""
+Letter PDF Engine
+Styles are built once per process; rendering a letter only lays out its paragraphs.
+The page output is the same as the original generate_pdf (same page, margins and
+styles, no added furniture)
+"""
+
+import re
+import threading
+from xml.sax.saxutils import escape
+from reportlab.lib.pagesizes import LETTER
+from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, PageBreak
+from reportlab.lib.units import inch
+
+def letter_paragraphs(text):
+    """Paragraphs of a letter (split on blank lines), each a list of its lines"""
+    return [para.split('\n') for para in text.split('\n\n') if para.strip()]
+
+
+class LetterPdfEngine:
+    """Reusable letter layout: one instance per process (see get_pdf_engine)"""
+
+    def __init__(self, pagesize=LETTER, margins=(72, 72, 72, 18)):
+        self.pagesize = pagesize
+        self.left_margin, self.right_margin, self.top_margin, self.bottom_margin = margins
+
+        styles = getSampleStyleSheet()
+        self.body_style = ParagraphStyle(
+            'CustomNormal',
+            parent=styles['Normal'],
+            fontSize=11,
+            leading=14,
+            spaceAfter=6
+        )
+        self.paragraph_gap = 0.1 * inch
+
+    def story(self, text):
+        """Flowables for the letter text (see letter_paragraphs)"""
+        story = []
+        for lines in letter_paragraphs(text):
+            # Escape markup characters (e.g. "AT&T"), keep single newlines as line breaks
+            story.append(Paragraph('<br/>'.join(escape(line) for line in lines), self.body_style))
+            story.append(Spacer(1, self.paragraph_gap))
+        return story
+
+    def render(self, text, out):
+        """
+        Render a letter to a path or binary file object. text may also be a list of
+        letters, printed as one document with each section starting on a new page
+        """
+        if isinstance(text, str):
+            story = self.story(text)
+        else:
+            story = []
+            for index, section in enumerate(text):
+                if index:
+                    story.append(PageBreak())
+                story.extend(self.story(section))
+        doc = SimpleDocTemplate(out if hasattr(out, 'write') else str(out), pagesize=self.pagesize,
+                                rightMargin=self.right_margin, leftMargin=self.left_margin,
+                                topMargin=self.top_margin, bottomMargin=self.bottom_margin)
+        doc.build(story)
+
+
+def pdf_page_count(data):
+    """Pages in a rendered PDF (counts its page objects; no parsing library needed)"""
+    return len(re.findall(rb"/Type\s*/Page\b", data))
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+def get_pdf_engine():
+    """Process-wide engine (styles built on first use)"""
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = LetterPdfEngine()
+        return _engine
@@ -0,0 +1,166 @@
+"""
+PDF Render Pool
+ReportLab layout is pure-Python and CPU-bound, so batch runs render letters in a pool of
+warm worker processes (reportlab imported and the letter engine built before the first
+job) instead of one after another on a single core. Workers run pdf_worker only: they
+don't re-import the script that started them (see _WorkerPopen).
+"""
+
+import io
+import os
+import time
+import threading
+import multiprocessing
+from multiprocessing import popen_forkserver, spawn
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dotenv import load_dotenv
+
+import metrics
+
+load_dotenv()
+
+# 0 = one worker per core; 1 = render in-process (no pool)
+PDF_RENDER_WORKERS = int(os.getenv("PDF_RENDER_WORKERS", "0")) or os.cpu_count() or 1
+
+_lock = threading.Lock()
+_pool = None
+_pool_pid = None
+
+def render_pdf(text, out_path=None):
+    """Render one letter in this process; returns out_path, or the PDF bytes when no path is given"""
+    import pdf_worker
+    return pdf_worker.render_pdf(text, out_path)
+
+
+class _WorkerPopen(popen_forkserver.Popen):
+    """
+    Starts a pool worker without the parent's __main__. multiprocessing normally has
+    each child import the parent's main script as __mp_main__ first, so under
+    `python batch_processor.py` every render worker would load the whole app (DB and
+    OpenAI clients, the provider probe thread) before rendering a page. The workers'
+    code lives in importable modules (pdf_worker, concurrent.futures), so they don't
+    need it. Same as popen_forkserver.Popen._launch, minus the main-module entries.
+    """
+
+    def _launch(self, process_obj):
+        prep_data = spawn.get_preparation_data(process_obj._name)
+        prep_data.pop('init_main_from_name', None)
+        prep_data.pop('init_main_from_path', None)
+        buf = io.BytesIO()
+        popen_forkserver.set_spawning_popen(self)
+        try:
+            popen_forkserver.reduction.dump(prep_data, buf)
+            popen_forkserver.reduction.dump(process_obj, buf)
+        finally:
+            popen_forkserver.set_spawning_popen(None)
+
+        self.sentinel, w = popen_forkserver.forkserver.connect_to_new_process(self._fds)
+        _parent_w = os.dup(w)
+        self.finalizer = popen_forkserver.util.Finalize(self, popen_forkserver.util.close_fds,
+                                                        (_parent_w, self.sentinel))
+        with open(w, 'wb', closefd=True) as f:
+            f.write(buf.getbuffer())
+        self.pid = popen_forkserver.forkserver.read_signed(self.sentinel)
+
+class _WorkerProcess(multiprocessing.context.ForkServerProcess):
+    @staticmethod
+    def _Popen(process_obj):
+        return _WorkerPopen(process_obj)
+
+class _WorkerContext(multiprocessing.context.ForkServerContext):
+    Process = _WorkerProcess
+
+def _get_pool():
+    """
+    The process-wide render pool, created on first use (and again after a fork).
+    Workers come from a forkserver so they never inherit the web worker's threads/locks,
+    preloaded with pdf_worker (reportlab) and nothing else.
+    """
+    import pdf_worker
+
+    global _pool, _pool_pid
+    with _lock:
+        if _pool is None or _pool_pid != os.getpid():
+            context = _WorkerContext()
+            context.set_forkserver_preload(["pdf_worker"])
+            _pool = ProcessPoolExecutor(max_workers=PDF_RENDER_WORKERS, mp_context=context,
+                                        initializer=pdf_worker.warm)
+            _pool_pid = os.getpid()
+            print(f"🖨️  PDF render pool started ({PDF_RENDER_WORKERS} workers)")
+        return _pool
+
+def _reset_pool(broken=None):
+    """Drop the pool (only if it is still the given broken one - another caller may have replaced it)"""
+    global _pool
+    with _lock:
+        if _pool is None or (broken is not None and _pool is not broken):
+            return
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+def _render_in_process(text, out_path):
+    future = Future()
+    try:
+        future.set_result(render_pdf(text, out_path))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+def _fall_back_if_broken(pool, pool_future, text, out_path):
+    """
+    Future for a pooled render that re-renders in-process if the pool breaks after the
+    job was submitted (a worker killed mid-render) instead of losing the letter
+    """
+    future = Future()
+
+    def rerender():
+        try:
+            future.set_result(render_pdf(text, out_path))
+        except Exception as e:
+            future.set_exception(e)
+
+    def done(pooled):
+        error = pooled.exception()
+        if isinstance(error, BrokenProcessPool):
+            print(f"⚠️ PDF render worker lost ({error}), rendering in-process")
+            metrics.incr("pdf.render.worker_lost")
+            _reset_pool(pool)
+            # Not on this callback's thread: it belongs to the broken pool's manager
+            threading.Thread(target=rerender, name="pdf-rerender", daemon=True).start()
+        elif error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(pooled.result())
+
+    pool_future.add_done_callback(done)
+    return future
+
+def submit_pdf(text, out_path=None):
+    """
+    Queue a letter for rendering; returns a Future resolving to out_path (or the PDF
+    bytes). Falls back to rendering in-process when the pool is disabled or broken,
+    including when it breaks while the letter is queued or rendering.
+    """
+    metrics.incr("pdf.render.submitted")
+    started = time.perf_counter()
+    import pdf_worker
+
+    if PDF_RENDER_WORKERS <= 1:
+        future = _render_in_process(text, out_path)
+    else:
+        try:
+            pool = _get_pool()
+            future = _fall_back_if_broken(pool, pool.submit(pdf_worker.render_pdf, text, out_path), text, out_path)
+        except (BrokenProcessPool, RuntimeError) as e:
+            print(f"⚠️ PDF render pool unavailable ({e}), rendering in-process")
+            metrics.incr("pdf.render.pool_unavailable")
+            _reset_pool()
+            future = _render_in_process(text, out_path)
+    # Queue wait + render, as seen by the caller
+    future.add_done_callback(lambda _: metrics.observe("pdf.render_seconds", time.perf_counter() - started))
+    return future
+
+def render_pdfs(jobs):
+    """Submit (text, out_path) pairs to render in parallel; Futures in the same order"""
+    return [submit_pdf(text, out_path) for text, out_path in jobs]
@@ -0,0 +1,85 @@
+"""
+Generated PDF Storage
+Letters go from the renderer to Lob as in-memory bytes. The copy under
+disputes/generated/ (for downloads and review) is written in the background, so the
+send path never waits on a write/read of its own PDF
+"""
+
+import os
+import time
+import threading
+from pathlib import Path
+from concurrent.futures import Future, ThreadPoolExecutor
+from dotenv import load_dotenv
+
+import metrics
+
+load_dotenv()
+
+PDF_PERSIST = os.getenv("PDF_PERSIST", "async")  # async | sync | off
+PDF_PERSIST_FSYNC = os.getenv("PDF_PERSIST_FSYNC", "0") == "1"
+
+_lock = threading.Lock()
+_writer = None
+_writer_pid = None
+_pending = {}  # path -> bytes queued but not yet on disk
+
+def _get_writer():
+    global _writer, _writer_pid
+    with _lock:
+        if _writer is None or _writer_pid != os.getpid():
+            _writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="pdf-writer")
+            _writer_pid = os.getpid()
+        return _writer
+
+def _write(data, path):
+    started = time.perf_counter()
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+            if PDF_PERSIST_FSYNC:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, path)  # Readers never see a half-written PDF
+        metrics.observe("pdf.persist_seconds", time.perf_counter() - started)
+        return path
+    except Exception as e:
+        metrics.incr("pdf.persist.failed")
+        print(f"❌ Failed to save {path}: {e}")
+        raise
+    finally:
+        with _lock:
+            if _pending.get(str(path)) is data:
+                del _pending[str(path)]
+
+def persist_pdf(data, path):
+    """
+    Save a rendered PDF to disk per PDF_PERSIST: queued on a background writer (async),
+    written before returning (sync) or skipped (off). Returns a Future for the path.
+    """
+    path = Path(path)
+    future = Future()
+    if PDF_PERSIST == "off":
+        future.set_result(None)
+        return future
+    if PDF_PERSIST == "sync":
+        future.set_result(_write(data, path))
+        return future
+
+    with _lock:
+        _pending[str(path)] = data
+    return _get_writer().submit(_write, data, path)
+
+def pending_pdf(path):
+    """Bytes of a PDF that is still queued for writing (so downloads don't 404 meanwhile)"""
+    with _lock:
+        return _pending.get(str(path))
+
+def flush(timeout=None):
+    """Wait for queued writes (e.g. before a batch script exits)"""
+    with _lock:
+        writer = _writer if _writer_pid == os.getpid() else None
+    if writer is not None:
+        writer.submit(lambda: None).result(timeout=timeout)
@@ -0,0 +1,22 @@
+"""
+PDF Render Worker
+What pdf_pool's worker processes run. Imports nothing but pdf_engine, so a worker only
+loads reportlab - not the app (DB, LLM clients, health probes) it was started from.
+"""
+
+import io
+
+from pdf_engine import get_pdf_engine
+
+def warm():
+    """Pool initializer: build the engine and lay out one page so the first job is warm"""
+    get_pdf_engine().render("Warm-up", io.BytesIO())
+
+def render_pdf(text, out_path=None):
+    """Render one letter; returns out_path, or the PDF bytes when no path is given"""
+    if out_path is None:
+        buffer = io.BytesIO()
+        get_pdf_engine().render(text, buffer)
+        return buffer.getvalue()
+    get_pdf_engine().render(text, out_path)
+    return out_path
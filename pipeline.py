@@ -0,0 +1,195 @@
+"""
+Streaming Pipeline
+Stages connected by bounded queues, each stage with its own worker threads. Items flow
+through as soon as the previous stage hands them on, a full queue holds its producers
+back, and every stage reports throughput, utilization and queue depth so the slowest
+one is easy to spot and give more workers.
+"""
+
+import time
+import queue
+import threading
+import traceback
+
+import metrics
+
+_DONE = object()  # End-of-stream marker passed from stage to stage
+
+class Stage:
+    """
+    One pipeline step. func(item) -> item (None drops it), or with batch_size set,
+    func(items) -> items for up to batch_size items gathered within linger seconds.
+    on_error(items, error) -> items to pass on when func raises (default: drop them).
+    """
+
+    def __init__(self, name, func, workers=1, batch_size=None, linger=0.5,
+                 queue_size=32, on_error=None):
+        self.name = name
+        self.func = func
+        self.workers = max(1, workers)
+        self.batch_size = batch_size
+        self.linger = linger
+        self.queue_size = queue_size
+        self.on_error = on_error
+
+class _StageStats:
+    def __init__(self, stage):
+        self.stage = stage
+        self.lock = threading.Lock()
+        self.items_in = 0
+        self.items_out = 0
+        self.errors = 0
+        self.busy = 0.0  # Seconds spent in func, summed over workers
+        self.blocked = 0.0  # Seconds waiting on a full downstream queue
+        self.depth_max = 0
+        self.depth_total = 0
+        self.depth_samples = 0
+
+    def sample_depth(self, depth):
+        with self.lock:
+            self.depth_max = max(self.depth_max, depth)
+            self.depth_total += depth
+            self.depth_samples += 1
+
+    def report(self, elapsed):
+        stage = self.stage
+        return {
+            'workers': stage.workers,
+            'items_in': self.items_in,
+            'items_out': self.items_out,
+            'errors': self.errors,
+            'per_second': round(self.items_out / elapsed, 2) if elapsed else None,
+            'utilization': round(self.busy / (stage.workers * elapsed), 3) if elapsed else None,
+            'blocked_seconds': round(self.blocked, 2),
+            'queue_size': stage.queue_size,
+            'queue_max': self.depth_max,
+            'queue_avg': round(self.depth_total / self.depth_samples, 1) if self.depth_samples else 0
+        }
+
+class Pipeline:
+    """Runs items from a source iterable through the stages in order"""
+
+    def __init__(self, name, stages):
+        self.name = name
+        self.stages = stages
+
+    def run(self, source):
+        """
+        Feed source through every stage and wait until all items are through (the
+        source is read lazily, so it may be a generator that fetches more work as
+        room frees up). Returns the per-stage report; re-raises a source error.
+        """
+        queues = [queue.Queue(maxsize=max(1, stage.queue_size)) for stage in self.stages]
+        stats = [_StageStats(stage) for stage in self.stages]
+        for stage, q in zip(self.stages, queues):
+            metrics.register_gauge(f"{self.name}.{stage.name}.queue_depth", q.qsize)
+
+        started = time.perf_counter()
+        source_error = []
+        threads = [threading.Thread(target=self._feed, args=(source, queues[0], source_error),
+                                    name=f"{self.name}-source", daemon=True)]
+        for index, stage in enumerate(self.stages):
+            outbox = queues[index + 1] if index + 1 < len(queues) else None
+            remaining = [stage.workers]  # Last worker out passes the end marker on
+            for number in range(stage.workers):
+                threads.append(threading.Thread(
+                    target=self._work, args=(stage, stats[index], queues[index], outbox, remaining),
+                    name=f"{self.name}-{stage.name}-{number}", daemon=True))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        report = {stage.name: stage_stats.report(elapsed)
+                  for stage, stage_stats in zip(self.stages, stats)}
+        self._publish(report, elapsed)
+        if source_error:
+            raise source_error[0]
+        return report
+
+    def _feed(self, source, inbox, source_error):
+        try:
+            for item in source:
+                inbox.put(item)
+        except Exception as e:
+            traceback.print_exc()
+            source_error.append(e)
+        finally:
+            inbox.put(_DONE)
+
+    def _take(self, stage, stats, inbox):
+        """Next item, or a batch gathered within the linger time; None at end of stream"""
+        item = inbox.get()
+        stats.sample_depth(inbox.qsize())
+        if item is _DONE:
+            inbox.put(_DONE)  # Let this stage's other workers see it too
+            return None
+        if not stage.batch_size:
+            return [item]
+
+        batch = [item]
+        deadline = time.monotonic() + stage.linger
+        while len(batch) < stage.batch_size:
+            try:
+                item = inbox.get(timeout=max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+            if item is _DONE:
+                inbox.put(_DONE)
+                break
+            batch.append(item)
+        return batch
+
+    def _work(self, stage, stats, inbox, outbox, remaining):
+        while True:
+            batch = self._take(stage, stats, inbox)
+            if batch is None:
+                break
+            started = time.perf_counter()
+            try:
+                if stage.batch_size:
+                    results = list(stage.func(batch) or [])
+                else:
+                    result = stage.func(batch[0])
+                    results = [] if result is None else [result]
+            except Exception as e:
+                traceback.print_exc()
+                metrics.incr(f"{self.name}.{stage.name}.errors")
+                results = list(stage.on_error(batch, e) or []) if stage.on_error else []
+                with stats.lock:
+                    stats.errors += len(batch)
+            elapsed = time.perf_counter() - started
+            metrics.observe(f"{self.name}.{stage.name}.seconds", elapsed)
+
+            with stats.lock:
+                stats.items_in += len(batch)
+                stats.items_out += len(results)
+                stats.busy += elapsed
+            if outbox is not None:
+                blocked_from = time.perf_counter()
+                for result in results:
+                    outbox.put(result)
+                with stats.lock:
+                    stats.blocked += time.perf_counter() - blocked_from
+
+        with stats.lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last and outbox is not None:
+            outbox.put(_DONE)
+
+    def _publish(self, report, elapsed):
+        """Print the per-stage report and keep it in /api/metrics"""
+        print(f"📊 {self.name}: {elapsed:.1f}s")
+        for name, stage in report.items():
+            metrics.incr(f"{self.name}.{name}.items", stage['items_out'])
+            metrics.set_gauge(f"{self.name}.{name}.per_second", stage['per_second'])
+            metrics.set_gauge(f"{self.name}.{name}.utilization", stage['utilization'])
+            metrics.set_gauge(f"{self.name}.{name}.queue_max", stage['queue_max'])
+            utilization = f"{stage['utilization']:.0%}" if stage['utilization'] is not None else "-"
+            print(f"   {name:<12} {stage['workers']:>2} worker(s)  {stage['items_out']:>5} out  "
+                  f"{stage['per_second'] or 0:>7.2f}/s  busy {utilization:>4}  "
+                  f"queue max {stage['queue_max']}/{stage['queue_size']} avg {stage['queue_avg']}  "
+                  f"blocked {stage['blocked_seconds']}s"
+                  + (f"  ⚠️ {stage['errors']} error(s)" if stage['errors'] else ""))
@@ -0,0 +1,110 @@
+"""
+Speculative Letter Pre-generation
+Builds the letter in the background as soon as a pending dispute is created and stores
+its text on the dispute, so /generate-batch can reuse it instead of waiting on the LLM
+(the PDF is rendered from the text when it is downloaded or sent)
+"""
+
+import os
+import threading
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Set PREGENERATE_LETTERS=0 to disable (e.g. to avoid speculative OpenAI spend)
+PREGENERATE_ENABLED = os.getenv("PREGENERATE_LETTERS", "1") == "1"
+PREGENERATE_NICENESS = int(os.getenv("PREGENERATE_NICENESS", "10"))
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def _lower_thread_priority():
+    """Run pre-generation below request threads (Linux applies nice per thread)"""
+    try:
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), PREGENERATE_NICENESS)
+    except (AttributeError, OSError):
+        pass
+
+def _get_executor():
+    """Single low-priority worker, created lazily so gunicorn --preload forks stay clean"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=1,
+                thread_name_prefix="letter-pregen",
+                initializer=_lower_thread_priority
+            )
+        return _executor
+
+def pregenerated_pdf_path(dispute):
+    """Path the letter for a dispute is written to (same layout as /generate-batch)"""
+    return Path(f"disputes/generated/{dispute['bureau'].lower()}") / f"{dispute['account_number']}.pdf"
+
+def stored_letter(dispute, inputs_hash):
+    """
+    The dispute's saved letter text if it was generated from these inputs, else None.
+    Rows without a hash (premium regenerations) are trusted as before.
+    """
+    if not dispute.get('letter_text'):
+        return None
+    stored_hash = dispute.get('inputs_hash')
+    return dispute['letter_text'] if stored_hash is None or stored_hash == inputs_hash else None
+
+def is_pregenerated(dispute, inputs_hash):
+    """
+    True if the dispute already has a usable letter for these inputs - saved text, or
+    (rows from before letter text was stored) a PDF on disk
+    """
+    if stored_letter(dispute, inputs_hash):
+        return True
+    pdf_path = dispute.get('pdf_path')
+    if dispute.get('letter_text') or not pdf_path or not Path(pdf_path).exists():
+        return False
+    stored_hash = dispute.get('inputs_hash')
+    return stored_hash is None or stored_hash == inputs_hash
+
+def pregenerate_letter(dispute_id):
+    """Generate and save the letter text for a pending dispute; discard if its inputs changed meanwhile"""
+    from db import get_dispute_for_generation, save_dispute_letter
+    from generator import render_letter, account_info_from_dispute, letter_inputs_hash
+
+    dispute = get_dispute_for_generation(dispute_id)
+    if not dispute or dispute.get('status') != 'pending':
+        return None
+
+    account_info = account_info_from_dispute(dispute)
+    inputs_hash = letter_inputs_hash(account_info)
+    if is_pregenerated(dispute, inputs_hash) and dispute.get('inputs_hash'):
+        return stored_letter(dispute, inputs_hash) or dispute['pdf_path']
+
+    print(f"🕒 Pre-generating letter for dispute {dispute_id}...")
+    source = {}
+    letter_text = render_letter(account_info, use_ai=True, source_out=source)
+
+    # Inputs may have changed (or the user generated/sent it) while the LLM was running
+    current = get_dispute_for_generation(dispute_id)
+    if (not current or current.get('status') != 'pending'
+            or letter_inputs_hash(account_info_from_dispute(current)) != inputs_hash
+            or stored_letter(current, inputs_hash)):
+        print(f"🗑️  Discarded pre-generated letter for dispute {dispute_id} (inputs changed)")
+        return None
+
+    save_dispute_letter(dispute_id, letter_text, inputs_hash, source.get('model'), source.get('prompt_version'))
+    print(f"✅ Pre-generated letter ready for dispute {dispute_id} ({source.get('model')})")
+    return letter_text
+
+def _run_pregeneration(dispute_id):
+    try:
+        return pregenerate_letter(dispute_id)
+    except Exception as e:
+        print(f"⚠️  Pre-generation failed for dispute {dispute_id}: {e}")
+        return None
+
+def schedule_pregeneration(dispute_id):
+    """Queue a background pre-generation pass for a newly created pending dispute"""
+    if not PREGENERATE_ENABLED or not dispute_id:
+        return None
+    return _get_executor().submit(_run_pregeneration, dispute_id)
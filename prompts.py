@@ -0,0 +1,196 @@
+"""
+Prompt Assembly
+Versioned prompt templates for letter generation.
+
+v1 is the original layout (account data first, REQUIREMENTS after it).
+v2 puts everything static - system message, instructions, REQUIREMENTS - first and
+byte-identical across calls, with the per-account data last, so OpenAI prompt caching
+and Ollama's prefix KV reuse can skip the shared prefix.
+"""
+
+import os
+from dotenv import load_dotenv
+
+import metrics
+
+load_dotenv()
+
+PROMPT_VERSION = os.getenv("LLM_PROMPT_VERSION", "v2")
+PROMPT_VERSIONS = ("v1", "v2")
+
+STANDARD_SYSTEM_PROMPT = "You are a professional credit repair specialist who writes effective, legally-compliant dispute letters. Your letters are clear, firm, and always get results."
+PREMIUM_SYSTEM_PROMPT = "You are an elite credit repair specialist with 20+ years experience. Your letters are meticulously crafted, legally bulletproof, and highly effective. You adapt your writing style based on client needs while maintaining professionalism."
+
+LETTER_INTRO = "You are an expert credit repair specialist. Generate a professional, legally-compliant credit dispute letter."
+BATCH_INTRO = "You are an expert credit repair specialist. Generate one professional, legally-compliant credit dispute letter for EACH account below."
+
+OLLAMA_REQUIREMENTS = """
+REQUIREMENTS:
+1. Write a formal business letter in a professional tone
+2. Cite the Fair Credit Reporting Act (FCRA) rights
+3. Clearly state what is being disputed and why
+4. Request investigation and correction within 30 days
+5. Request written confirmation of results
+6. Be firm but respectful
+7. Keep it concise (300-500 words)
+8. Include proper letter structure (date, recipient, body, closing)
+9. Use "To Whom It May Concern:" as greeting
+10. Sign off with "Sincerely,"
+
+DO NOT include:
+- Sender's personal information in the body (will be added separately)
+- Threats or aggressive language
+- Irrelevant information
+- Legal jargon that's too complex
+"""
+
+OPENAI_REQUIREMENTS = """
+REQUIREMENTS:
+1. Write a formal business letter in a professional tone
+2. Cite the Fair Credit Reporting Act (FCRA) rights
+3. Clearly state what is being disputed and why
+4. Request investigation and correction
+5. Request written confirmation of results
+6. Be firm but respectful
+7. Keep it concise (300-500 words)
+8. Include proper letter structure (date, recipient, body, closing)
+9. Use "Dear Sir or Madam" as greeting
+10. Sign off with "Sincerely,"
+
+DO NOT include:
+- Sender's personal information in the body (will be added separately)
+- Threats or aggressive language
+- Irrelevant information
+- Legal jargon that's too complex
+"""
+
+PREMIUM_REQUIREMENTS = """
+STANDARD REQUIREMENTS:
+1. Write a formal business letter
+2. Cite the Fair Credit Reporting Act (FCRA) rights
+3. Clearly state what is being disputed and why
+4. Request investigation and correction
+5. Request written confirmation of results
+6. Include proper letter structure (date, recipient, body, closing)
+7. Use "Dear Sir or Madam" as greeting
+8. Sign off with "Sincerely,"
+
+DO NOT include:
+- Sender's personal information in the body (will be added separately)
+- Threats or aggressive language
+- Irrelevant information
+"""
+
+OLLAMA_OUTPUT_INSTRUCTION = "Generate ONLY the letter body. Start with today's date and the bureau address."
+OPENAI_OUTPUT_INSTRUCTION = "Generate ONLY the letter body. Start with the date line."
+
+BATCH_RULES = "Each letter must be complete on its own and only discuss its own account."
+BATCH_OUTPUT_INSTRUCTION = """Return JSON: {"letters": [{"id": "<account id>", "letter": "<letter body>"}]} with exactly one entry per account id.
+Each letter body starts with the date line."""
+
+def _requirements(kind):
+    return OLLAMA_REQUIREMENTS if kind == "ollama" else OPENAI_REQUIREMENTS
+
+def _output_instruction(kind):
+    return OLLAMA_OUTPUT_INSTRUCTION if kind == "ollama" else OPENAI_OUTPUT_INSTRUCTION
+
+def account_fields(account_info: dict) -> str:
+    """The variable per-account lines"""
+    fields = f"""- Credit Bureau: {account_info.get('bureau', 'N/A')}
+- Creditor: {account_info.get('creditor_name', 'N/A')}
+- Account Number: {account_info.get('account_number', 'N/A')}
+- Account Type: {account_info.get('account_type', 'Not specified')}
+- Balance: ${account_info.get('balance', 'N/A')}
+- Dispute Reason: {account_info.get('reason', 'N/A')}
+"""
+
+    if account_info.get('notes'):
+        fields += f"- Additional Details: {account_info['notes']}\n"
+
+    return fields
+
+def _split_for_kind(kind, system, static_prefix, variable):
+    """
+    Place the static prefix for a backend: OpenAI gets it at the start of the user
+    message (after the fixed system message); Ollama gets it as the system field so
+    the templated prompt starts with the same tokens every time.
+    """
+    if kind == "ollama":
+        return static_prefix, variable
+    return system, static_prefix + variable
+
+# --- v1: original layout (account data before the static REQUIREMENTS) ---
+
+def _v1_letter(kind, account_info):
+    prompt = f"{LETTER_INTRO}\n\nACCOUNT INFORMATION:\n{account_fields(account_info)}"
+    prompt += _requirements(kind) + "\n" + _output_instruction(kind)
+    return (None if kind == "ollama" else STANDARD_SYSTEM_PROMPT), prompt
+
+def _v1_premium(account_info, custom_instructions):
+    prompt = f"{LETTER_INTRO}\n\nACCOUNT INFORMATION:\n{account_fields(account_info)}"
+    if custom_instructions:
+        prompt += f"\nCUSTOM REQUIREMENTS:\n{custom_instructions}\n"
+    return PREMIUM_SYSTEM_PROMPT, prompt + PREMIUM_REQUIREMENTS + "\n" + OPENAI_OUTPUT_INSTRUCTION
+
+def _v1_batch(kind, account_infos):
+    prompt = f"{BATCH_INTRO}\n{_requirements(kind)}\n{BATCH_RULES}\n"
+    for index, account_info in enumerate(account_infos):
+        prompt += f"\nACCOUNT id={index}:\n{account_fields(account_info)}"
+    prompt += "\n" + BATCH_OUTPUT_INSTRUCTION
+    return (None if kind == "ollama" else STANDARD_SYSTEM_PROMPT), prompt
+
+# --- v2: static prefix first, variable data last ---
+
+def _v2_letter(kind, account_info):
+    static_prefix = (f"{LETTER_INTRO}\n{_requirements(kind)}\n{_output_instruction(kind)}\n\n")
+    variable = f"ACCOUNT INFORMATION:\n{account_fields(account_info)}"
+    return _split_for_kind(kind, STANDARD_SYSTEM_PROMPT, static_prefix, variable)
+
+def _v2_premium(account_info, custom_instructions):
+    static_prefix = f"{LETTER_INTRO}\n{PREMIUM_REQUIREMENTS}\n{OPENAI_OUTPUT_INSTRUCTION}\n\n"
+    variable = f"ACCOUNT INFORMATION:\n{account_fields(account_info)}"
+    if custom_instructions:
+        # Customer-specific instructions go last; they override the standard requirements
+        variable += f"\nCUSTOM REQUIREMENTS:\n{custom_instructions}\n"
+    return PREMIUM_SYSTEM_PROMPT, static_prefix + variable
+
+def _v2_batch(kind, account_infos):
+    static_prefix = (f"{BATCH_INTRO}\n{_requirements(kind)}\n{BATCH_RULES}\n"
+                     f"{BATCH_OUTPUT_INSTRUCTION}\n")
+    variable = "".join(f"\nACCOUNT id={index}:\n{account_fields(account_info)}"
+                       for index, account_info in enumerate(account_infos))
+    return _split_for_kind(kind, STANDARD_SYSTEM_PROMPT, static_prefix, variable)
+
+_TEMPLATES = {
+    "v1": {"letter": _v1_letter, "premium": _v1_premium, "batch": _v1_batch},
+    "v2": {"letter": _v2_letter, "premium": _v2_premium, "batch": _v2_batch},
+}
+
+def _template(name, version):
+    version = version or PROMPT_VERSION
+    if version not in _TEMPLATES:
+        raise ValueError(f"Unknown prompt version: {version}")
+    return _TEMPLATES[version][name]
+
+def letter_prompt(kind, account_info, version=None):
+    """(system, prompt) for one standard letter on a backend kind ('ollama' / 'openai')"""
+    return _template("letter", version)(kind, account_info)
+
+def premium_prompt(account_info, custom_instructions="", version=None):
+    """(system, prompt) for a premium letter with customer instructions"""
+    return _template("premium", version)(account_info, custom_instructions)
+
+def batch_prompt(kind, account_infos, version=None):
+    """(system, prompt) for a multi-account structured request"""
+    return _template("batch", version)(kind, account_infos)
+
+def record_prompt_usage(version, usage):
+    """Track time-to-first-token and cached-prompt ratio per prompt version (v1 vs v2)"""
+    version = version or PROMPT_VERSION
+    if usage.get('ttft') is not None:
+        metrics.observe(f"prompt.{version}.ttft_seconds", usage['ttft'])
+    prompt_tokens = usage.get('prompt_tokens') or 0
+    if prompt_tokens and usage.get('cached_tokens') is not None:
+        metrics.observe(f"prompt.{version}.cached_token_ratio", usage['cached_tokens'] / prompt_tokens)
+    if usage.get('prompt_eval_seconds') is not None:
+        metrics.observe(f"prompt.{version}.prompt_eval_seconds", usage['prompt_eval_seconds'])
@@ -0,0 +1,188 @@
+"""
+LLM Provider Health
+Circuit breakers and background health probes so an unavailable backend (e.g. Ollama
+not running in production) fails fast instead of costing a round trip per letter
+"""
+
+import os
+import time
+import threading
+import requests
+from dotenv import load_dotenv
+
+import metrics
+from http_clients import get_session
+
+load_dotenv()
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+STATE_CODES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("LLM_BREAKER_FAILURES", "3"))
+BREAKER_RESET_SECONDS = float(os.getenv("LLM_BREAKER_RESET_SECONDS", "30"))
+PROBE_INTERVAL_SECONDS = float(os.getenv("LLM_PROBE_INTERVAL_SECONDS", "15"))
+PROBE_TIMEOUT_SECONDS = float(os.getenv("LLM_PROBE_TIMEOUT_SECONDS", "2"))
+
+class CircuitBreaker:
+    """
+    Classic closed -> open -> half-open breaker.
+
+    closed:    requests flow; consecutive failures trip it open
+    open:      requests fail fast until reset_timeout passes (or a probe succeeds)
+    half_open: one trial request is let through; success closes, failure re-opens
+    """
+
+    def __init__(self, name, failure_threshold=BREAKER_FAILURE_THRESHOLD,
+                 reset_timeout=BREAKER_RESET_SECONDS):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state
+
+    def _transition(self, new_state):
+        if new_state == self._state:
+            return
+        print(f"🔌 Circuit '{self.name}': {self._state} -> {new_state}")
+        metrics.incr(f"breaker.{self.name}.transitions.{new_state}")
+        self._state = new_state
+        if new_state == OPEN:
+            self._opened_at = time.monotonic()
+            self._trial_in_flight = False
+        elif new_state == CLOSED:
+            self._failures = 0
+            self._trial_in_flight = False
+
+    def allow_request(self):
+        """Return True if a call may be attempted now, False to fail fast"""
+        with self._lock:
+            if self._state == OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self._transition(HALF_OPEN)
+
+            if self._state == CLOSED:
+                return True
+            if self._state == HALF_OPEN and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+
+        metrics.incr(f"breaker.{self.name}.fast_fail")
+        return False
+
+    def is_available(self):
+        """Non-consuming check used for routing (allow_request still gates the actual call)"""
+        with self._lock:
+            if self._state == CLOSED:
+                return True
+            if self._state == OPEN:
+                return time.monotonic() - self._opened_at >= self.reset_timeout
+            return not self._trial_in_flight
+
+    def release_trial(self):
+        """Give back a half-open trial slot without a verdict (call was cancelled, not failed)"""
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._transition(CLOSED)
+
+    def record_failure(self, trip=False):
+        """
+        Count a failure. trip=True opens the breaker immediately (connection
+        refused / timeout mean the backend is down, not just flaky).
+        """
+        with self._lock:
+            self._failures += 1
+            metrics.incr(f"breaker.{self.name}.failures")
+            if trip or self._state == HALF_OPEN or self._failures >= self.failure_threshold:
+                self._transition(OPEN)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'state': self._state,
+                'state_code': STATE_CODES[self._state],
+                'consecutive_failures': self._failures
+            }
+
+
+_breakers = {}
+_probes = {}
+_registry_lock = threading.Lock()
+_probe_thread = None
+_probe_pid = None
+
+def get_breaker(name):
+    """Get (or create) the breaker for a provider and expose its state in metrics"""
+    with _registry_lock:
+        breaker = _breakers.get(name)
+        if breaker is None:
+            breaker = CircuitBreaker(name)
+            _breakers[name] = breaker
+            metrics.register_gauge(f"breaker.{name}", breaker.snapshot)
+    _ensure_probe_thread()
+    return breaker
+
+def register_probe(name, probe):
+    """Register a cheap health check (callable returning True when healthy) for a provider"""
+    with _registry_lock:
+        _probes[name] = probe
+    _ensure_probe_thread()
+
+def http_probe(url, timeout=PROBE_TIMEOUT_SECONDS):
+    """Build a probe that GETs a lightweight endpoint (e.g. Ollama's /api/tags)"""
+    def probe():
+        try:
+            return get_session().get(url, timeout=timeout).status_code == 200
+        except requests.exceptions.RequestException:
+            return False
+    return probe
+
+def run_probes():
+    """Probe every registered provider once and feed the result into its breaker"""
+    with _registry_lock:
+        probes = list(_probes.items())
+
+    for name, probe in probes:
+        breaker = get_breaker(name)
+        started = time.monotonic()
+        healthy = probe()
+        metrics.observe(f"probe.{name}.seconds", time.monotonic() - started)
+        metrics.incr(f"probe.{name}.{'ok' if healthy else 'failed'}")
+
+        if healthy and breaker.state != CLOSED:
+            breaker.record_success()
+        elif not healthy and breaker.state != OPEN:
+            breaker.record_failure(trip=True)
+
+def _probe_loop():
+    while True:
+        time.sleep(PROBE_INTERVAL_SECONDS)
+        try:
+            run_probes()
+        except Exception as e:
+            print(f"⚠️  Provider health probe error: {e}")
+
+def _ensure_probe_thread():
+    """Start the probe thread lazily (and again in forked workers, where threads don't survive)"""
+    global _probe_thread, _probe_pid
+    if PROBE_INTERVAL_SECONDS <= 0:
+        return
+    with _registry_lock:
+        if _probe_thread is not None and _probe_pid == os.getpid() and _probe_thread.is_alive():
+            return
+        _probe_pid = os.getpid()
+        _probe_thread = threading.Thread(target=_probe_loop, name="llm-health-probe", daemon=True)
+        _probe_thread.start()
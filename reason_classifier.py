@@ -0,0 +1,84 @@
+"""
+Dispute Reason Classifier
+Maps the common dispute reasons (the Add Account dropdown, the CSV template values and
+their usual wordings) to pre-approved letter variants, so only unusual free-text
+disputes need the LLM
+"""
+
+import os
+import re
+from dotenv import load_dotenv
+
+load_dotenv()
+
+FAST_PATH_ENABLED = os.getenv("LETTER_FAST_PATH", "1") == "1"
+FAST_PATH_MAX_NOTE_WORDS = int(os.getenv("LETTER_FAST_PATH_MAX_NOTE_WORDS", "25"))
+KEYWORD_MAX_WORDS = 8  # Longer reasons are treated as free text even if a keyword matches
+
+# Exact (normalized) reason values, including the dropdown options
+REASON_PHRASES = {
+    'not_mine': ['not my account', 'not mine', 'never opened', 'never opened this account',
+                 'account not mine', 'i do not recognize this account'],
+    'identity_theft': ['identity theft', 'fraud', 'fraudulent account', 'stolen identity'],
+    # Only unqualified "paid in full" wordings: the letter says the balance is $0
+    'paid': ['already paid', 'paid in full', 'paid off', 'account paid', 'account paid in full'],
+    'incorrect_balance': ['incorrect balance', 'wrong balance', 'balance incorrect', 'balance is wrong'],
+    'incorrect_date': ['incorrect date', 'wrong date', 'incorrect dates', 'date incorrect'],
+    'duplicate': ['duplicate entry', 'duplicate', 'duplicate account', 'listed twice', 'reported twice'],
+    'outdated': ['outdated information', 'outdated', 'obsolete', 'too old', 'older than 7 years'],
+}
+
+# Keywords for short variations ("Balance reported wrong", "Duplicate tradeline").
+# 'paid' has none: "Paid late" or "not paid" must never get the paid-in-full letter.
+REASON_KEYWORDS = {
+    'not_mine': [r'\bnot (?:my|mine)\b', r'\bnever opened\b', r"\bdon'?t recognize\b", r'\bdo not recognize\b'],
+    'identity_theft': [r'\bidentity theft\b', r'\bfraud', r'\bstolen\b'],
+    'incorrect_balance': [r'\bbalance\b'],
+    'incorrect_date': [r'\bdates?\b'],
+    'duplicate': [r'\bduplicate\b', r'\btwice\b'],
+    'outdated': [r'\boutdated\b', r'\bobsolete\b', r'\b7 years\b', r'\bseven years\b'],
+}
+
+# Negations and qualifiers change what a keyword means ("not paid", "Never paid late",
+# "Fraud alert needed") - reasons with these go to the LLM unless they match exactly.
+# not_mine is exempt: its keywords are negations themselves.
+QUALIFIER_PATTERN = re.compile(r"\b(?:not|never|no|\w+n't|late|alert|partial|partially|but|except)\b")
+
+_PHRASE_LOOKUP = {phrase: reason_class for reason_class, phrases in REASON_PHRASES.items()
+                  for phrase in phrases}
+_KEYWORD_PATTERNS = {reason_class: [re.compile(pattern) for pattern in patterns]
+                     for reason_class, patterns in REASON_KEYWORDS.items()}
+
+def normalize_reason(text):
+    """Lowercase, drop punctuation (keeping apostrophes) and collapse whitespace"""
+    text = re.sub(r"[^\w\s']", " ", str(text or "").lower())
+    return " ".join(text.split())
+
+def classify_reason(reason, notes=""):
+    """
+    Return the letter variant for a dispute, or None if it needs the LLM.
+
+    A reason matches a class by exact phrase, or - for short reasons without negations
+    or qualifiers - by keywords of exactly one class. Long notes are free text the
+    template can't address, so they always go to the LLM.
+    """
+    if not FAST_PATH_ENABLED:
+        return None
+    if notes and len(str(notes).split()) > FAST_PATH_MAX_NOTE_WORDS:
+        return None
+
+    normalized = normalize_reason(reason)
+    if not normalized:
+        return None
+    if normalized in _PHRASE_LOOKUP:
+        return _PHRASE_LOOKUP[normalized]
+    if len(normalized.split()) > KEYWORD_MAX_WORDS:
+        return None
+
+    matches = [reason_class for reason_class, patterns in _KEYWORD_PATTERNS.items()
+               if any(pattern.search(normalized) for pattern in patterns)]
+    if len(matches) != 1:
+        return None
+    if matches[0] != 'not_mine' and QUALIFIER_PATTERN.search(normalized):
+        return None
+    return matches[0]
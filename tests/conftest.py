@@ -0,0 +1,23 @@
+"""Tests import the app's modules from the repository root; shared fixtures"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+@pytest.fixture
+def lob_server(monkeypatch):
+    """lob_standin.py on a free port, with the Lob SDK pointed at it"""
+    import lob
+    import lob_standin
+    from http_clients import lob_config
+
+    lob_config()  # Configured from the environment first, so it isn't redone over this
+    server = lob_standin.serve(0)
+    monkeypatch.setattr(lob, "api_base", f"http://127.0.0.1:{server.server_port}/v1")
+    monkeypatch.setattr(lob, "api_key", "test_x")
+    yield server
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,277 @@
+"""
+Tests for resuming an interrupted batch send (run with: python -m pytest tests/test_batch_resume.py).
+The pipeline mails through lob_standin.py (the lob_server fixture), which honors
+Idempotency-Key like Lob does; checkpoints live in a dict that follows the same rules
+as the batch_checkpoints upsert.
+"""
+
+import os
+import re
+import socket
+import subprocess
+import sys
+
+import pytest
+
+import batch_processor as bp
+import checkpoints
+import pdf_pool
+
+class CheckpointStore:
+    """batch_checkpoints in memory: stages only move forward, a mailing is fixed once submitting"""
+
+    def __init__(self):
+        self.rows = {}
+
+    def save(self, stage, entries):
+        order = checkpoints.STAGES.index
+        for entry in entries:
+            old = self.rows.get(entry['dispute_id'])
+            letter_hash = checkpoints.letter_hash(entry['letter_text'])
+            same_letter = old is not None and old['letter_hash'] == letter_hash
+            fixed = same_letter and order(old['stage']) >= order('submitting')
+            pdf_path = str(entry['pdf_path']) if entry.get('pdf_path') else None
+            if entry.get('pdf_sha256'):
+                pdf_sha256 = entry['pdf_sha256']
+            elif not same_letter or (pdf_path and pdf_path != old['pdf_path']):
+                pdf_sha256 = None
+            else:
+                pdf_sha256 = old['pdf_sha256']
+            self.rows[entry['dispute_id']] = {
+                'dispute_id': entry['dispute_id'],
+                'stage': stage if not same_letter or order(stage) > order(old['stage']) else old['stage'],
+                'letter_hash': letter_hash,
+                'idempotency_key': old['idempotency_key'] if fixed else
+                    entry.get('idempotency_key') or checkpoints.idempotency_key(entry['dispute_id'], entry['letter_text']),
+                'mailing_dispute_ids': old['mailing_dispute_ids'] if fixed else
+                    list(entry.get('mailing_dispute_ids') or [entry['dispute_id']]),
+                'pdf_path': pdf_path or (old['pdf_path'] if old else None),
+                'pdf_sha256': pdf_sha256,
+                'tracking_id': entry.get('tracking_id') or (old['tracking_id'] if same_letter else None),
+            }
+
+    def load(self, dispute_ids):
+        return {dispute_id: dict(self.rows[dispute_id]) for dispute_id in dispute_ids if dispute_id in self.rows}
+
+def letter(dispute_id):
+    return f"Dear Experian,\n\nRe: Creditor {dispute_id}\n\n" + "Please investigate this account. " * 20 + "\n\nSincerely,"
+
+def dispute(dispute_id, user_id=1):
+    return {'id': dispute_id, 'user_id': user_id, 'bureau': 'Experian', 'account_number': f"A{dispute_id}",
+            'creditor_name': f"Creditor {dispute_id}", 'account_type': 'Credit Card', 'balance': 0,
+            'notes': None, 'reason': None, 'description': 'Not mine', 'letter_text': letter(dispute_id),
+            'inputs_hash': None}
+
+@pytest.fixture
+def batch(monkeypatch, tmp_path, lob_server):
+    """Batch processor against the stand-in and in-memory tables; returns the recorded outcomes"""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(pdf_pool, "PDF_RENDER_WORKERS", 1)
+    monkeypatch.setattr(bp, "LOB_SEND_MODE", "pdf")
+    monkeypatch.setattr(bp, "BATCH_RECORD_LINGER", 0.05)
+    monkeypatch.setattr(bp, "BATCH_CONSOLIDATE_LINGER", 0.2)
+
+    store = CheckpointStore()
+    state = {'store': store, 'recorded': [], 'released': [], 'claimed': []}
+    monkeypatch.setattr(bp, "save_checkpoints", store.save)
+    monkeypatch.setattr(bp, "load_checkpoints", store.load)
+    monkeypatch.setattr(bp, "update_dispute_statuses", state['recorded'].extend)
+    monkeypatch.setattr(bp, "release_claims", state['released'].extend)
+    monkeypatch.setattr(bp, "save_dispute_letter", lambda *args, **kwargs: None)
+    monkeypatch.setattr(bp, "stored_letter", lambda row, inputs_hash: letter(row['id']))
+
+    def claim_disputes(dispute_ids):
+        state['claimed'].extend(dispute_ids)
+        return [dispute(dispute_id) for dispute_id in dispute_ids]
+    monkeypatch.setattr(bp, "claim_disputes", claim_disputes)
+    return state
+
+def run(disputes):
+    totals = bp.send_disputes(disputes)
+    bp.flush_pdfs()
+    return totals
+
+def crash_after_send(monkeypatch):
+    """The letter reaches Lob, then the worker dies before the 'submitted' checkpoint"""
+    send = bp.send_with_retries
+
+    def send_then_die(*args, **kwargs):
+        send(*args, **kwargs)
+        raise RuntimeError("worker died")
+    monkeypatch.setattr(bp, "send_with_retries", send_then_die)
+    return send
+
+def test_stages_advance_and_lob_gets_the_dispute_key(batch, lob_server):
+    totals = run([dispute(1), dispute(2)])
+
+    assert (totals['sent'], totals['mailings']) == (2, 2)
+    rows = batch['store'].rows
+    assert {row['stage'] for row in rows.values()} == {'recorded'}
+    assert set(lob_server.idempotent) == {checkpoints.idempotency_key(i, letter(i)) for i in (1, 2)}
+    assert {rows[i]['tracking_id'] for i in (1, 2)} == set(lob_server.letters)
+    assert sorted((dispute_id, status) for dispute_id, _, status, _ in batch['recorded']) == [(1, 'sent'), (2, 'sent')]
+
+def test_resume_after_submitted_only_records(batch, lob_server):
+    run([dispute(1)])
+    batch['store'].rows[1]['stage'] = 'submitted'  # Died before recording
+    tracking_id = batch['store'].rows[1]['tracking_id']
+    requests = len(lob_server.requests)
+    batch['recorded'].clear()
+
+    totals = run([dispute(1)])
+
+    assert len(lob_server.requests) == requests
+    assert batch['recorded'] == [(1, tracking_id, 'sent', "disputes/generated/experian/dispute-1.pdf")]
+    assert (totals['sent'], totals['mailings']) == (1, 0)
+    assert batch['store'].rows[1]['stage'] == 'recorded'
+
+def test_resume_after_submitting_gets_the_same_letter(batch, lob_server, monkeypatch):
+    send = crash_after_send(monkeypatch)
+    totals = run([dispute(1)])
+    assert totals['sent'] == 0 and batch['released'] == [1]
+    assert batch['store'].rows[1]['stage'] == 'submitting'
+    (letter_id,) = lob_server.letters
+
+    monkeypatch.setattr(bp, "send_with_retries", send)
+    totals = run([dispute(1)])
+
+    assert list(lob_server.letters) == [letter_id]
+    assert batch['store'].rows[1]['tracking_id'] == letter_id
+    assert totals['sent'] == 1
+
+def test_consolidated_resume_keeps_its_disputes(batch, lob_server, monkeypatch):
+    monkeypatch.setattr(bp, "BATCH_CONSOLIDATE", True)
+    monkeypatch.setattr(bp, "BATCH_CONSOLIDATE_MAX", 3)
+    send = crash_after_send(monkeypatch)
+    run([dispute(i) for i in range(1, 7)])
+    mailed = {letter_id: tuple(int(n) for n in re.findall(r"Creditor (\d+)", sent['text']))
+              for letter_id, sent in lob_server.letters.items()}
+    assert sorted(mailed.values()) == [(1, 2, 3), (4, 5, 6)]
+
+    # The next run sees only some of them, in another order: it must not regroup
+    monkeypatch.setattr(bp, "send_with_retries", send)
+    batch['recorded'].clear()
+    totals = run([dispute(i) for i in (5, 2, 6)])
+
+    assert len(lob_server.letters) == 2
+    assert sorted(batch['claimed']) == [1, 3, 4, 6]  # Brought in by the first of their mailing to arrive
+    tracking = {dispute_id: tracking_id for dispute_id, tracking_id, _, _ in batch['recorded']}
+    assert {tracking[i] for i in (1, 2, 3)} == {next(k for k, v in mailed.items() if v == (1, 2, 3))}
+    assert {tracking[i] for i in (4, 5, 6)} == {next(k for k, v in mailed.items() if v == (4, 5, 6))}
+    assert totals['sent'] == 6
+
+def test_resume_renders_a_changed_pdf_again(batch, lob_server, monkeypatch):
+    send = crash_after_send(monkeypatch)
+    run([dispute(1)])
+    row = batch['store'].rows[1]
+    assert row['pdf_sha256'] == checkpoints.pdf_hash(open(row['pdf_path'], 'rb').read())
+    with open(row['pdf_path'], 'wb') as f:
+        f.write(b"%PDF-1.4 another letter")  # e.g. overwritten by another run
+
+    rendered = []
+    submit_pdf = bp.submit_pdf
+    monkeypatch.setattr(bp, "submit_pdf", lambda text: rendered.append(text) or submit_pdf(text))
+    monkeypatch.setattr(bp, "send_with_retries", send)
+    run([dispute(1)])
+
+    assert rendered == [letter(1)]
+    assert checkpoints.pdf_hash(open(row['pdf_path'], 'rb').read()) == batch['store'].rows[1]['pdf_sha256']
+
+def test_resume_reuses_an_unchanged_pdf(batch, lob_server, monkeypatch):
+    send = crash_after_send(monkeypatch)
+    run([dispute(1)])
+
+    rendered = []
+    monkeypatch.setattr(bp, "submit_pdf", rendered.append)
+    monkeypatch.setattr(bp, "send_with_retries", send)
+    assert run([dispute(1)])['sent'] == 1
+    assert rendered == []
+
+# --- Claims of crashed runs -----------------------------------------------------------
+
+def test_claim_holder_gone(monkeypatch):
+    monkeypatch.setattr(bp, "WORKER_ID", "batch-1")
+    host = socket.gethostname()
+    finished = subprocess.Popen([sys.executable, "-c", "pass"])
+    finished.wait()
+
+    assert bp._claim_holder_gone("batch-1")  # An earlier run under our own id
+    assert bp._claim_holder_gone(f"{host}:{finished.pid}")
+    assert not bp._claim_holder_gone(f"{host}:{os.getpid()}")
+    assert not bp._claim_holder_gone(f"elsewhere:{finished.pid}")  # Can't be checked
+    assert not bp._claim_holder_gone("batch-2")
+
+class FakeCursor:
+    def __init__(self, holders):
+        self.holders = holders
+        self.executed = []
+        self.rowcount = 0
+
+    def execute(self, sql, params=None):
+        self.executed.append((sql, params))
+        if params:
+            self.rowcount = sum(1 for holder in self.holders if holder in params[0])
+
+    def fetchall(self):
+        return [{'claimed_by': holder} for holder in dict.fromkeys(self.holders)]
+
+    def close(self):
+        pass
+
+class FakeConnection:
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def cursor(self):
+        return self._cursor
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
+
+def test_release_dead_claims_leaves_live_workers(monkeypatch):
+    monkeypatch.setattr(bp, "WORKER_ID", "batch-1")
+    live = f"{socket.gethostname()}:{os.getpid()}"
+    cursor = FakeCursor(["batch-1", "batch-1", live, "elsewhere:12"])
+    monkeypatch.setattr(bp, "get_db_connection", lambda: FakeConnection(cursor))
+
+    assert bp.release_dead_claims() == 2
+    (_, params), = [(sql, params) for sql, params in cursor.executed if sql.strip().startswith("UPDATE")]
+    assert params == (["batch-1"],)
+
+def test_release_dead_claims_with_none_dead(monkeypatch):
+    monkeypatch.setattr(bp, "WORKER_ID", "batch-1")
+    cursor = FakeCursor(["elsewhere:12"])
+    monkeypatch.setattr(bp, "get_db_connection", lambda: FakeConnection(cursor))
+
+    assert bp.release_dead_claims() == 0
+    assert len(cursor.executed) == 1
+
+def test_unrecorded_outcomes_are_kept_for_the_next_run(batch, lob_server, monkeypatch):
+    def database_down(updates):
+        raise ConnectionError("database unavailable")
+    monkeypatch.setattr(bp, "update_dispute_statuses", database_down)
+    monkeypatch.setattr(bp, "BATCH_RECORD_SIZE", 10)
+    monkeypatch.setattr(bp, "BATCH_RECORD_LINGER", 1.0)
+    render = bp._render_stage
+
+    def render_unless_2(mailing):
+        if mailing['sections'][0]['dispute']['id'] == 2:
+            raise OSError("disk full")
+        return render(mailing)
+    monkeypatch.setattr(bp, "_render_stage", render_unless_2)
+    totals = run([dispute(1), dispute(2)])
+
+    assert (totals['sent'], totals['unrecorded']) == (0, 1)
+    assert batch['released'] == [2]  # Never reached Lob: handed back anyway
+    assert batch['store'].rows[1]['stage'] == 'submitted'
+
+    monkeypatch.setattr(bp, "update_dispute_statuses", batch['recorded'].extend)
+    requests = len(lob_server.requests)
+    totals = run([dispute(1)])
+
+    assert len(lob_server.requests) == requests
+    assert (totals['sent'], totals['unrecorded']) == (1, 0)
+    assert batch['store'].rows[1]['stage'] == 'recorded'
@@ -0,0 +1,72 @@
+"""Tests for retargeting a letter to another bureau (run with: python -m pytest tests/test_bureau_fanout.py)"""
+
+import itertools
+import re
+
+import pytest
+
+from bureau_fanout import BUREAUS, retarget_letter
+from mailer import BUREAU_ADDRESSES
+
+def letter_to(bureau):
+    """A letter as it would be written to this bureau"""
+    address = BUREAU_ADDRESSES[bureau]
+    brand = BUREAUS[bureau]['brands'][0]
+    return (f"March 2, 2026\n\n{address['name']}\n{address['address_line1']}\n"
+            f"{address['address_city']}, {address['address_state']} {address['address_zip']}\n\n"
+            f"To {BUREAUS[bureau]['legal_names'][0]}:\n\n"
+            f"I am writing to dispute an account on my {brand} credit report. Under FCRA §611, "
+            f"{brand} must investigate within 30 days. Please send the results to me, not to "
+            f"{address['address_line1']}.\n\nSincerely,\nJane Roe\n42 Oak Ave\nTampa, FL 33602")
+
+def mentions(letter, bureau):
+    """Names and address parts of the bureau still in the letter"""
+    address = BUREAU_ADDRESSES[bureau]
+    parts = BUREAUS[bureau]['brands'] + [address['address_line1'], address['address_zip'], address['address_city']]
+    return [part for part in parts if re.search(rf"(?<![\w-]){re.escape(part)}(?![\w-])", letter, re.IGNORECASE)]
+
+PAIRS = list(itertools.permutations(BUREAUS, 2))
+
+def test_all_bureau_pairs_covered():
+    assert len(PAIRS) == 6
+
+@pytest.mark.parametrize("source, target", PAIRS)
+def test_retarget_matches_a_letter_written_to_the_target(source, target):
+    assert retarget_letter(letter_to(source), source, target) == letter_to(target)
+
+@pytest.mark.parametrize("source, target", PAIRS)
+def test_retarget_leaves_no_other_bureau(source, target):
+    letter = retarget_letter(letter_to(source), source, target)
+    for other in BUREAUS:
+        if other != target:
+            assert mentions(letter, other) == []
+
+@pytest.mark.parametrize("source, target", PAIRS)
+def test_every_known_name_is_swapped_whole(source, target):
+    names = BUREAUS[source]['legal_names'] + BUREAUS[source]['department_names']
+    letter = retarget_letter(letter_to(source) + "\n\ncc: " + "; ".join(names), source, target)
+    cc = letter.rsplit("cc: ", 1)[1].split("; ")
+    assert set(cc) <= {BUREAUS[target]['legal_names'][0], BUREAU_ADDRESSES[target]['name']}
+
+@pytest.mark.parametrize("name", ["TransUnion Information Solutions, Inc.", "TransUnion, Inc.",
+                                  "TransUnion Consumer Relations"])
+def test_unknown_legal_name_is_not_invented(name):
+    letter = letter_to('transunion').replace("To TransUnion LLC:", f"To {name}:")
+    assert retarget_letter(letter, 'transunion', 'equifax') is None
+
+def test_spelling_variants():
+    letter = letter_to('transunion').replace("TransUnion credit report", "Trans Union credit report")
+    retargeted = retarget_letter(letter, 'Trans Union', 'Experian')
+    assert "Experian credit report" in retargeted and not mentions(retargeted, 'transunion')
+
+def test_same_bureau_is_unchanged():
+    assert retarget_letter(letter_to('equifax'), 'Equifax', 'equifax') == letter_to('equifax')
+
+def test_unknown_bureau():
+    assert retarget_letter(letter_to('equifax'), 'equifax', 'Innovis') is None
+
+@pytest.mark.parametrize("source, target", PAIRS)
+def test_recipient_block_named_by_brand_is_replaced_whole(source, target):
+    address = BUREAU_ADDRESSES[source]
+    letter = letter_to(source).replace(address['name'] + "\n", BUREAUS[source]['brands'][0] + "\n", 1)
+    assert retarget_letter(letter, source, target) == letter_to(target)
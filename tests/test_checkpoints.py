@@ -0,0 +1,104 @@
+"""
+Tests for batch checkpoints and Lob idempotency keys (run with: python -m pytest tests/test_checkpoints.py).
+The save/load tests run the real SQL and need a scratch PostgreSQL: set TEST_DATABASE_URL.
+"""
+
+import os
+import uuid
+
+import pytest
+
+import db
+from checkpoints import (STAGES, idempotency_key, letter_hash, load_checkpoints, mailing_idempotency_key,
+                         resume_point, save_checkpoints)
+
+def test_idempotency_key_is_stable():
+    assert idempotency_key(42, "Dear Experian,") == idempotency_key(42, "Dear Experian,")
+
+def test_idempotency_key_changes_with_the_letter_or_dispute():
+    key = idempotency_key(42, "Dear Experian,")
+    assert idempotency_key(42, "Dear Experian, (regenerated)") != key
+    assert idempotency_key(43, "Dear Experian,") != key
+
+def test_mailing_key_ignores_arrival_order():
+    letters = [(7, "first"), (3, "second"), (11, "third")]
+    assert mailing_idempotency_key(letters) == mailing_idempotency_key(list(reversed(letters)))
+
+def test_mailing_key_changes_with_members_or_letters():
+    key = mailing_idempotency_key([(3, "a"), (7, "b")])
+    assert mailing_idempotency_key([(3, "a"), (7, "b"), (9, "c")]) != key
+    assert mailing_idempotency_key([(3, "a"), (7, "b2")]) != key
+    assert mailing_idempotency_key([(3, "a")]) != idempotency_key(3, "a")
+
+def test_resume_point_only_for_the_same_letter():
+    checkpoint = {'dispute_id': 1, 'stage': 'submitting', 'letter_hash': letter_hash("letter")}
+    assert resume_point(checkpoint, "letter") is checkpoint
+    assert resume_point(checkpoint, "another letter") is None
+    assert resume_point(None, "letter") is None
+
+def test_stage_order():
+    assert STAGES == ('generated', 'rendered', 'submitting', 'submitted', 'recorded')
+
+# --- Against PostgreSQL ---------------------------------------------------------------
+
+@pytest.fixture
+def dispute_ids(monkeypatch):
+    url = os.getenv("TEST_DATABASE_URL")
+    if not url:
+        pytest.skip("TEST_DATABASE_URL not set")
+    monkeypatch.setattr(db, "DATABASE_URL", url)
+    db.init_db()
+    conn = db.get_db_connection()
+    cur = conn.cursor()
+    cur.execute("INSERT INTO users (password_hash, email) VALUES ('x', %s) RETURNING id",
+                (f"checkpoints-{uuid.uuid4().hex}@example.com",))
+    user_id = cur.fetchone()['id']
+    cur.execute("INSERT INTO disputes (user_id, bureau) SELECT %s, 'Experian' FROM generate_series(1, 3) RETURNING id",
+                (user_id,))
+    ids = [row['id'] for row in cur.fetchall()]
+    conn.commit()
+    yield ids
+    cur.execute("DELETE FROM users WHERE id = %s", (user_id,))
+    conn.commit()
+    cur.close()
+    conn.close()
+
+def test_stages_only_move_forward(dispute_ids):
+    dispute_id = dispute_ids[0]
+    entry = {'dispute_id': dispute_id, 'letter_text': "letter"}
+    save_checkpoints('submitted', [{**entry, 'tracking_id': 'ltr_1'}])
+    save_checkpoints('rendered', [{**entry, 'pdf_path': 'late.pdf'}])
+    row = load_checkpoints([dispute_id])[dispute_id]
+    assert (row['stage'], row['tracking_id']) == ('submitted', 'ltr_1')
+    assert row['idempotency_key'] == idempotency_key(dispute_id, "letter")
+
+def test_a_new_letter_restarts_the_checkpoint(dispute_ids):
+    dispute_id = dispute_ids[0]
+    save_checkpoints('submitted', [{'dispute_id': dispute_id, 'letter_text': "old", 'tracking_id': 'ltr_1',
+                                    'pdf_path': 'a.pdf', 'pdf_sha256': 'abc'}])
+    save_checkpoints('generated', [{'dispute_id': dispute_id, 'letter_text': "new"}])
+    row = load_checkpoints([dispute_id])[dispute_id]
+    assert (row['stage'], row['tracking_id'], row['pdf_sha256']) == ('generated', None, None)
+    assert row['idempotency_key'] == idempotency_key(dispute_id, "new")
+
+def test_mailing_is_fixed_once_submitting(dispute_ids):
+    first, second, third = dispute_ids
+    key = mailing_idempotency_key([(first, "a"), (second, "b")])
+    save_checkpoints('submitting', [
+        {'dispute_id': first, 'letter_text': "a", 'idempotency_key': key, 'mailing_dispute_ids': [first, second]},
+        {'dispute_id': second, 'letter_text': "b", 'idempotency_key': key, 'mailing_dispute_ids': [first, second]}])
+    # A later run grouping differently can't change what may already be at Lob
+    regrouped = mailing_idempotency_key([(first, "a"), (third, "c")])
+    save_checkpoints('submitting', [{'dispute_id': first, 'letter_text': "a", 'idempotency_key': regrouped,
+                                     'mailing_dispute_ids': [first, third]}])
+    row = load_checkpoints([first])[first]
+    assert (row['idempotency_key'], list(row['mailing_dispute_ids'])) == (key, [first, second])
+
+def test_rendered_pdf_hash_follows_its_file(dispute_ids):
+    dispute_id = dispute_ids[0]
+    entry = {'dispute_id': dispute_id, 'letter_text': "letter"}
+    save_checkpoints('rendered', [{**entry, 'pdf_path': 'a.pdf', 'pdf_sha256': 'abc'}])
+    save_checkpoints('submitting', [{**entry, 'pdf_path': 'a.pdf'}])
+    assert load_checkpoints([dispute_id])[dispute_id]['pdf_sha256'] == 'abc'
+    save_checkpoints('submitting', [{**entry, 'pdf_path': 'b.pdf'}])
+    assert load_checkpoints([dispute_id])[dispute_id]['pdf_sha256'] is None
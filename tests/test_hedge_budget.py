@@ -0,0 +1,41 @@
+"""Tests for the hedged request budget (run with: python -m pytest tests/test_hedge_budget.py)"""
+
+from llm_providers import HedgeBudget
+
+def test_no_calls_no_hedge():
+    budget = HedgeBudget(max_ratio=0.5)
+    assert not budget.try_spend()
+    assert budget.ratio() == 0.0
+
+def test_hedges_stay_within_ratio():
+    budget = HedgeBudget(max_ratio=0.1)
+    hedged = 0
+    for _ in range(100):
+        budget.record_call()
+        hedged += budget.try_spend()
+    assert hedged == 10
+    assert budget.ratio() == 0.1
+
+def test_first_call_is_not_hedged_under_a_small_ratio():
+    budget = HedgeBudget(max_ratio=0.1)
+    budget.record_call()
+    assert not budget.try_spend()  # 1 of 1 would be 100%
+
+def test_a_call_is_hedged_at_most_once():
+    budget = HedgeBudget(max_ratio=1.0)
+    budget.record_call()
+    assert budget.try_spend()
+    budget.try_spend()
+    assert budget.ratio() == 1.0
+
+def test_old_calls_leave_the_window():
+    budget = HedgeBudget(max_ratio=0.5, window=4)
+    for _ in range(4):
+        budget.record_call()
+        budget.try_spend()
+    assert budget.ratio() == 0.5
+    for _ in range(4):
+        budget.record_call()  # Unhedged calls push the hedged ones out
+    assert budget.ratio() == 0.0
+    budget.record_call()
+    assert budget.try_spend()
@@ -0,0 +1,92 @@
+"""Tests for near-duplicate letter reuse (run with: python -m pytest tests/test_letter_similarity.py)"""
+
+from datetime import date
+
+import pytest
+
+import letter_similarity
+from letter_similarity import LetterIndex, adapt_letter, jaccard, letter_tokens, reuse_letter
+
+GENERATED_ON = date(2026, 3, 2)
+
+def account(**fields):
+    info = {'user_id': 7, 'creditor_name': 'Chase', 'bureau': 'Experian', 'account_number': '4417',
+            'account_type': 'Credit Card', 'balance': '1500', 'reason': 'Late payment reported',
+            'notes': 'I was late in March 2023'}
+    info.update(fields)
+    return info
+
+LETTER = ("March 2, 2026\n\nExperian\n\nRe: Chase account 4417\n\n"
+          "Reason: Late payment reported. I was late in March 2023, but the account was brought current.\n"
+          "Reported balance: $1,500.00 (shown as $1500 on my report).\n\nSincerely,")
+
+@pytest.fixture
+def index(monkeypatch):
+    index = LetterIndex()
+    monkeypatch.setattr(letter_similarity, "_index", index)
+    return index
+
+def test_negation_stays_with_its_word():
+    assert 'not_late' in letter_tokens(account(notes="I was never late in March 2023"))
+    assert 'not_mine' in letter_tokens(account(notes="This is not mine"))
+    assert 'not_recognize' in letter_tokens(account(notes="I don't recognize it"))
+
+def test_opposite_notes_differ_in_their_tokens():
+    late = letter_tokens(account(reason="Dispute", notes="I was late in March 2023"))
+    never_late = letter_tokens(account(reason="Dispute", notes="I was never late in March 2023"))
+    assert 'late' in late and 'not_late' in never_late and 'late' not in never_late
+    assert jaccard(late, never_late) < letter_similarity.REUSE_THRESHOLD
+
+def test_opposite_notes_are_never_reused(index):
+    index.add(account(), LETTER)
+    assert index.find(account(notes="I was never late in March 2023"), threshold=0.0) is None
+    assert reuse_letter(account(account_number='9902', notes="I was never late in March 2023")) is None
+
+def test_negation_must_match_even_below_the_threshold(index):
+    index.add(account(notes="Account is mine"), LETTER)
+    assert index.find(account(notes="Account is not mine"), threshold=0.0) is None
+
+def test_same_dispute_on_another_account_is_reused(index):
+    index.add(account(), LETTER)
+    letter = reuse_letter(account(account_number='9902', balance='250'))
+    assert letter is not None
+    assert "9902" in letter and "4417" not in letter
+    assert "$250.00" in letter and "$250 on my report" in letter
+    assert "1500" not in letter and "1,500" not in letter
+
+def test_adapt_swaps_account_details_and_date():
+    adapted = adapt_letter(LETTER, account(), account(account_number='9902', balance='2,750.10',
+                                                      creditor_name='Capital One'), GENERATED_ON)
+    assert adapted is None  # $1500 has no form in a balance with cents
+
+    adapted = adapt_letter(LETTER, account(), account(account_number='9902', balance='2750',
+                                                      creditor_name='Capital One'), GENERATED_ON)
+    assert "Re: Capital One account 9902" in adapted
+    assert "$2,750.00 (shown as $2750 on my report)" in adapted
+    assert adapted.startswith(date.today().strftime("%B %d, %Y").replace(" 0", " "))
+
+def test_adapt_refuses_when_the_old_balance_is_left_behind():
+    letter = LETTER + "\nI owed 1500 dollars."
+    assert adapt_letter(letter.replace("$1500", "USD 1500.0"), account(), account(balance='250'), GENERATED_ON) is None
+
+def test_adapt_refuses_when_the_new_balance_is_unknown():
+    assert adapt_letter(LETTER, account(), account(balance=None), GENERATED_ON) is None
+
+def test_adapt_refuses_when_the_old_account_number_is_left_behind():
+    letter = LETTER + "\nReference 44170."  # Not a whole-number match, so not swapped
+    assert adapt_letter(letter, account(), account(account_number='9902'), GENERATED_ON) is None
+
+def test_adapt_swaps_a_different_note_quoted_exactly():
+    adapted = adapt_letter(LETTER, account(), account(notes="I was late in June 2023"), GENERATED_ON)
+    assert "I was late in June 2023, but" in adapted and "March 2023" not in adapted
+
+def test_adapt_refuses_a_different_note_it_cant_swap():
+    paraphrased = LETTER.replace("I was late in March 2023", "I acknowledge the March 2023 late payment")
+    assert adapt_letter(paraphrased, account(), account(notes="I was late in June 2023"), GENERATED_ON) is None
+
+def test_adapt_refuses_when_the_new_note_is_missing():
+    assert adapt_letter(LETTER, account(), account(notes=""), GENERATED_ON) is None
+
+def test_adapt_keeps_a_note_that_only_differs_in_case():
+    adapted = adapt_letter(LETTER, account(), account(notes="i was late in march 2023"), GENERATED_ON)
+    assert "I was late in March 2023" in adapted
@@ -0,0 +1,71 @@
+"""Tests for the Lob send rate limiter and retry rules (run with: python -m pytest tests/test_lob_sender.py)"""
+
+import pytest
+import requests
+from lob.error import APIConnectionError, AuthenticationError, InvalidRequestError, LobError
+
+import lob_sender
+from lob_sender import TokenBucket, is_retryable
+
+class Clock:
+    """monotonic() and sleep() that only move when slept on"""
+
+    def __init__(self):
+        self.now = 0.0
+        self.slept = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(lob_sender.time, "monotonic", clock.monotonic)
+    monkeypatch.setattr(lob_sender.time, "sleep", clock.sleep)
+    return clock
+
+def test_burst_is_free(clock):
+    bucket = TokenBucket(rate=2, burst=3)
+    assert [bucket.acquire() for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert clock.slept == []
+
+def test_waits_for_the_next_token(clock):
+    bucket = TokenBucket(rate=2, burst=1)
+    bucket.acquire()
+    assert bucket.acquire() == pytest.approx(0.5)
+    assert bucket.acquire() == pytest.approx(0.5)
+    assert clock.now == pytest.approx(1.0)
+
+def test_refills_up_to_burst(clock):
+    bucket = TokenBucket(rate=10, burst=2)
+    bucket.acquire()
+    bucket.acquire()
+    clock.now += 60
+    assert [bucket.acquire() for _ in range(2)] == [0.0, 0.0]
+    assert bucket.acquire() == pytest.approx(0.1)
+
+def test_burst_is_at_least_one(clock):
+    bucket = TokenBucket(rate=1, burst=0)
+    assert bucket.acquire() == 0.0
+
+@pytest.mark.parametrize("error, idempotent, retryable", [
+    (LobError("rate limited", http_status=429), False, True),
+    (LobError("server error", http_status=500), False, True),
+    (LobError("bad gateway", http_status=502), False, True),
+    (InvalidRequestError("bad address", http_status=422), False, False),
+    (AuthenticationError("bad key", http_status=401), True, False),
+    (LobError("no status"), True, False),
+    (APIConnectionError("connection reset"), False, True),
+    (requests.Timeout("read timed out"), False, False),
+    (requests.Timeout("read timed out"), True, True),
+    (requests.ConnectionError("dropped"), True, True),
+    (ValueError("not JSON"), False, False),
+    (ValueError("not JSON"), True, True),
+    (KeyError("id"), True, False),
+])
+def test_is_retryable(error, idempotent, retryable):
+    assert is_retryable(error, idempotent=idempotent) is retryable
@@ -0,0 +1,57 @@
+"""
+Tests for Lob template registration (run with: python -m pytest tests/test_lob_templates.py).
+Templates are registered with lob_standin.py servers; lob_templates rows live in a dict.
+"""
+
+import lob
+import pytest
+
+import http_clients
+import lob_standin
+import lob_templates
+
+@pytest.fixture
+def servers(monkeypatch):
+    http_clients.lob_config()
+    monkeypatch.setattr(lob, "api_key", "test_x")
+    monkeypatch.setattr(lob_templates, "_template_ids", {})
+    rows = {}
+    monkeypatch.setattr(lob_templates, "_stored_template_id", lambda api_base, version: rows.get((api_base, version)))
+    monkeypatch.setattr(lob_templates, "_save_template_id",
+                        lambda api_base, version, template_id: rows.setdefault((api_base, version), template_id))
+    started = [lob_standin.serve(0), lob_standin.serve(0)]
+    yield started
+    for server in started:
+        server.shutdown()
+        server.server_close()
+
+def use(monkeypatch, server):
+    monkeypatch.setattr(lob, "api_base", f"http://127.0.0.1:{server.server_port}/v1")
+
+def test_template_is_registered_once_per_api_base(servers, monkeypatch):
+    first, second = servers
+    use(monkeypatch, first)
+    template_id = lob_templates.ensure_template()
+    assert lob_templates.ensure_template() == template_id
+    assert list(first.templates) == [template_id]
+
+    use(monkeypatch, second)
+    other_id = lob_templates.ensure_template()
+    assert list(second.templates) == [other_id] and other_id != template_id
+
+    use(monkeypatch, first)
+    assert lob_templates.ensure_template() == template_id
+    assert len(first.templates) == 1
+
+def test_stored_id_is_used_after_a_restart(servers, monkeypatch):
+    server = servers[0]
+    use(monkeypatch, server)
+    template_id = lob_templates.ensure_template()
+    monkeypatch.setattr(lob_templates, "_template_ids", {})  # A new process
+
+    assert lob_templates.ensure_template() == template_id
+    assert len(server.templates) == 1
+
+def test_lob_config_keeps_the_api_base_it_was_given(servers, monkeypatch):
+    use(monkeypatch, servers[0])
+    assert http_clients.lob_config().api_base == f"http://127.0.0.1:{servers[0].server_port}/v1"
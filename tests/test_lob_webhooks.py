@@ -0,0 +1,75 @@
+"""Tests for Lob webhook signatures and event mapping (run with: python -m pytest tests/test_lob_webhooks.py)"""
+
+import time
+from datetime import datetime, timezone
+
+import pytest
+
+import lob_webhooks
+from lob_webhooks import LOB_WEBHOOK_TOLERANCE_SECONDS, letter_status, sign, verify_signature
+
+SECRET = "whsec_test"
+BODY = b'{"id": "evt_1", "event_type": {"id": "letter.delivered"}}'
+
+def test_valid_signature():
+    timestamp = str(int(time.time() * 1000))
+    assert verify_signature(BODY, timestamp, sign(BODY, timestamp, SECRET), SECRET)
+
+def test_valid_signature_with_iso_timestamp():
+    timestamp = datetime.now(timezone.utc).isoformat().replace('+00:00', 'Z')
+    assert verify_signature(BODY, timestamp, sign(BODY, timestamp, SECRET), SECRET)
+
+def test_stale_timestamp_is_rejected():
+    timestamp = str(int((time.time() - LOB_WEBHOOK_TOLERANCE_SECONDS - 60) * 1000))
+    assert not verify_signature(BODY, timestamp, sign(BODY, timestamp, SECRET), SECRET)
+
+def test_future_timestamp_is_rejected():
+    timestamp = str(int((time.time() + LOB_WEBHOOK_TOLERANCE_SECONDS + 60) * 1000))
+    assert not verify_signature(BODY, timestamp, sign(BODY, timestamp, SECRET), SECRET)
+
+def test_tampered_body_is_rejected():
+    timestamp = str(int(time.time() * 1000))
+    signature = sign(BODY, timestamp, SECRET)
+    assert not verify_signature(BODY.replace(b"delivered", b"returned_to_sender"), timestamp, signature, SECRET)
+
+def test_timestamp_is_part_of_the_signature():
+    timestamp = str(int(time.time() * 1000))
+    signature = sign(BODY, timestamp, SECRET)
+    assert not verify_signature(BODY, str(int(timestamp) + 1), signature, SECRET)
+
+def test_other_secret_is_rejected():
+    timestamp = str(int(time.time() * 1000))
+    assert not verify_signature(BODY, timestamp, sign(BODY, timestamp, "whsec_other"), SECRET)
+
+@pytest.mark.parametrize("timestamp, signature", [
+    (None, "abc"),
+    ("", "abc"),
+    ("not a time", "abc"),
+    ("1700000000000", None),
+])
+def test_missing_or_malformed_headers_are_rejected(timestamp, signature):
+    assert not verify_signature(BODY, timestamp, signature, SECRET)
+
+def test_no_secret_configured_rejects_everything(monkeypatch):
+    monkeypatch.setattr(lob_webhooks, "LOB_WEBHOOK_SECRET", None)
+    timestamp = str(int(time.time() * 1000))
+    assert not verify_signature(BODY, timestamp, sign(BODY, timestamp, SECRET), secret=None)
+
+@pytest.mark.parametrize("event, status", [
+    ("letter.mailed", "in_transit"),
+    ("letter.in_transit", "in_transit"),
+    ("letter.in_local_area", "in_transit"),
+    ("letter.certified.delivered", "delivered"),
+    ("letter.processed_for_delivery", "delivered"),
+    ("letter.returned_to_sender", "returned_to_sender"),
+    ("letter.deleted", "cancelled"),
+    ("In Local Area", "in_transit"),
+    ("Re-Routed", "in_transit"),
+    ("Delivered", "delivered"),
+    ("letter.created", None),
+    ("letter.rendered_pdf", None),
+    ("", None),
+    (None, None),
+])
+def test_letter_status(event, status):
+    assert letter_status(event) == status
@@ -0,0 +1,41 @@
+"""Tests for the letter PDF engine (run with: python -m pytest tests/test_pdf_engine.py)"""
+
+import io
+
+import pytest
+from reportlab import rl_config
+
+from benchmark_pdf import SAMPLE_LETTER, legacy_generate_pdf
+from pdf_engine import LetterPdfEngine, get_pdf_engine, pdf_page_count
+
+@pytest.fixture
+def invariant():
+    """Leave out creation dates and random document ids so two renders can be compared"""
+    rl_config.invariant = 1
+    yield
+    rl_config.invariant = 0
+
+def _render(render, text):
+    out = io.BytesIO()
+    render(text, out)
+    return out.getvalue()
+
+@pytest.mark.parametrize("text", [
+    SAMPLE_LETTER,
+    SAMPLE_LETTER + "\n\n" + "A long paragraph that runs onto another page. " * 200,
+])
+def test_same_bytes_as_original_generate_pdf(invariant, text):
+    assert _render(get_pdf_engine().render, text) == _render(legacy_generate_pdf, text)
+
+def test_no_sender_added(invariant):
+    from PyPDF2 import PdfReader
+    pdf = PdfReader(io.BytesIO(_render(LetterPdfEngine().render, "Dear Sir or Madam:\n\nSincerely,")))
+    assert pdf.pages[0].extract_text().split() == ["Dear", "Sir", "or", "Madam:", "Sincerely,"]
+
+def test_markup_characters_are_printed():
+    from PyPDF2 import PdfReader
+    pdf = PdfReader(io.BytesIO(_render(LetterPdfEngine().render, "AT&T reported <30 days> late")))
+    assert "AT&T reported <30 days> late" in pdf.pages[0].extract_text()
+
+def test_sections_start_new_pages():
+    assert pdf_page_count(_render(LetterPdfEngine().render, ["First letter", "Second letter"])) == 2
@@ -0,0 +1,124 @@
+"""
+Tests for the streaming pipeline (run with: python -m pytest tests/test_pipeline.py)
+"""
+
+import threading
+import time
+
+import pytest
+
+from pipeline import Pipeline, Stage
+
+def running(name):
+    return [thread for thread in threading.enumerate() if thread.name.startswith(f"{name}-")]
+
+def test_items_flow_through_every_stage():
+    out = []
+    report = Pipeline("flow", [
+        Stage("double", lambda n: n * 2, workers=3),
+        Stage("multiples_of_4", lambda n: n if n % 4 == 0 else None),
+        Stage("collect", lambda n: out.append(n) or n)
+    ]).run(range(10))
+
+    assert sorted(out) == [0, 4, 8, 12, 16]
+    assert (report['double']['items_in'], report['double']['items_out']) == (10, 10)
+    assert report['multiples_of_4']['items_out'] == 5
+    assert report['double']['workers'] == 3
+
+def test_a_full_queue_holds_the_source_back():
+    release = threading.Event()
+    read = []
+
+    def source():
+        for n in range(100):
+            read.append(n)
+            yield n
+
+    def slow(n):
+        release.wait()
+        return n
+
+    thread = threading.Thread(target=lambda: Pipeline("bounded", [Stage("slow", slow, queue_size=2)]).run(source()))
+    thread.start()
+    time.sleep(0.3)
+    # One item in the worker, two queued, one held by the blocked feeder
+    assert len(read) <= 4
+    release.set()
+    thread.join(timeout=5)
+    assert len(read) == 100
+
+def test_batches_fill_up_to_batch_size():
+    batches = []
+    Pipeline("batches", [Stage("batch", lambda items: batches.append(list(items)) or items,
+                               batch_size=4, linger=5)]).run(range(10))
+
+    assert [len(batch) for batch in batches] == [4, 4, 2]  # The last one goes at end of stream, not after linger
+
+def test_a_partial_batch_goes_after_linger():
+    batches = []
+
+    def source():
+        yield from range(3)
+        time.sleep(0.5)
+        yield 3
+
+    started = time.monotonic()
+    Pipeline("linger", [Stage("batch", lambda items: batches.append((time.monotonic() - started, list(items))),
+                              batch_size=10, linger=0.1)]).run(source())
+
+    (first_at, first), (_, second) = batches
+    assert (first, second) == ([0, 1, 2], [3])
+    assert first_at < 0.4
+
+def test_on_error_decides_what_is_passed_on():
+    out = []
+    seen = []
+
+    def fail_on_three(n):
+        if n == 3:
+            raise ValueError("bad item")
+        return n
+
+    def on_error(items, error):
+        seen.append((items, str(error)))
+        return [f"failed {item}" for item in items]
+
+    report = Pipeline("errors", [Stage("check", fail_on_three, on_error=on_error),
+                                 Stage("collect", out.append)]).run(range(5))
+
+    assert seen == [([3], "bad item")]
+    assert sorted(map(str, out)) == ["0", "1", "2", "4", "failed 3"]
+    assert report['check']['errors'] == 1
+
+def test_without_on_error_failed_items_are_dropped():
+    out = []
+    report = Pipeline("dropped", [Stage("check", lambda items: [1 / item for item in items], batch_size=2, linger=5),
+                                  Stage("collect", out.append)]).run([1, 0, 2, 4])
+
+    assert report['check']['errors'] == 2  # The whole batch with the 0
+    assert out == [0.5, 0.25]
+
+def test_source_error_is_raised_after_the_items_read_are_through():
+    out = []
+
+    def source():
+        yield 1
+        yield 2
+        raise RuntimeError("claim query failed")
+
+    with pytest.raises(RuntimeError, match="claim query failed"):
+        Pipeline("source_error", [Stage("collect", out.append, workers=2)]).run(source())
+    assert sorted(out) == [1, 2]
+    assert running("source_error") == []
+
+@pytest.mark.parametrize("workers", [1, 4])
+def test_every_worker_stops_at_end_of_stream(workers):
+    Pipeline("shutdown", [Stage("first", lambda n: n, workers=workers),
+                          Stage("batched", lambda items: items, workers=workers, batch_size=3, linger=0.05),
+                          Stage("last", lambda n: n, workers=workers)]).run(range(7))
+    assert running("shutdown") == []
+
+def test_an_empty_source_finishes():
+    report = Pipeline("empty", [Stage("only", lambda n: n, workers=3)]).run(iter(()))
+    assert report['only']['items_in'] == 0
+    assert running("empty") == []
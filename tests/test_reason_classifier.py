@@ -0,0 +1,35 @@
+"""Tests for the dispute reason classifier (run with: python -m pytest tests/test_reason_classifier.py)"""
+
+import pytest
+
+from reason_classifier import classify_reason
+
+@pytest.mark.parametrize("reason", [
+    "not paid",
+    "Paid late",
+    "Never paid late",
+    "Paid",
+    "Paid but still showing late",
+    "Partially paid",
+    "Fraud alert needed",
+    "Balance not updated",
+])
+def test_negated_or_qualified_reasons_go_to_llm(reason):
+    assert classify_reason(reason) is None
+
+@pytest.mark.parametrize("reason, expected", [
+    ("Already paid", "paid"),
+    ("Paid in full", "paid"),
+    ("paid off", "paid"),
+    ("Not my account", "not_mine"),
+    ("I don't recognize this account", "not_mine"),
+    ("Fraud", "identity_theft"),
+    ("Identity theft", "identity_theft"),
+    ("Balance reported wrong", "incorrect_balance"),
+    ("Duplicate tradeline", "duplicate"),
+])
+def test_common_reasons_use_template(reason, expected):
+    assert classify_reason(reason) == expected
+
+def test_long_notes_go_to_llm():
+    assert classify_reason("Already paid", notes="word " * 40) is None
@@ -0,0 +1,37 @@
+"""Tests for the tracking poll schedule (run with: python -m pytest tests/test_tracker.py)"""
+
+from datetime import datetime, timedelta
+
+import pytest
+
+from tracker import MAX_POLL_INTERVAL, MIN_POLL_INTERVAL, next_check_time
+
+NOW = datetime(2026, 3, 2, 12, 0)
+
+@pytest.mark.parametrize("status, days", [("queued", 2), ("sent", 2), ("in_transit", 7)])
+def test_not_polled_before_the_expected_transition(status, days):
+    sent = NOW - timedelta(days=1)
+    assert next_check_time(status, sent, now=NOW) == sent + timedelta(days=days)
+
+@pytest.mark.parametrize("status", ["delivered", "returned_to_sender", "cancelled", "invalid_tracking_id"])
+def test_final_statuses_are_not_tracked(status):
+    assert next_check_time(status, NOW - timedelta(days=30), now=NOW) is None
+
+def test_just_overdue_is_checked_after_the_minimum_interval():
+    sent = NOW - timedelta(days=2, hours=1)
+    assert next_check_time("sent", sent, now=NOW) == NOW + MIN_POLL_INTERVAL
+
+def test_overdue_checks_spread_out():
+    sent = NOW - timedelta(days=2 + 2)  # Two days overdue -> check again in one
+    assert next_check_time("sent", sent, now=NOW) == NOW + timedelta(days=1)
+
+def test_long_overdue_is_checked_at_most_every_max_interval():
+    sent = NOW - timedelta(days=60)
+    assert next_check_time("in_transit", sent, now=NOW) == NOW + MAX_POLL_INTERVAL
+
+def test_exactly_due_is_checked_after_the_minimum_interval():
+    sent = NOW - timedelta(days=7)
+    assert next_check_time("in_transit", sent, now=NOW) == NOW + MIN_POLL_INTERVAL
+
+def test_no_sent_date_counts_from_now():
+    assert next_check_time("queued", None, now=NOW) == NOW + timedelta(days=2)
@@ -1,49 +1,172 @@
 import lob
 import os
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
+from psycopg2.extras import execute_values
+import metrics
 from db import get_db_connection
+from lob_sender import TokenBucket, LOB_RATE_PER_SECOND, LOB_RATE_BURST
+from lob_webhooks import STATUS_RANK, letter_status, utc_naive, apply_letter_statuses, apply_pending_events
+from http_clients import lob_config
 
 load_dotenv()
-lob.api_key = os.getenv("LOB_API_KEY")
+lob_config()
 
-def fetch_pending_disputes():
+LOB_POLL_BATCH_SIZE = int(os.getenv("LOB_POLL_BATCH_SIZE", "100"))  # Due letters claimed per round
+LOB_POLL_CONCURRENCY = int(os.getenv("LOB_POLL_CONCURRENCY", "4"))
+LOB_POLL_MAX_PER_SWEEP = int(os.getenv("LOB_POLL_MAX_PER_SWEEP", "2000"))
+POLL_LEASE = timedelta(minutes=15)  # A claimed letter isn't claimed again this soon (crashed sweep)
+
+# When each status is usually left behind, counted from sent_date: Lob prints and mails
+# within ~2 business days, USPS First-Class delivers ~3-5 business days after that.
+# A letter isn't polled before then; once overdue, checks spread out with how overdue it is.
+EXPECTED_TRANSITION = {
+    'queued': timedelta(days=2),
+    'sent': timedelta(days=2),
+    'in_transit': timedelta(days=7)
+}
+MIN_POLL_INTERVAL = timedelta(hours=6)
+MAX_POLL_INTERVAL = timedelta(days=3)
+OPEN_STATUSES = tuple(EXPECTED_TRANSITION)
+
+_bucket = TokenBucket(LOB_RATE_PER_SECOND, LOB_RATE_BURST)
+
+def next_check_time(status, sent_date, now=None):
+    """When a letter in this status should next be polled (None = no longer tracked)"""
+    expected = EXPECTED_TRANSITION.get(status)
+    if expected is None:
+        return None
+    now = now or datetime.utcnow()
+    due = (sent_date or now) + expected
+    if due > now:
+        return due
+    return now + min(MAX_POLL_INTERVAL, max(MIN_POLL_INTERVAL, (now - due) / 2))
+
+def claim_due_letters(limit):
+    """
+    Open letters whose next check time has come (oldest due first), leased to this sweep
+    by pushing next_check_at forward so a concurrent sweep skips them
+    """
     conn = get_db_connection()
     cur = conn.cursor()
-    cur.execute("SELECT id, tracking_id, description FROM disputes WHERE status IN ('sent', 'in_transit', 'queued')")
+    cur.execute("""
+        UPDATE disputes SET next_check_at = CURRENT_TIMESTAMP + %s
+        WHERE id IN (
+            SELECT id FROM disputes
+            WHERE status = ANY(%s) AND (next_check_at IS NULL OR next_check_at <= CURRENT_TIMESTAMP)
+            ORDER BY next_check_at NULLS FIRST
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING id, tracking_id, description, status, sent_date
+    """, (POLL_LEASE, list(OPEN_STATUSES), limit))
     rows = cur.fetchall()
+    conn.commit()
     cur.close()
     conn.close()
     return rows
 
-def update_status(dispute_id, new_status):
+def letter_status_from_tracking(letter):
+    """
+    Most advanced dispute status among a retrieved letter's tracking events, and when it
+    happened (naive UTC) -> (status, time), or (None, None) if there's nothing to go on
+    """
+    found = [(letter_status(event.get('name')), event.get('time') or event.get('date_created'))
+             for event in letter.get('tracking_events') or []]
+    if letter.get('deleted'):
+        found.append(('cancelled', letter.get('date_modified')))
+    found = [(status, happened) for status, happened in found if status]
+    if not found:
+        return None, None
+    status, happened = max(found, key=lambda pair: STATUS_RANK[pair[0]])
+    try:
+        return status, utc_naive(happened)
+    except (TypeError, ValueError):
+        return status, None
+
+def poll_letter(row):
+    """Current status of one letter from Lob -> (row, new status or None, when, error)"""
+    if not row['tracking_id'] or row['tracking_id'] == "N/A":
+        return row, "invalid_tracking_id", None, None
+    try:
+        metrics.observe("lob_poll.rate_wait_seconds", _bucket.acquire())
+        letter = lob.Letter.retrieve(row['tracking_id'])
+        current_status, happened = letter_status_from_tracking(letter)
+        # Statuses only move forward (same rule as the webhook)
+        if current_status and STATUS_RANK[current_status] > STATUS_RANK.get(row['status'], 0):
+            return row, current_status, happened, None
+        return row, None, None, None
+    except Exception as e:
+        return row, None, None, e
+
+def save_poll_results(results):
+    """
+    Flush one polled batch in a single transaction: status changes (with their
+    dispute_history rows and, on delivery, the response due date) and every letter's
+    next check time, each as one set-based statement
+    """
+    if not results:
+        return 0
+    now = datetime.utcnow()
+    changes = []
+    schedule = []
+    for row, new_status, happened, error in results:
+        if new_status:
+            note = ("No Lob tracking ID" if new_status == "invalid_tracking_id"
+                    else f"Lob status check: {new_status}")
+            changes.append((row['id'], new_status, happened, note))
+        # A failed poll is retried after the shortest interval
+        next_check = (now + MIN_POLL_INTERVAL if error
+                      else next_check_time(new_status or row['status'], row['sent_date'], now))
+        schedule.append((row['id'], next_check))
+
     conn = get_db_connection()
     cur = conn.cursor()
-    cur.execute("UPDATE disputes SET status = %s WHERE id = %s", (new_status, dispute_id))
+    updated = apply_letter_statuses(cur, changes, match_on='id')
+    execute_values(cur, """
+        UPDATE disputes AS d SET next_check_at = v.next_check_at
+        FROM (VALUES %s) AS v (id, next_check_at)
+        WHERE d.id = v.id
+    """, schedule, template="(%s::integer, %s::timestamp)")
     conn.commit()
     cur.close()
     conn.close()
+    return updated
 
-def check_lob_status():
-    print("📡 Checking Lob letter delivery statuses...")
-    pending = fetch_pending_disputes()
-
-    if not pending:
-        print("✅ No pending letters found.")
-        return
-
-    for dispute_id, tracking_id, description in pending:
-        try:
-            if not tracking_id or tracking_id == "N/A":
-                update_status(dispute_id, "invalid_tracking_id")
-                print(f"⚠️ Skipping {description}: invalid tracking ID")
-                continue
+def check_lob_status(max_letters=LOB_POLL_MAX_PER_SWEEP):
+    """
+    Reconciliation sweep: apply any stored webhook events, then poll only the letters
+    that are due (see next_check_time), a batch at a time with bounded parallelism
+    (run it daily, or from "Check status"); returns counts
+    """
+    print("📡 Reconciling Lob letter delivery statuses...")
+    try:
+        apply_pending_events()
+    except Exception as e:
+        print(f"⚠️ Could not apply stored Lob events: {e}")
 
-            letter = lob.Letter.retrieve(tracking_id)
-            current_status = letter.get("status", "unknown")
-            update_status(dispute_id, current_status)
-            print(f"🔄 {description}: {current_status}")
+    checked = updated = errors = 0
+    with ThreadPoolExecutor(max_workers=LOB_POLL_CONCURRENCY, thread_name_prefix="lob-poll") as pool:
+        while checked < max_letters:
+            due = claim_due_letters(min(LOB_POLL_BATCH_SIZE, max_letters - checked))
+            if not due:
+                break
+            results = list(pool.map(poll_letter, due))
+            updated += save_poll_results(results)
 
-        except Exception as e:
-            print(f"❌ Error checking {description}: {e}")
+            for row, new_status, _, error in results:
+                if error:
+                    errors += 1
+                    print(f"❌ Error checking {row['description']}: {error}")
+                elif new_status:
+                    print(f"🔄 {row['description']}: {row['status']} → {new_status}")
+            checked += len(due)
 
-    print("✅ Status check complete.")
+    metrics.incr("lob_poll.checked", checked)
+    metrics.incr("lob_poll.updated", updated)
+    if not checked:
+        print("✅ No letters due for a status check.")
+    else:
+        print(f"✅ Reconciliation complete: {checked} checked, {updated} updated, {errors} error(s).")
+    return {'checked': checked, 'updated': updated, 'errors': errors}